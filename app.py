@@ -1,8 +1,12 @@
-from datetime import datetime, timezone
-from dateutil import tz
+from datetime import datetime, timedelta, timezone
 
+import atexit
+import calendar
+import json
 import logging
+import math
 import os
+import threading
 import time
 
 import flask
@@ -10,96 +14,397 @@ from flask import Flask, request, Response
 
 import sqlalchemy
 
-from connect_connector import connect_with_connector
-from connect_tcp import connect_tcp_socket
-from connect_unix import connect_unix_socket
+from connect import init_connection_pool, init_replica_pool
+import db_pool
+import dialect
+import downsample
+import export
+from group_cache import GroupCache
+from idempotency import RecentKeys
+import ingest
+import logs
+import metrics
+import migrations
+import partitions
+from rate_limit import RateLimiter
+from replica import ReadRouter
+import rollup
+import sessions
+import stream
+from user_cache import UserCache
+from write_behind import QueueFull, WriteBehindBuffer
 
 app = Flask(__name__)
 
+logs.configure()
 logger = logging.getLogger()
 
+# requests logged per route, see logs.py
+request_sampler = logs.RouteSampler.from_env()
+
+# codec.CONTENT_TYPE, without importing codec (and numpy) before a binary upload arrives
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
 ############
 # Database #
 ############
 
 
-def init_connection_pool() -> sqlalchemy.engine.base.Engine:
-    # use a TCP socket when INSTANCE_HOST (e.g. 127.0.0.1) is defined
-    if os.environ.get("INSTANCE_HOST"):
-        return connect_tcp_socket()
+stmt_user_by_name = sqlalchemy.text("SELECT * FROM users WHERE first_name=:first_name AND last_name=:last_name")
+stmt_user_by_id = sqlalchemy.text("SELECT * FROM users WHERE user_id=:user_id")
+# changes with the group's members and whenever one of their last_update
+# moves forward, whichever process wrote it
+stmt_group_version = dialect.DialectText(
+    "SELECT COUNT(*), SUM(UNIX_TIMESTAMP(last_update)) FROM users WHERE group_id=:group_id",
+    sqlite="SELECT COUNT(*), SUM(CAST(strftime('%s', last_update) AS INTEGER)) FROM users WHERE group_id=:group_id")
 
-    # use a Unix socket when INSTANCE_UNIX_SOCKET (e.g. /cloudsql/project:region:instance) is defined
-    if os.environ.get("INSTANCE_UNIX_SOCKET"):
-        return connect_unix_socket()
 
-    # use the connector when INSTANCE_CONNECTION_NAME (e.g. project:region:instance) is defined
-    if os.environ.get("INSTANCE_CONNECTION_NAME"):
-        return connect_with_connector()
+# create or upgrade tables in database, see migrations.py
+def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
+    migrations.migrate(db)
+
+
+# connection pools are sized as in db_pool.py
+pool_config = db_pool.PoolConfig.from_env()
+
+# Connection pools and background jobs, created by start() in the process
+# serving requests: after gunicorn forks its workers, so none is shared
+# between processes.
+db = None
+replica_db = None
+reads = None
+partition_maintenance = None
+write_buffer = None
+pipeline = None
+downsampler = None
+sessionizer = None
+fatigue_states = None
+_started = False
+_start_lock = threading.Lock()
+
+
+def start() -> None:
+    """Connect to the database and start the background jobs of this process,
+    once. Pending migrations are applied first unless MIGRATE_ON_START=0,
+    e.g. when gunicorn's master (gunicorn.conf.py) or `python migrations.py`
+    applied them already."""
+    global db, replica_db, reads, partition_maintenance, write_buffer, pipeline, downsampler, sessionizer
+    global fatigue_states
+    global _started
+    with _start_lock:
+        if _started:
+            return
+
+        # initiate a connection pool to a Cloud SQL database
+        db = init_connection_pool()
+        logs.set_sql_echo(db, float(os.environ.get("SQL_ECHO_SAMPLE", 0)))
+        metrics.instrument_engine(db)
+        migrate_on_start = os.environ.get("MIGRATE_ON_START", "1") != "0"
+        if migrate_on_start:
+            migrate_db(db)
+
+        # read-only routes use a read replica when configured and no more than
+        # REPLICA_MAX_LAG seconds behind, see replica.py
+        replica_db = init_replica_pool()
+        if replica_db is not None:
+            metrics.instrument_engine(replica_db, "db_replica_pool")
+        reads = ReadRouter(db, replica_db, max_lag=float(os.environ.get("REPLICA_MAX_LAG", 5)),
+                           interval=float(os.environ.get("REPLICA_PROBE_INTERVAL", 1)))
+        reads.start()
+        atexit.register(reads.close)
+        metrics.registry.gauge("db_replica_lag_seconds", "Seconds the read replica is behind the primary.",
+                               lambda: reads.lag)
+
+        # create upcoming daily partitions, then again every PARTITION_MAINTENANCE_INTERVAL seconds
+        if os.environ.get("PARTITION_MAINTENANCE_INTERVAL"):
+            partition_maintenance = partitions.PartitionMaintenance(
+                db, float(os.environ["PARTITION_MAINTENANCE_INTERVAL"]))
+            partition_maintenance.start()
+        elif migrate_on_start:
+            partitions.maintain(db)
+
+        # opt-in write-behind mode: uploads are queued in memory and written in bulk
+        if os.environ.get("WRITE_BEHIND"):
+            write_buffer = WriteBehindBuffer.from_env(db, on_written=rows_written)
+            write_buffer.start()
+            atexit.register(write_buffer.close)
+            metrics.registry.gauge("write_behind_queue_depth", "Samples waiting on the write-behind buffer.",
+                                   lambda: write_buffer.stats()["queue_depth"])
+
+        # compute fatigue levels from uploaded heart rates every FATIGUE_PIPELINE_INTERVAL seconds
+        if os.environ.get("FATIGUE_PIPELINE_INTERVAL"):
+            import fatigue_pipeline
+            pipeline = fatigue_pipeline.FatiguePipeline(db, float(os.environ["FATIGUE_PIPELINE_INTERVAL"]))
+            pipeline.start()
+
+        # fold uploaded heart rates into the history tiers every HEART_RATE_DOWNSAMPLE_INTERVAL seconds
+        if os.environ.get("HEART_RATE_DOWNSAMPLE_INTERVAL"):
+            downsampler = downsample.Downsampler(db, float(os.environ["HEART_RATE_DOWNSAMPLE_INTERVAL"]))
+            downsampler.start()
+
+        # pair activity events into viewing sessions every VIEW_SESSION_INTERVAL seconds
+        if os.environ.get("VIEW_SESSION_INTERVAL"):
+            sessionizer = sessions.Sessionizer(db, float(os.environ["VIEW_SESSION_INTERVAL"]))
+            sessionizer.start()
+
+        # keep each user's running fatigue in memory, updated by every heart rate upload
+        if os.environ.get("FATIGUE_STREAMING"):
+            if db_pool.workers() > 1:
+                # each worker would see, and answer with, part of a user's heart rates
+                raise RuntimeError("FATIGUE_STREAMING keeps fatigue in process memory and needs "
+                                   "a single worker, WEB_CONCURRENCY=1")
+            from fatigue_registry import FatigueRegistry
+            fatigue_states = FatigueRegistry.from_env(db)
+
+        _started = True
+
+
+def create_app() -> Flask:
+    """Application factory, e.g. `gunicorn 'app:create_app()'`: start each
+    worker before it accepts requests. Serving `app:app` instead starts it
+    on its first request."""
+    start()
+    return app
+
+
+# peer group responses polled by dashboards, invalidated when a member changes
+group_cache = GroupCache(ttl=float(os.environ.get("PEER_GROUP_CACHE_TTL", 5)))
+
+# user profiles read by login, registration and per-user lookups, see user_cache.py
+user_cache = UserCache.from_env()
+
+# drop retried uploads before they reach the database
+recent_keys = RecentKeys(max_keys=int(os.environ.get("RECENT_KEYS", 100000)))
+
+# at most UPLOAD_RATE_LIMIT upload requests per second and user, if set
+rate_limiter = None
+if os.environ.get("UPLOAD_RATE_LIMIT"):
+    rate_limiter = RateLimiter.from_env()
+
+
+def find_user(first_name: str, last_name: str):
+    """Profile of the user with this name, or None, from the cache if possible."""
+    hit, profile = user_cache.get_by_name(first_name, last_name)
+    if hit:
+        return profile
+    token = user_cache.token()
+    # on the primary: a login right after registering must find the new user
+    with db.connect() as conn:
+        row = conn.execute(stmt_user_by_name, first_name=first_name, last_name=last_name).fetchone()
+    if row is None:
+        user_cache.put_unknown(first_name, last_name, token)
+        return None
+    profile = UserCache.profile(row)
+    user_cache.put(profile, token)
+    return profile
+
+
+def user_profile(user_id: int):
+    """Profile of a user, or None, from the cache if possible."""
+    hit, profile = user_cache.get(user_id)
+    if hit:
+        return profile
+    token = user_cache.token()
+    with db.connect() as conn:
+        row = conn.execute(stmt_user_by_id, user_id=user_id).fetchone()
+    if row is None:
+        return None
+    profile = UserCache.profile(row)
+    user_cache.put(profile, token)
+    return profile
+
+
+def stream_heart_rates(rows: list) -> None:
+    """Feed heart rate rows to the in-memory fatigue registry."""
+    if fatigue_states is None:
+        return
+    try:
+        for row in rows:
+            fatigue_states.update(row['user_id'], row['heart_rate'],
+                                  calendar.timegm(time.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S')))
+    except Exception as e:
+        # the upload itself succeeded; streaming fatigue is best effort
+        logger.exception(e)
+
 
-    raise ValueError(
-        "Missing database connection type. Please define one of INSTANCE_HOST, INSTANCE_UNIX_SOCKET, or INSTANCE_CONNECTION_NAME"
+def rate_limited(rows: list):
+    """Charge one request to every user in rows. Return a 429 response if any is over the limit."""
+    if rate_limiter is None:
+        return None
+    wait = max([rate_limiter.acquire(user_id) for user_id in {row['user_id'] for row in rows}], default=0)
+    if not wait:
+        return None
+    return Response(
+        status=429,
+        response="Too many uploads, please retry later.",
+        headers={"Retry-After": str(math.ceil(wait))},
     )
 
 
-# create tables in database if not already exist
-def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
-    with db.connect() as conn:
+def unknown_users(rows: list) -> set:
+    """The user_ids of rows that belong to no user; their samples would fail the foreign key."""
+    with db_pool.checkout_timeout(pool_config.upload_pool_timeout):
+        return {user_id for user_id in {row['user_id'] for row in rows} if user_profile(user_id) is None}
+
+
+def rows_written(kind: str, rows: list, inserted: int) -> None:
+    """Remember rows once they are in the database, so retries are dropped."""
+    recent_keys.add(kind, rows)
+    metrics.ingested_rows.inc(inserted, kind)
+
+
+def write_rows(kind: str, rows: list) -> int:
+    """Save validated rows that were not written recently, on the write-behind buffer if enabled.
+    Return the number of rows inserted, or queued on the buffer."""
+    rows = recent_keys.filter(kind, rows)
+    if write_buffer is not None:
+        # the buffer calls rows_written once they are flushed
+        write_buffer.put(kind, rows)
+        inserted = len(rows)
+    else:
+        _, insert = ingest.KINDS[kind]
+        # fail fast rather than queue behind other requests when the pool is exhausted
+        with db_pool.checkout_timeout(pool_config.upload_pool_timeout), db.connect() as conn:
+            inserted = insert(conn, rows)
+        rows_written(kind, rows, inserted)
+    if kind == "heart_rate":
+        stream_heart_rates(rows)
+    return inserted
+
+
+def upload_samples(kind: str, samples: list) -> Response:
+    """Validate samples and save them, all or nothing.
+    Return acknowledgement, or push back when over the rate limit or the buffer is full."""
+    parse, _ = ingest.KINDS[kind]
+    try:
+        rows = [parse(sample) for sample in samples]
+    except ingest.InvalidSample as e:
+        return Response(status=400, response=str(e))
+    limited = rate_limited(rows)
+    if limited is not None:
+        return limited
 
-        # user table
-        conn.execute("CREATE TABLE IF NOT EXISTS users "
-                     "(user_id INTEGER AUTO_INCREMENT PRIMARY KEY, "
-                     "first_name VARCHAR(40) NOT NULL, "
-                     "last_name VARCHAR(40) NOT NULL, "
-                     "group_id VARCHAR(20) NOT NULL, "
-                     "age INTEGER NOT NULL, "
-                     "max_heart_rate INTEGER NOT NULL, "
-                     "rest_heart_rate INTEGER NOT NULL, "
-                     "hrr_cp INTEGER NOT NULL, "
-                     "awc_tot INTEGER NOT NULL, "
-                     "k_value INTEGER NOT NULL, "
-                     "fatigue_level INTEGER NOT NULL, "
-                     "last_update DATETIME, "
-                     "created DATETIME DEFAULT CURRENT_TIMESTAMP); ")
-
-        # heart_rates table
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS heart_rates "
-            "(user_id INTEGER NOT NULL, "
-            "heart_rate INTEGER NOT NULL, "
-            "timestamp DATETIME NOT NULL, "
-            "FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE); "
+    try:
+        if unknown_users(rows):
+            return Response(status=404, response="Unknown user.")
+        write_rows(kind, rows)
+        return Response(
+            response="Success",
+            status=200,
         )
 
-        # fatigue_levels table
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS fatigue_levels "
-            "(user_id INTEGER NOT NULL, "
-            "fatigue_level INTEGER NOT NULL, "
-            "timestamp DATETIME NOT NULL, "
-            "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); "
+    except QueueFull:
+        return Response(
+            status=503,
+            response="Upload queue is full, please retry later.",
+            headers={"Retry-After": "1"},
+        )
+    except sqlalchemy.exc.TimeoutError:
+        return Response(
+            status=503,
+            response="Database is busy, please retry later.",
+            headers={"Retry-After": "1"},
+        )
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            status=500,
+            response="Unable to successfully upload data! Please check the "
+            "application logs for more details.",
         )
 
-        # activities table
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS activities "
-            "(user_id INTEGER NOT NULL, "
-            "peer_id INTEGER NOT NULL, "
-            "timestamp DATETIME NOT NULL, "
-            "if_open BOOLEAN NOT NULL, "
-            "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); "
+
+def save_batch(kind: str, rows: list, errors: list) -> Response:
+    """Save the valid rows of a batch upload.
+    Return the number of samples stored (queued in write-behind mode), skipped
+    as already stored, and rejected."""
+    limited = rate_limited(rows)
+    if limited is not None:
+        return limited
+
+    try:
+        rows, errors = ingest.reject_users(rows, errors, unknown_users(rows))
+        accepted = write_rows(kind, rows)
+        context = {
+            "accepted": accepted,
+            "duplicates": len(rows) - accepted,
+            "rejected": len(errors),
+            "errors": errors,
+        }
+        return flask.jsonify(**context)
+
+    except QueueFull:
+        return Response(
+            status=503,
+            response="Upload queue is full, please retry later.",
+            headers={"Retry-After": "1"},
+        )
+    except sqlalchemy.exc.TimeoutError:
+        return Response(
+            status=503,
+            response="Database is busy, please retry later.",
+            headers={"Retry-After": "1"},
         )
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            status=500,
+            response="Unable to successfully upload data! Please check the "
+            "application logs for more details.",
+        )
+
 
+def binary_upload(kind: str) -> Response:
+    """Decode an application/octet-stream upload (see codec.py) and save its valid samples."""
+    import codec
+    try:
+        rows, errors = codec.decode(kind, request.get_data())
+    except codec.BatchTooLarge as e:
+        return Response(status=413, response=str(e))
+    except ingest.InvalidSample as e:
+        return Response(status=400, response=str(e))
+    return save_batch(kind, rows, errors)
 
-# initiate a connection pool to a Cloud SQL database
-db = init_connection_pool()
-# creates required 'votes' table in database (if it does not exist)
-migrate_db(db)
 
 ############
 # REST API #
 ############
 
 
+@app.before_request
+def start_on_first_request():
+    # without create_app(), this process connects when serving its first request
+    if not _started:
+        start()
+
+
+@app.before_request
+def start_timer():
+    flask.g.start = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def log_request(response):
+    duration = time.perf_counter() - flask.g.get("start", time.perf_counter())
+    route = request.endpoint or "not_found"
+    metrics.request_duration.observe(duration, route, request.method)
+    metrics.request_db_duration.observe(metrics.request_db_time(), route)
+    metrics.requests_total.inc(1, route, request.method, response.status_code)
+    # failed requests are always logged, the rest sampled per route
+    if response.status_code >= 500 or request_sampler.sample(request.endpoint):
+        logger.info("request", extra={
+            "route": request.endpoint,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 3),
+            "db_ms": round(metrics.request_db_time() * 1000, 3),
+            "request_bytes": request.content_length or 0,
+        })
+    return response
+
+
 # index GET
 @app.route("/", methods=["GET"])
 def hello_world():
@@ -107,35 +412,39 @@ def hello_world():
     return f"<p>Hello, {name}!</p>"
 
 
+# metrics GET, for Prometheus to scrape
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
 # user
 @app.route("/api/v1/user/login/", methods=['POST'])
 def post_user_login():
     """Receive user name and check the database.
     If exists, return with user info;
     if not exists, return new user."""
-    stmt = sqlalchemy.text("SELECT * FROM users WHERE first_name=:first_name AND last_name=:last_name")
     try:
-        with db.connect() as conn:
-            first_name = request.json['first_name']
-            last_name = request.json['last_name']
-            query = conn.execute(stmt, first_name=first_name, last_name=last_name).fetchone()
-            if not query:
-                context = {"first_name": first_name, "last_name": last_name, "created": False}
-            else:
-                context = {
-                    "first_name": first_name,
-                    "last_name": last_name,
-                    "created": True,
-                    "user_id": query['user_id'],
-                    "group_id": query['group_id'],
-                    "age": query['age'],
-                    "max_heart_rate": query['max_heart_rate'],
-                    "rest_heart_rate": query['rest_heart_rate'],
-                    "hrr_cp": query['hrr_cp'],
-                    "awc_tot": query['awc_tot'],
-                    "k_value": query['k_value'],
-                }
-            return flask.jsonify(**context)
+        first_name = request.json['first_name']
+        last_name = request.json['last_name']
+        query = find_user(first_name, last_name)
+        if not query:
+            context = {"first_name": first_name, "last_name": last_name, "created": False}
+        else:
+            context = {
+                "first_name": first_name,
+                "last_name": last_name,
+                "created": True,
+                "user_id": query['user_id'],
+                "group_id": query['group_id'],
+                "age": query['age'],
+                "max_heart_rate": query['max_heart_rate'],
+                "rest_heart_rate": query['rest_heart_rate'],
+                "hrr_cp": query['hrr_cp'],
+                "awc_tot": query['awc_tot'],
+                "k_value": query['k_value'],
+            }
+        return flask.jsonify(**context)
     except Exception as e:
         logger.exception(e)
         return Response(
@@ -164,8 +473,8 @@ def post_user_new():
         with db.connect() as conn:
             first_name = request.json['first_name']
             last_name = request.json['last_name']
-            query = conn.execute(sqlalchemy.text(
-                "SELECT * FROM users WHERE first_name=:first_name AND last_name=:last_name"), first_name=first_name, last_name=last_name).fetchone()
+            # on the primary rather than the cache, whose entries may be a minute old
+            query = conn.execute(stmt_user_by_name, first_name=first_name, last_name=last_name).fetchone()
             max_heart_rate = 200 - round(0.7 * float(request.json['age']))
             if not query:
                 # new user
@@ -202,6 +511,16 @@ def post_user_new():
                     "user_id": request.json['user_id'],
                     "max_heart_rate": max_heart_rate
                 }
+                group_cache.invalidate_group(str(query['group_id']))
+                group_cache.invalidate_user(request.json['user_id'])
+                user_cache.invalidate(query['user_id'])
+                if fatigue_states is not None:
+                    fatigue_states.invalidate(request.json['user_id'])
+            group_cache.invalidate_group(str(request.json['group_id']))
+            # write through, as stored; an update may name a user_id that does not exist
+            row = conn.execute(stmt_user_by_id, user_id=context["user_id"]).fetchone()
+            if row is not None:
+                user_cache.write(UserCache.profile(row))
             return flask.jsonify(**context)
 
     except Exception as e:
@@ -218,29 +537,80 @@ def post_user_new():
 def post_heart_rate():
     """Receive heart rate and user info and save to database.
     Return acknowledgement."""
-    print(request.json)
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return binary_upload("heart_rate")
+    return upload_samples("heart_rate", [request.json])
+
+
+@app.route("/api/v1/upload/heart_rate/batch/", methods=['POST'])
+def post_heart_rate_batch():
+    """Receive a list of heart rate samples, possibly for several users,
+    and save the valid ones to database in a single transaction.
+    Return the number of accepted and rejected samples."""
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return binary_upload("heart_rate")
+    samples = request.get_json(silent=True)
+    if not isinstance(samples, list):
+        return Response(
+            status=400,
+            response="Expected a JSON array of heart rate samples.",
+        )
+    if len(samples) > ingest.MAX_BATCH_SIZE:
+        return Response(
+            status=413,
+            response=f"At most {ingest.MAX_BATCH_SIZE} samples per batch.",
+        )
 
-    stmt = sqlalchemy.text(
-        """INSERT INTO heart_rates (user_id, heart_rate, timestamp)
-        VALUES (:user_id, :heart_rate, :timestamp)""")
-    try:
-        user_id = request.json['user_id']
-        heart_rate = request.json['heart_rate']
-        timestamp = int(request.json['timestamp'])
+    rows, errors = ingest.parse_batch(samples, ingest.parse_heart_rate)
+    return save_batch("heart_rate", rows, errors)
 
-        print(f"{timestamp} {user_id} heart rate: {heart_rate}")
 
-        with db.connect() as conn:
-            conn.execute(stmt,
-                         user_id=user_id,
-                         heart_rate=heart_rate,
-                         timestamp=datetime.utcfromtimestamp(
-                             timestamp).strftime('%Y-%m-%d %H:%M:%S'))
-            return Response(
-                response="Success",
-                status=200,
-            )
+@app.route("/api/v1/upload/stream/", methods=['POST'])
+def post_stream():
+    """Receive a chunked NDJSON stream of heart rate and activity frames for
+    one user (see stream.py) and save them to database window by window.
+    Return one acknowledgement line per written window."""
+    lines = iter(request.stream)
+    try:
+        session = stream.StreamSession(stream.hello(next(lines, b"")))
+    except ingest.InvalidSample as e:
+        return Response(status=400, response=str(e))
+
+    def write_window():
+        rows, ack = session.take()
+        if rate_limiter is not None:
+            # slow the stream down rather than drop frames
+            time.sleep(rate_limiter.acquire(session.user_id))
+        rows = {kind: recent_keys.filter(kind, kind_rows) for kind, kind_rows in rows.items()}
+        with db_pool.checkout_timeout(pool_config.upload_pool_timeout), db.connect() as conn:
+            # one insert per kind, in FRAME_KINDS order
+            inserted = dict(zip(stream.FRAME_KINDS, ingest.execute_plan(conn, stream.plan(rows))))
+        for kind, kind_rows in rows.items():
+            rows_written(kind, kind_rows, inserted[kind])
+        stream_heart_rates(rows["heart_rate"])
+        return json.dumps(ack) + "\n"
+
+    def generate():
+        try:
+            for line in lines:
+                if not line.strip():
+                    continue
+                session.feed(line)
+                if session.due():
+                    # acknowledged as soon as written, while the body is still coming
+                    yield write_window()
+            if session.timeout() is not None:
+                yield write_window()
+        except Exception as e:
+            logger.exception(e)
+            # the status is sent already; windows acknowledged so far are
+            # stored and the client resends the rest
+            yield json.dumps({"error": "Unable to successfully upload data! Please check the "
+                              "application logs for more details."}) + "\n"
 
+    try:
+        if user_profile(session.user_id) is None:
+            return Response(status=404, response="Unknown user.")
     except Exception as e:
         logger.exception(e)
         return Response(
@@ -248,91 +618,186 @@ def post_heart_rate():
             response="Unable to successfully upload data! Please check the "
             "application logs for more details.",
         )
+    return Response(flask.stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 @app.route("/api/v1/upload/fatigue_level/", methods=['POST'])
 def post_fatigue_level():
     """Receive fatigue level and user info and save to database.
     Return acknowledgement."""
-    print(request.json)
+    return upload_samples("fatigue_level", [request.json])
 
-    stmt_fatigue = sqlalchemy.text(
-        """INSERT INTO fatigue_levels (user_id, fatigue_level, timestamp)
-        VALUES (:user_id, :fatigue_level, :timestamp)""")
-    stmt_user = sqlalchemy.text(
-        "UPDATE users SET fatigue_level=:fatigue_level, last_update=:last_update WHERE user_id=:user_id"
-    )
-    try:
-        user_id = request.json['user_id']
-        fatigue_level = request.json['fatigue_level']
-        timestamp = int(request.json['timestamp'])
-        dtime = datetime.utcfromtimestamp(timestamp).strftime(
-            '%Y-%m-%d %H:%M:%S')
 
-        print(f"{timestamp} {user_id} fatigue level: {fatigue_level}")
+@app.route("/api/v1/upload/activity/", methods=['POST'])
+def post_activity():
+    """Receive activity logging and save to database.
+    Return acknowledgement."""
+    if request.mimetype == BINARY_CONTENT_TYPE:
+        return binary_upload("activity")
+    return upload_samples("activity", [request.json])
+
+
+# fatigue
+@app.route("/api/v1/fatigue/<int:user_id>/", methods=['GET'])
+def get_fatigue(user_id):
+    """Receive user_id and return the current fatigue level.
+    Served from memory when streaming fatigue is enabled."""
+    try:
+        if fatigue_states is not None:
+            state = fatigue_states.get(user_id)
+            if state is None:
+                return Response(status=404, response="Unknown user.")
+            last_update = (state.minute + 1) * 60 if state.minute is not None else 0
+            context = {
+                "user_id": user_id,
+                "fatigue_level": state.fatigue_level,
+                "last_update": last_update,
+            }
+            return flask.jsonify(**context)
 
+        stmt = sqlalchemy.text(
+            "SELECT fatigue_level, last_update FROM users WHERE user_id=:user_id")
         with db.connect() as conn:
-            conn.execute(stmt_fatigue,
-                         user_id=user_id,
-                         fatigue_level=fatigue_level,
-                         timestamp=dtime)
-            conn.execute(stmt_user,
-                         user_id=user_id,
-                         fatigue_level=fatigue_level,
-                         last_update=dtime)
-
-            return Response(
-                response="Success",
-                status=200,
-            )
+            row = conn.execute(stmt, user_id=user_id).fetchone()
+        if row is None:
+            return Response(status=404, response="Unknown user.")
+        last_update = 0
+        if row[1] is not None:
+            last_update = int(round(row[1].replace(tzinfo=timezone.utc).timestamp()))
+        context = {
+            "user_id": user_id,
+            "fatigue_level": row[0],
+            "last_update": last_update,
+        }
+        return flask.jsonify(**context)
 
     except Exception as e:
         logger.exception(e)
         return Response(
             status=500,
-            response="Unable to successfully upload data! Please check the "
+            response="Unable to successfully get fatigue level! Please check the "
             "application logs for more details.",
         )
 
 
-@app.route("/api/v1/upload/activity/", methods=['POST'])
-def post_activity():
-    """Receive activity logging and save to database.
-    Return acknowledgement."""
-    print(request.json)
-
-    stmt = sqlalchemy.text(
-        """INSERT INTO activities (user_id, peer_id, timestamp, if_open)
-        VALUES (:user_id, :peer_id, :timestamp, :if_open)""")
+# heart rate history
+@app.route("/api/v1/heart_rate/<int:user_id>/", methods=['GET'])
+def get_heart_rate(user_id):
+    """Receive user_id and a time range in unix seconds, and return min, max,
+    mean and count of heart rates per bucket. The resolution in seconds is
+    either requested or the finest one fitting in max_points buckets; a range
+    with more than max_points buckets is refused."""
     try:
-        user_id = request.json['user_id']
-        peer_id = request.json['peer_id']
-        timestamp = int(request.json['timestamp'])
-        if_open = bool(request.json['if_open'])
-
-        print(f"{timestamp} {user_id} on {peer_id}. if_open = {if_open}")
+        end = int(request.args.get('end', time.time()))
+        start = int(request.args.get('start', end - 24 * 3600))
+        max_points = int(request.args.get('max_points', 1000))
+        resolution = request.args.get('resolution')
+        if resolution is None:
+            resolution = downsample.pick_resolution(start, end, max_points)
+        else:
+            resolution = int(resolution)
+    except ValueError:
+        return Response(status=400, response="start, end, resolution and max_points must be integers.")
+    if resolution not in downsample.RESOLUTIONS:
+        return Response(
+            status=400,
+            response=f"resolution must be one of {', '.join(map(str, downsample.RESOLUTIONS))}.",
+        )
+    if not 0 <= start < end <= ingest.MAX_TIMESTAMP or not 0 < max_points <= downsample.MAX_POINTS:
+        return Response(
+            status=400,
+            response=f"Expected 0 <= start < end and 0 < max_points <= {downsample.MAX_POINTS}.",
+        )
+    if (end - start) / resolution > max_points:
+        return Response(
+            status=400,
+            response=f"More than max_points buckets of {resolution} s, use a coarser resolution "
+            f"or a shorter range; at most {max_points * downsample.RESOLUTIONS[-1]} s "
+            f"at the coarsest resolution, {downsample.RESOLUTIONS[-1]} s.",
+        )
 
-        with db.connect() as conn:
-            conn.execute(stmt,
-                         user_id=user_id,
-                         peer_id=peer_id,
-                         timestamp=datetime.utcfromtimestamp(
-                             timestamp).strftime('%Y-%m-%d %H:%M:%S'),
-                         if_open=if_open)
-            return Response(
-                response="Success",
-                status=200,
-            )
+    try:
+        with reads.connect() as conn:
+            buckets = downsample.history(conn, user_id, start, end, resolution)
+        context = {
+            "user_id": user_id,
+            "resolution": resolution,
+            "buckets": [{
+                "timestamp": timestamp,
+                "count": count,
+                "min": hr_min,
+                "max": hr_max,
+                "mean": mean,
+            } for timestamp, count, hr_min, hr_max, mean in buckets],
+        }
+        return flask.jsonify(**context)
 
     except Exception as e:
         logger.exception(e)
         return Response(
             status=500,
-            response="Unable to successfully upload data! Please check the "
+            response="Unable to successfully get heart rates! Please check the "
             "application logs for more details.",
         )
 
 
+# export
+@app.route("/api/v1/export/<kind>/", methods=['GET'])
+def get_export(kind):
+    """Stream the samples of one kind for a user, a group or everyone, in a
+    time range in unix seconds, as CSV or Parquet, optionally gzipped."""
+    if kind not in export.KINDS:
+        return Response(status=404, response=f"kind must be one of {', '.join(export.KINDS)}.")
+    try:
+        start = datetime.utcfromtimestamp(int(request.args['start'])) if 'start' in request.args else export.START
+        end = datetime.utcfromtimestamp(int(request.args['end'])) if 'end' in request.args else export.END
+        user_id = int(request.args['user_id']) if 'user_id' in request.args else None
+    except ValueError:
+        return Response(status=400, response="start, end and user_id must be integers.")
+    group_id = request.args.get('group_id')
+    fmt = request.args.get('format', 'csv')
+    gzip = request.args.get('gzip') in ('1', 'true')
+    try:
+        export.check_format(fmt)
+    except ValueError as e:
+        return Response(status=400, response=str(e))
+
+    def generate():
+        try:
+            with reads.connect() as conn:
+                yield from export.encode(kind, fmt, export.chunks(conn, kind, start, end, group_id, user_id), gzip)
+        except Exception as e:
+            # the status is sent already; the client gets a truncated file
+            logger.exception(e)
+
+    filename = f"{kind}.{fmt}{'.gz' if gzip else ''}"
+    mimetype = "application/gzip" if gzip else ("text/csv" if fmt == "csv" else "application/vnd.apache.parquet")
+    return Response(flask.stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+# status
+@app.route("/api/v1/status/write_behind/", methods=['GET'])
+def get_write_behind_status():
+    """Return queue depth and flush counters of the write-behind buffer."""
+    if write_buffer is None:
+        return flask.jsonify(enabled=False)
+    return flask.jsonify(enabled=True, **write_buffer.stats())
+
+
+@app.route("/api/v1/status/sql_echo/", methods=['GET', 'PUT'])
+def sql_echo():
+    """Return, or set with {"sample_rate": 0.01}, the fraction of SQL statements logged."""
+    if request.method == 'PUT':
+        sample_rate = (request.get_json(silent=True) or {}).get('sample_rate')
+        if not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1:
+            return Response(status=400, response="sample_rate must be a number from 0 to 1.")
+        for engine in (db, replica_db):
+            if engine is not None:
+                logs.set_sql_echo(engine, sample_rate)
+    return flask.jsonify(sample_rate=logs.sql_echo(db))
+
+
 # peer
 @app.route("/api/v1/peer/group/<group_id>/", methods=['GET'])
 def get_peer_group(group_id):
@@ -346,7 +811,15 @@ def get_peer_group(group_id):
     )
 
     try:
-        with db.connect() as conn:
+        token = group_cache.token(group_id)
+        with reads.connect() as conn:
+            version = tuple(conn.execute(stmt_group_version, group_id=group_id).fetchone())
+            cached = group_cache.get(group_id, version)
+            if cached is not None:
+                etag, body = cached
+                response = Response(body, mimetype="application/json")
+                response.set_etag(etag)
+                return response.make_conditional(request)
             query = conn.execute(stmt, group_id=group_id).fetchall()
 
         for row in query:
@@ -363,7 +836,11 @@ def get_peer_group(group_id):
             })
 
         context = {"peers": peers}
-        return flask.jsonify(**context)
+        response = flask.jsonify(**context)
+        etag = group_cache.put(group_id, response.get_data(),
+                               [peer["user_id"] for peer in peers], token, version)
+        response.set_etag(etag)
+        return response.make_conditional(request)
 
     except Exception as e:
         logger.exception(e)
@@ -379,57 +856,96 @@ def get_peer(user_id):
     """Receive user_id and query database.
     Return ranges and average of fatigue_level today by hour."""
 
-    print("------------")
+    # [count, sum, min, max] per local hour of today
+    hours = [[0, 0, None, None] for _ in range(24)]
 
-    # abstract = [[-1, -1]] * 24
-    fatigue_levels = [[] for _ in range(24)]
+    try:
+        start, end = local_today()
+        with reads.connect() as conn:
+            query = rollup.hourly(conn, user_id, start, end)
 
-    stmt = sqlalchemy.text(
-        "SELECT fatigue_level, timestamp FROM fatigue_levels WHERE user_id=:user_id AND timestamp >= now() - INTERVAL 24 HOUR;"
-    )
+        # rollup rows are UTC hours; a local hour can span two of them on DST changes
+        for row in query:
+            bucket = hours[utc_to_local(row[0]).hour]
+            bucket[0] += row[1]
+            bucket[1] += row[2]
+            bucket[2] = row[3] if bucket[2] is None else min(bucket[2], row[3])
+            bucket[3] = row[4] if bucket[3] is None else max(bucket[3], row[4])
+
+        data = [{
+            "hour_from_midnight": ind,
+            "fatigue_level_range": [ele[2], ele[3]] if ele[0] else [-1, -1],
+            "avg_fatigue_level": ele[1] / ele[0] if ele[0] else -1.0,
+        } for ind, ele in enumerate(hours)]
 
-    try:
-        with db.connect() as conn:
-            query = conn.execute(stmt, user_id=user_id).fetchall()
+        context = {"observations": data}
+        return flask.jsonify(**context)
 
-        print(query)
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            status=500,
+            response="Unable to successfully upload data! Please check the "
+            "application logs for more details.",
+        )
 
-        def utc_to_local(utc_dt):
-            return utc_dt.replace(tzinfo=timezone.utc).astimezone(tz=tz.gettz('America/Detroit'))
 
-        def updateAbstract(hour, fatigue_level):
-            fatigue_levels[hour].append(fatigue_level)
-            print(hour, fatigue_level)
-            print(fatigue_levels)
+def utc_to_local(utc_dt: datetime) -> datetime:
+    """A naive UTC datetime in the app's time zone."""
+    from dateutil import tz
+    return utc_dt.replace(tzinfo=timezone.utc).astimezone(tz=tz.gettz('America/Detroit'))
 
-        now = utc_to_local(datetime.utcnow())
-        print("now: ", now)
 
-        for x in query:
-            fatigue_level = x[0]
-            timestamp = utc_to_local(x[1])
-            print(timestamp)
-            if timestamp.date() == now.date():
-                updateAbstract(timestamp.hour, fatigue_level)
+def local_today(now: datetime = None):
+    """Naive UTC bounds of the day of `now` (UTC, the current time by default)
+    in the app's time zone; 23 or 25 hours apart on DST changes."""
+    local = utc_to_local(now or datetime.utcnow())
+    today = local.date()
 
-        fatigue_levels = [ lst if lst else [-1] for lst in fatigue_levels ]
-        data = [{"hour_from_midnight": ind, "fatigue_level_range": [min(ele), max(ele)], "avg_fatigue_level": sum(ele)/len(ele) } for ind, ele in enumerate(fatigue_levels)]
+    def midnight(day):
+        return datetime.combine(day, datetime.min.time(), tzinfo=local.tzinfo).astimezone(
+            timezone.utc).replace(tzinfo=None)
 
-        context = {"observations": data}
-        print(context)
+    return midnight(today), midnight(today + timedelta(days=1))
 
-        print("------------")
 
-        return flask.jsonify(**context)
+@app.route("/api/v1/peer/<int:user_id>/viewers/", methods=['GET'])
+def get_peer_viewers(user_id):
+    """Receive user_id and query the viewing sessions.
+    Return who viewed the user today, in how many sessions and for how many seconds."""
+    try:
+        start, end = local_today()
+        with reads.connect() as conn:
+            data = sessions.viewers(conn, user_id, start, end)
+        return flask.jsonify(viewers=data)
 
     except Exception as e:
         logger.exception(e)
         return Response(
             status=500,
-            response="Unable to successfully upload data! Please check the "
+            response="Unable to successfully get viewers! Please check the "
+            "application logs for more details.",
+        )
+
+
+@app.route("/api/v1/peer/<int:user_id>/viewed/", methods=['GET'])
+def get_peer_viewed(user_id):
+    """Receive user_id and query the viewing sessions.
+    Return whom the user viewed today, in how many sessions and for how many seconds."""
+    try:
+        start, end = local_today()
+        with reads.connect() as conn:
+            data = sessions.viewed(conn, user_id, start, end)
+        return flask.jsonify(viewed=data)
+
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            status=500,
+            response="Unable to successfully get viewed peers! Please check the "
             "application logs for more details.",
         )
 
 
 if __name__ == "__main__":
-    app.run(debug=False, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    create_app().run(debug=False, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,306 @@
+from flask.testing import FlaskClient
+
+import pytest
+
+import app
+from idempotency import RecentKeys
+import ingest
+import metrics
+from user_cache import UserCache
+
+T0 = 1664625600  # 2022-10-01 12:00:00 UTC
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch) -> FlaskClient:
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "dpm.db"))
+    monkeypatch.setattr(app, "_started", False)
+    # start() registers the pool gauges, once per process
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    monkeypatch.setattr(app, "recent_keys", RecentKeys())
+    monkeypatch.setattr(app, "user_cache", UserCache())
+    app.start()
+    app.app.testing = True
+    client = app.app.test_client()
+    response = client.post("/api/v1/user/new/", json={
+        "first_name": "app", "last_name": "test", "group_id": "a", "age": 30,
+        "rest_heart_rate": 60, "hrr_cp": 40, "awc_tot": 100, "k_value": 1})
+    assert response.json["user_id"] == 1
+    return client
+
+
+def heart_rates():
+    with app.db.connect() as conn:
+        return conn.execute("SELECT user_id, heart_rate, timestamp FROM heart_rates ORDER BY timestamp").fetchall()
+
+
+def test_batch(client: FlaskClient) -> None:
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 80 + i, "timestamp": T0 + i} for i in range(3)])
+    assert response.status_code == 200
+    assert response.json == {"accepted": 3, "duplicates": 0, "rejected": 0, "errors": []}
+    assert [row[1] for row in heart_rates()] == [80, 81, 82]
+
+
+def test_batch_reports_rows_inserted(client: FlaskClient, monkeypatch) -> None:
+    batch = [{"user_id": 1, "heart_rate": 80, "timestamp": T0 + i} for i in range(3)]
+    client.post("/api/v1/upload/heart_rate/batch/", json=batch)
+    # a retry after a restart, when the recent keys are gone: skipped by the database
+    monkeypatch.setattr(app, "recent_keys", RecentKeys())
+    batch.append({"user_id": 1, "heart_rate": 80, "timestamp": T0 + 3})
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=batch)
+    assert response.json == {"accepted": 1, "duplicates": 3, "rejected": 0, "errors": []}
+    # and again, dropped by the recent keys
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=batch)
+    assert response.json == {"accepted": 0, "duplicates": 4, "rejected": 0, "errors": []}
+    assert len(heart_rates()) == 4
+
+
+def test_mixed_batch(client: FlaskClient) -> None:
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 80, "timestamp": T0},
+        {"user_id": 1, "heart_rate": 900, "timestamp": T0 + 1},
+        {"user_id": 1, "timestamp": T0 + 2},
+        "not a sample",
+        {"user_id": 1, "heart_rate": 82, "timestamp": T0 + 4},
+    ])
+    assert response.status_code == 200
+    assert response.json == {"accepted": 2, "duplicates": 0, "rejected": 3, "errors": [
+        {"index": 1, "error": "heart_rate out of range"},
+        {"index": 2, "error": "missing heart_rate"},
+        {"index": 3, "error": "sample must be an object"},
+    ]}
+    assert [row[1] for row in heart_rates()] == [80, 82]
+
+
+def test_batch_too_large(client: FlaskClient) -> None:
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 80, "timestamp": T0 + i} for i in range(ingest.MAX_BATCH_SIZE + 1)])
+    assert response.status_code == 413
+    assert heart_rates() == []
+
+
+def test_timestamps_out_of_range(client: FlaskClient) -> None:
+    timestamps = [0, -1, 10**12, 1e20, 2**31]
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 80, "timestamp": timestamp} for timestamp in timestamps])
+    assert response.status_code == 200
+    assert response.json["rejected"] == len(timestamps)
+    assert {error["error"] for error in response.json["errors"]} == {"invalid timestamp"}
+
+    for timestamp in timestamps:
+        response = client.post("/api/v1/upload/heart_rate/", json={
+            "user_id": 1, "heart_rate": 80, "timestamp": timestamp})
+        assert response.status_code == 400
+        assert response.text == "invalid timestamp"
+    # the largest timestamp accepted
+    response = client.post("/api/v1/upload/heart_rate/", json={
+        "user_id": 1, "heart_rate": 80, "timestamp": ingest.MAX_TIMESTAMP})
+    assert response.status_code == 200
+    assert heart_rates()[0][2].year == 2038
+
+
+def test_streaming_fatigue_needs_one_worker(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "dpm.db"))
+    monkeypatch.setenv("FATIGUE_STREAMING", "1")
+    monkeypatch.setenv("WEB_CONCURRENCY", "2")
+    monkeypatch.setattr(app, "_started", False)
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    with pytest.raises(RuntimeError):
+        app.start()
+    assert not app._started
+
+
+def test_peer_group_etag(client: FlaskClient, monkeypatch) -> None:
+    from group_cache import GroupCache
+    monkeypatch.setattr(app, "group_cache", GroupCache())
+    response = client.get("/api/v1/peer/group/a/")
+    assert response.status_code == 200
+    assert [peer["user_id"] for peer in response.json["peers"]] == [1]
+    etag = response.headers["ETag"]
+
+    response = client.get("/api/v1/peer/group/a/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert app.group_cache.hits == 1
+
+    # a fatigue level upload changes the group's response
+    assert client.post("/api/v1/upload/fatigue_level/", json={
+        "user_id": 1, "fatigue_level": 40, "timestamp": T0}).status_code == 200
+    response = client.get("/api/v1/peer/group/a/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["peers"][0]["fatigue_level"] == 40
+
+    # so does one written by another process, e.g. the pipeline or the async server
+    with app.db.connect() as conn:
+        ingest.execute_plan(conn, ingest.plan_fatigue_levels([
+            {"user_id": 1, "fatigue_level": 55, "timestamp": ingest.to_datetime(T0 + 60)}]))
+    response = client.get("/api/v1/peer/group/a/", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.json["peers"][0]["fatigue_level"] == 55
+
+
+def test_heart_rate_history_is_bounded(client: FlaskClient) -> None:
+    client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 80, "timestamp": T0 + i} for i in range(3)])
+    url = "/api/v1/heart_rate/1/"
+    response = client.get(url, query_string={"start": T0, "end": T0 + 3, "resolution": 1})
+    assert response.status_code == 200
+    assert len(response.json["buckets"]) == 3
+
+    day = {"start": T0, "end": T0 + 24 * 3600}
+    assert client.get(url, query_string=day).json["resolution"] == 900
+    # 86400 buckets of a second
+    assert client.get(url, query_string={**day, "resolution": 1}).status_code == 400
+    assert client.get(url, query_string={**day, "resolution": 1, "max_points": 10**6}).status_code == 400
+    # a year is served in daily buckets
+    year = client.get(url, query_string={"start": T0 - 365 * 24 * 3600, "end": T0})
+    assert year.status_code == 200 and year.json["resolution"] == 86400
+    # more than max_points buckets even at the coarsest resolution
+    response = client.get(url, query_string={"start": 0, "end": T0})
+    assert response.status_code == 400
+    assert "at most 86400000 s at the coarsest resolution" in response.get_data(as_text=True)
+    assert client.get(url, query_string={"start": T0, "end": 10**12}).status_code == 400
+
+
+def test_binary_batch_too_large(client: FlaskClient) -> None:
+    import codec
+    header = codec.HEADER.pack(codec.VERSION, codec.HEART_RATE, 0, 0, 1, T0, ingest.MAX_BATCH_SIZE + 1)
+    response = client.post("/api/v1/upload/heart_rate/batch/", data=header, content_type=codec.CONTENT_TYPE)
+    assert response.status_code == 413
+    payload = codec.encode_heart_rates(1, [T0, T0 + 1], [80, 81])
+    response = client.post("/api/v1/upload/heart_rate/batch/", data=payload, content_type=codec.CONTENT_TYPE)
+    assert response.json["accepted"] == 2
+
+
+def test_login_reads_the_primary(client: FlaskClient, tmp_path, monkeypatch) -> None:
+    from connect_sqlite import connect_sqlite
+    import migrations
+    from replica import ReadRouter
+    # a fresh replica that has not received the registration yet
+    replica_db = connect_sqlite(str(tmp_path / "replica.db"))
+    migrations.migrate(replica_db)
+    reads = ReadRouter(app.db, replica_db)
+    reads.lag = 0.0
+    monkeypatch.setattr(app, "reads", reads)
+    monkeypatch.setattr(app, "user_cache", UserCache())
+    response = client.post("/api/v1/user/login/", json={"first_name": "app", "last_name": "test"})
+    assert response.json["created"] is True
+    assert response.json["user_id"] == 1
+
+
+def test_unknown_user(client: FlaskClient) -> None:
+    response = client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 2, "heart_rate": 80, "timestamp": T0},
+        {"user_id": 1, "heart_rate": 900, "timestamp": T0},
+        {"user_id": 1, "heart_rate": 81, "timestamp": T0 + 1},
+        {"user_id": 2, "heart_rate": 82, "timestamp": T0 + 2},
+    ])
+    assert response.json == {"accepted": 1, "duplicates": 0, "rejected": 3, "errors": [
+        {"index": 0, "error": "unknown user"},
+        {"index": 1, "error": "heart_rate out of range"},
+        {"index": 3, "error": "unknown user"},
+    ]}
+    response = client.post("/api/v1/upload/fatigue_level/", json={"user_id": 2, "fatigue_level": 40, "timestamp": T0})
+    assert response.status_code == 404
+    assert [row[0] for row in heart_rates()] == [1]
+
+
+def test_registration_checks_the_primary(client: FlaskClient) -> None:
+    user = {"first_name": "app", "last_name": "test", "group_id": "b", "age": 40,
+            "rest_heart_rate": 60, "hrr_cp": 40, "awc_tot": 100, "k_value": 1}
+    # the cache still holds the profile of a user renamed by another worker
+    with app.db.connect() as conn:
+        conn.execute("UPDATE users SET first_name = 'renamed' WHERE user_id = 1")
+    response = client.post("/api/v1/user/new/", json=user)
+    assert response.json["user_id"] == 2
+
+    # an update of a user_id that does not exist
+    response = client.post("/api/v1/user/new/", json={**user, "user_id": 99})
+    assert response.status_code == 200
+    with app.db.connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users").scalar() == 2
+
+
+def test_stream_acknowledges_each_window(client: FlaskClient) -> None:
+    import io
+    import json
+    frames = [{"user_id": 1}] + [{"heart_rate": 80, "timestamp": T0 + i} for i in range(1000)]
+    body = io.BytesIO(b"".join(json.dumps(frame).encode() + b"\n" for frame in frames))
+    response = client.post("/api/v1/upload/stream/", input_stream=body, buffered=False,
+                           environ_overrides={"wsgi.input_terminated": True})
+    assert response.status_code == 200
+    acks = response.iter_encoded()
+    # the first window is acknowledged before the rest of the body is read
+    assert json.loads(next(acks)) == {"ack": 100, "accepted": 100, "rejected": []}
+    assert body.tell() < len(body.getvalue())
+    rest = [json.loads(line) for line in b"".join(acks).splitlines()]
+    # the last frame closes a full window, so no empty one follows
+    assert [ack["ack"] for ack in rest] == list(range(200, 1001, 100))
+    assert len(heart_rates()) == 1000
+
+
+def test_profile_update_reaches_streaming_fatigue(client: FlaskClient, monkeypatch) -> None:
+    monkeypatch.setenv("FATIGUE_STREAMING", "1")
+    monkeypatch.setenv("WEB_CONCURRENCY", "1")
+    monkeypatch.setattr(app, "_started", False)
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    app.start()
+    client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 150, "timestamp": T0 + i} for i in range(60)])
+    state = app.fatigue_states.get(1)
+    assert state.Rest_HR == 60
+
+    response = client.post("/api/v1/user/new/", json={
+        "user_id": 1, "first_name": "app", "last_name": "test", "group_id": "a", "age": 30,
+        "rest_heart_rate": 50, "hrr_cp": 30, "awc_tot": 100, "k_value": 1})
+    assert response.status_code == 200
+    client.post("/api/v1/upload/heart_rate/batch/", json=[
+        {"user_id": 1, "heart_rate": 150, "timestamp": T0 + 60 + i} for i in range(60)])
+    # same running state, new parameters
+    assert app.fatigue_states.get(1) is state
+    assert (state.Rest_HR, state.HRR_CP, state.minute) == (50, 30, T0 // 60)
+    assert state.W_exp > 0
+
+
+def test_peer_hourly_fatigue(client: FlaskClient, monkeypatch) -> None:
+    from datetime import datetime
+    local_today = app.local_today
+
+    def upload(timestamp, level):
+        return client.post("/api/v1/upload/fatigue_level/", json={
+            "user_id": 1, "fatigue_level": level, "timestamp": timestamp})
+
+    # T0 is 08:00 in Detroit
+    monkeypatch.setattr(app, "local_today", lambda: local_today(datetime(2022, 10, 1, 12)))
+    for timestamp, level in [(T0 + 600, 10), (T0 + 1200, 30), (T0 + 3660, 50)]:
+        upload(timestamp, level)
+    observations = client.get("/api/v1/peer/1/").json["observations"]
+    assert observations[8] == {"hour_from_midnight": 8, "fatigue_level_range": [10, 30], "avg_fatigue_level": 20.0}
+    assert observations[9] == {"hour_from_midnight": 9, "fatigue_level_range": [50, 50], "avg_fatigue_level": 50.0}
+    assert observations[7] == {"hour_from_midnight": 7, "fatigue_level_range": [-1, -1], "avg_fatigue_level": -1.0}
+
+    # a retry changes nothing, a new sample of the hour recomputes it
+    upload(T0 + 600, 10)
+    upload(T0 + 1800, 80)
+    observations = client.get("/api/v1/peer/1/").json["observations"]
+    assert observations[8] == {"hour_from_midnight": 8, "fatigue_level_range": [10, 80], "avg_fatigue_level": 40.0}
+
+    # the day clocks go back has 25 hours, and two UTC hours fall in local hour 1
+    start, end = local_today(datetime(2022, 11, 6, 12))
+    assert (start, end) == (datetime(2022, 11, 6, 4), datetime(2022, 11, 7, 5))
+    monkeypatch.setattr(app, "local_today", lambda: (start, end))
+    dst = 1667712600  # 2022-11-06 05:30 UTC, 01:30 EDT
+    upload(dst, 20)
+    upload(dst + 3600, 40)  # 01:30 EST
+    observations = client.get("/api/v1/peer/1/").json["observations"]
+    assert observations[1] == {"hour_from_midnight": 1, "fatigue_level_range": [20, 40], "avg_fatigue_level": 30.0}
+    assert observations[2]["avg_fatigue_level"] == -1.0
+
+
+def test_sql_echo_toggle(client: FlaskClient) -> None:
+    import logs
+    assert client.get("/api/v1/status/sql_echo/").json == {"sample_rate": 0.0}
+    assert client.put("/api/v1/status/sql_echo/", json={"sample_rate": 2}).status_code == 400
+    assert client.put("/api/v1/status/sql_echo/", json={"sample_rate": 0.5}).json == {"sample_rate": 0.5}
+    client.put("/api/v1/status/sql_echo/", json={"sample_rate": 0})
+    assert logs.sql_echo(app.db) == 0.0
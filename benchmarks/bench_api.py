@@ -0,0 +1,266 @@
+"""Load-test the REST API: throughput and latency per route under concurrency.
+
+    python benchmarks/bench_api.py --users 200 --groups 10 --concurrency 16 --duration 30
+    python benchmarks/bench_api.py --url http://localhost:8080 --output results.json
+
+Creates a synthetic cohort (--users users spread over --groups groups), then
+--concurrency workers upload heart rate batches and fatigue levels, random
+walks, and read the peer endpoints for --duration seconds.
+Without --url the app runs in process on a fresh SQLite database (or on
+SQLITE_PATH / the MySQL settings in the environment, as app.py reads them);
+with --url requests go over HTTP to a running server, e.g. gunicorn in front
+of a local MySQL.
+
+Results are written as JSON (--output) with the commit they were measured
+on; --baseline prints the change against an earlier result.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_MIX = "heart_rate_batch=4,fatigue_level=2,peer_group=3,peer=1"
+
+
+def random_walk(rng, start, scale, low, high):
+    """Endless bounded random walk, reflected at the bounds."""
+    y = start
+    while True:
+        yield y
+        d = rng.normal(scale=scale)
+        if y + d < low or y + d > high:
+            y -= d
+        else:
+            y += d
+
+
+class LocalClient:
+    """The app in this process, through Flask's test client."""
+
+    def __init__(self):
+        import app
+        self.client = app.app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """A running server, over one keep-alive connection."""
+
+    def __init__(self, url):
+        url = urllib.parse.urlsplit(url)
+        self.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self.connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                headers=headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        try:
+            return response.status, json.loads(content)
+        except ValueError:
+            return response.status, None
+
+
+class Cohort:
+    """Synthetic users, their groups and the state of their random walks."""
+
+    def __init__(self, users, groups, seed):
+        self.users = []
+        self.groups = [f"bench-{group}" for group in range(groups)]
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._clock = {}
+        self._heart_rate = {}
+        self._fatigue = {}
+        self.profiles = [{
+            "first_name": "bench",
+            "last_name": f"user-{user}",
+            "group_id": self.groups[user % groups],
+            "age": int(self._rng.integers(20, 60)),
+            "rest_heart_rate": int(self._rng.integers(50, 75)),
+            "hrr_cp": 0.4,
+            "awc_tot": 20000,
+            "k_value": 5,
+        } for user in range(users)]
+
+    def register(self, client):
+        start = int(time.time()) - 86400
+        for profile in self.profiles:
+            status, body = client.request("POST", "/api/v1/user/new/", profile)
+            if status != 200:
+                sys.exit(f"creating {profile['last_name']} failed with {status}")
+            user_id = body["user_id"]
+            self.users.append(user_id)
+            self._clock[user_id] = start
+            self._heart_rate[user_id] = random_walk(self._rng, 70, 3, 45, 190)
+            self._fatigue[user_id] = random_walk(self._rng, 0, 10, 0, 150)
+
+    def heart_rates(self, user_id, count):
+        """The next `count` seconds of a user's heart rate."""
+        with self._lock:
+            start = self._clock[user_id]
+            self._clock[user_id] += count
+            walk = self._heart_rate[user_id]
+            return [{"user_id": user_id, "heart_rate": int(next(walk)), "timestamp": start + i}
+                    for i in range(count)]
+
+    def fatigue_level(self, user_id):
+        with self._lock:
+            self._clock[user_id] += 1
+            return {"user_id": user_id, "fatigue_level": int(next(self._fatigue[user_id])),
+                    "timestamp": self._clock[user_id]}
+
+
+def operations(cohort, batch):
+    """Route name -> function making its request (method, path, body)."""
+    return {
+        "heart_rate_batch": lambda rand: (
+            "POST", "/api/v1/upload/heart_rate/batch/", cohort.heart_rates(rand.choice(cohort.users), batch)),
+        "fatigue_level": lambda rand: (
+            "POST", "/api/v1/upload/fatigue_level/", cohort.fatigue_level(rand.choice(cohort.users))),
+        "peer_group": lambda rand: ("GET", f"/api/v1/peer/group/{rand.choice(cohort.groups)}/", None),
+        "peer": lambda rand: ("GET", f"/api/v1/peer/{rand.choice(cohort.users)}/", None),
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def worker(make_client, ops, weights, deadline, seed):
+    client = make_client()
+    rand = random.Random(seed)
+    names = list(weights)
+    samples = []
+    while time.monotonic() < deadline:
+        name = rand.choices(names, [weights[n] for n in names])[0]
+        method, path, body = ops[name](rand)
+        start = time.perf_counter()
+        try:
+            status, _ = client.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            status = 0
+        samples.append((name, time.perf_counter() - start, status))
+    return samples
+
+
+def summarize(samples, seconds):
+    routes = {}
+    for name in sorted({name for name, _, _ in samples} | {"all"}):
+        latencies = np.array([latency for n, latency, _ in samples if name in (n, "all")])
+        errors = sum(1 for n, _, status in samples if name in (n, "all") and not 200 <= status < 300)
+        if not len(latencies):
+            continue
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+        routes[name] = {
+            "requests": int(len(latencies)),
+            "errors": errors,
+            "throughput": len(latencies) / seconds,
+            "p50_ms": p50,
+            "p95_ms": p95,
+            "p99_ms": p99,
+        }
+    return routes
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="base URL of a running server; in process when omitted")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=60, help="heart rate samples per batch upload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route=weight,... of the requests sent")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="earlier JSON results to compare with")
+    args = parser.parse_args()
+
+    if args.url:
+        target = args.url
+        make_client = lambda: HttpClient(args.url)  # noqa: E731
+    else:
+        if not any(os.environ.get(name) for name in ("SQLITE_PATH", "INSTANCE_HOST", "INSTANCE_UNIX_SOCKET",
+                                                     "INSTANCE_CONNECTION_NAME")):
+            os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-api-"), "dpm.db")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        target = f"sqlite:{os.environ['SQLITE_PATH']}" if os.environ.get("SQLITE_PATH") else "mysql"
+        make_client = LocalClient
+
+    cohort = Cohort(args.users, args.groups, args.seed)
+    cohort.register(make_client())
+    ops = operations(cohort, args.batch)
+    weights = parse_mix(args.mix)
+    unknown = set(weights) - set(ops)
+    if unknown:
+        parser.error(f"unknown routes in --mix: {', '.join(sorted(unknown))}")
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [pool.submit(worker, make_client, ops, weights, deadline, args.seed + i)
+                   for i in range(args.concurrency)]
+        samples = [sample for future in futures for sample in future.result()]
+    routes = summarize(samples, time.monotonic() - start)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["routes"]
+
+    print(f"{target}: {args.users} users in {args.groups} groups, concurrency {args.concurrency}, "
+          f"{args.duration:g}s, commit {commit()}")
+    print(f"{'route':18} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          + (f" {'req/s vs':>9} {'p95 vs':>7}" if baseline else ""))
+    for name, route in routes.items():
+        line = (f"{name:18} {route['requests']:>9} {route['errors']:>7} {route['throughput']:>9.1f} "
+                f"{route['p50_ms']:>8.2f} {route['p95_ms']:>8.2f} {route['p99_ms']:>8.2f}")
+        if name in baseline:
+            line += (f" {route['throughput'] / baseline[name]['throughput']:>8.2f}x"
+                     f" {route['p95_ms'] / baseline[name]['p95_ms']:>6.2f}x")
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": commit(),
+                "time": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                "target": target,
+                "args": vars(args),
+                "routes": routes,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
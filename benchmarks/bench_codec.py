@@ -0,0 +1,62 @@
+"""Compare the binary upload encoding with JSON: bytes on the wire and parse CPU.
+
+    python benchmarks/bench_codec.py --samples 3600 --repeat 200
+
+Each payload holds --samples heart rates of one user, one per second, as the
+batch endpoint receives them. Parsing covers decoding and validation up to
+the rows handed to the database.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+import ingest  # noqa: E402
+
+
+def best_of(repeat, fn):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=3600)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    timestamps = 1657776614 + np.arange(args.samples)
+    heart_rates = rng.integers(55, 180, args.samples)
+
+    as_json = json.dumps([{"user_id": 7, "heart_rate": int(hr), "timestamp": int(ts)}
+                          for ts, hr in zip(timestamps, heart_rates)]).encode()
+    as_binary = codec.encode_heart_rates(7, timestamps, heart_rates)
+    assert codec.decode("heart_rate", as_binary) == \
+        ingest.parse_batch(json.loads(as_json), ingest.parse_heart_rate)
+
+    json_seconds = best_of(args.repeat, lambda: ingest.parse_batch(json.loads(as_json), ingest.parse_heart_rate))
+    binary_seconds = best_of(args.repeat, lambda: codec.decode("heart_rate", as_binary))
+
+    print(f"{args.samples} samples per payload, best of {args.repeat}")
+    print(f"{'':8} {'bytes':>10} {'B/sample':>9} {'parse ms':>9} {'us/sample':>10}")
+    for name, payload, seconds in (("json", as_json, json_seconds),
+                                   ("binary", as_binary, binary_seconds)):
+        print(f"{name:8} {len(payload):>10} {len(payload) / args.samples:>9.1f} "
+              f"{seconds * 1e3:>9.2f} {seconds / args.samples * 1e6:>10.2f}")
+    print(f"binary is {len(as_json) / len(as_binary):.1f}x smaller and parses "
+          f"{json_seconds / binary_seconds:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measure export throughput and show that its memory does not grow with its size.
+
+    python benchmarks/bench_export.py --rows 1000000
+    python benchmarks/bench_export.py --rows 100000000 --users 1000    # the full-size run, hours to fill
+
+Fills a SQLite database with --rows heart rates of --users users, one per
+second each, then runs `export.py` on a tenth of the time range and on all
+of it, in every format, and last the naive alternative of fetchall(). Each
+export runs in its own process so its peak RSS can be read on its own.
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from connect_sqlite import connect_sqlite  # noqa: E402
+import migrations  # noqa: E402
+
+START = datetime(2022, 10, 1)
+
+NAIVE = """
+import sys
+from connect import init_connection_pool
+with init_connection_pool().connect() as conn:
+    rows = conn.execute("SELECT user_id, heart_rate, timestamp FROM heart_rates "
+                        "WHERE timestamp < :end", end=sys.argv[1]).fetchall()
+print(len(rows))
+"""
+
+
+def fill(path, rows, users):
+    db = connect_sqlite(path)
+    migrations.migrate(db)
+    per_user = rows // users
+    with db.connect() as conn:
+        conn.execute("INSERT INTO users (first_name, last_name, group_id, age, max_heart_rate, rest_heart_rate, "
+                     "hrr_cp, awc_tot, k_value, fatigue_level) VALUES ('bench', :n, 'bench', 30, 179, 60, 40, "
+                     "100, 1, -1)", [{"n": str(n)} for n in range(users)])
+        cursor = conn.connection.cursor()
+        batch = 100000
+        for user_id in range(1, users + 1):
+            for offset in range(0, per_user, batch):
+                cursor.executemany(
+                    "INSERT INTO heart_rates (user_id, heart_rate, timestamp) VALUES (?, ?, ?)",
+                    ((user_id, 60 + i % 90, (START + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S'))
+                     for i in range(offset, min(offset + batch, per_user))))
+            conn.connection.commit()
+    db.dispose()
+    return per_user * users, START + timedelta(seconds=per_user)
+
+
+def measure(args, env):
+    """Run a command. Return its seconds and peak RSS in MB."""
+    start = time.perf_counter()
+    process = subprocess.Popen(args, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return time.perf_counter() - start, usage.ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--database", help="SQLite file to fill, a temporary one by default")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-export-")
+    path = args.database or os.path.join(workdir, "dpm.db")
+    start = time.perf_counter()
+    rows, end = fill(path, args.rows, args.users)
+    print(f"filled {rows} heart rates in {time.perf_counter() - start:.0f}s")
+    env = dict(os.environ, SQLITE_PATH=path, LOG_LEVEL="WARNING")
+
+    formats = [("csv", []), ("csv.gz", ["--gzip"])]
+    if importlib.util.find_spec("pyarrow") is not None:
+        formats.append(("parquet", ["--format", "parquet"]))
+    else:
+        print("pyarrow is not installed, skipping parquet")
+
+    print(f"{'format':10} {'rows':>12} {'seconds':>8} {'rows/s':>10} {'MB out':>8} {'peak RSS MB':>12}")
+    for fraction in (0.1, 1.0):
+        until = START + (end - START) * fraction
+        for name, options in formats:
+            output = os.path.join(workdir, f"export.{name}")
+            seconds, peak = measure([sys.executable, "export.py", "heart_rate", "--end", until.isoformat(),
+                                     "-o", output] + options, env)
+            print(f"{name:10} {int(rows * fraction):>12} {seconds:>8.1f} {rows * fraction / seconds:>10.0f} "
+                  f"{os.path.getsize(output) / 1e6:>8.1f} {peak:>12.0f}")
+            os.remove(output)
+        seconds, peak = measure([sys.executable, "-c", NAIVE, until.strftime('%Y-%m-%d %H:%M:%S')], env)
+        print(f"{'fetchall':10} {int(rows * fraction):>12} {seconds:>8.1f} {rows * fraction / seconds:>10.0f} "
+              f"{'':>8} {peak:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
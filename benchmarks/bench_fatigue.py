@@ -0,0 +1,96 @@
+"""Benchmark the vectorized W' balance engine against the per-minute loop.
+
+    python benchmarks/bench_fatigue.py --users 1000 --samples 86400
+
+The loop is timed on --reference-users users and extrapolated linearly to the
+whole cohort; those users are also checked to be bit-identical.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatigue import Fatigue, fatigue_assess_batch  # noqa: E402
+
+
+def loop_w_exp(HR, Rest_HR, Max_HR, HRR_CP, K, R, W_exp_init):
+    # the original per-minute loop of Fatigue.fatigue_assess
+    HRR = (HR - Rest_HR) / (Max_HR - Rest_HR) * 100
+    W_exp = np.zeros(len(HR))
+    if HRR[0] > HRR_CP:
+        W_exp[0] = W_exp_init + K * (HRR[0] - HRR_CP)
+    else:
+        W_exp[0] = W_exp_init
+    for i in range(1, len(HR)):
+        if HRR[i] > HRR_CP:
+            W_exp[i] = W_exp[i - 1] + K * (HRR[i] - HRR_CP)
+        else:
+            W_exp[i] = max(W_exp[i - 1] - R * (HRR_CP - HRR[i]), 0)
+    return W_exp
+
+
+def heart_rates(rng, users, samples):
+    # bounded random walk around a resting heart rate, one sample per second
+    HR = np.empty((users, samples), dtype=np.uint8)
+    y = rng.uniform(55, 90, users)
+    for begin in range(0, samples, 4096):
+        end = min(begin + 4096, samples)
+        steps = rng.normal(scale=0.8, size=(users, end - begin))
+        walk = np.clip(y[:, None] + np.cumsum(steps, axis=1), 40, 200)
+        HR[:, begin:end] = np.rint(walk)
+        y = walk[:, -1]
+    return HR
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--samples", type=int, default=86400, help="samples per user (a day at 1 Hz)")
+    parser.add_argument("--reference-users", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    HR = heart_rates(rng, args.users, args.samples)
+    subject = Fatigue("bench")
+    params = (subject.Rest_HR, subject.Max_HR, subject.HRR_CP, subject.K, subject.R)
+
+    start = time.perf_counter()
+    W_exp = fatigue_assess_batch(HR, subject.Rest_HR, subject.Max_HR, subject.HRR_CP, 0)
+    batch_seconds = time.perf_counter() - start
+
+    loop_seconds = 0.0
+    single_seconds = 0.0
+    reference = min(args.reference_users, args.users)
+    for u in range(reference):
+        row = HR[u].astype(np.int64)
+
+        start = time.perf_counter()
+        expected = loop_w_exp(row, *params, 0)
+        loop_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        single = Fatigue("bench").fatigue_assess(row, 0, 0)
+        single_seconds += time.perf_counter() - start
+
+        for name, actual in (("batch", np.ascontiguousarray(W_exp[u])), ("fatigue_assess", single)):
+            if not (actual.view(np.int64) == expected.view(np.int64)).all():
+                sys.exit(f"{name} result for user {u} differs from the loop")
+
+    loop_total = loop_seconds / reference * args.users
+    single_total = single_seconds / reference * args.users
+    print(f"cohort: {args.users} users x {args.samples} samples")
+    print(f"loop (extrapolated from {reference} users): {loop_total:10.2f} s")
+    print(f"fatigue_assess per user (extrapolated):     {single_total:10.2f} s  "
+          f"({loop_total / single_total:.0f}x)")
+    print(f"fatigue_assess_batch:                       {batch_seconds:10.2f} s  "
+          f"({loop_total / batch_seconds:.0f}x)")
+    print(f"bit-identical on {reference} reference users")
+
+
+if __name__ == "__main__":
+    main()
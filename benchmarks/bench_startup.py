@@ -0,0 +1,63 @@
+"""Time a worker's cold start: importing the app, starting it and its first response.
+
+    python benchmarks/bench_startup.py --repeat 10
+
+Every run is a fresh interpreter, like a new gunicorn worker or Cloud Run
+instance. The database is a SQLite file migrated beforehand (or the database
+given by the INSTANCE_* variables), so runs measure an up-to-date schema as
+a restarting worker finds it, with and without MIGRATE_ON_START.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+RUN = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.start()
+started = time.perf_counter()
+response = app.app.test_client().get("/")
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({"import": imported - start, "start": started - imported,
+                  "first response": done - started, "total": done - start}))
+"""
+
+
+def run(env):
+    output = subprocess.run([sys.executable, "-c", RUN], cwd=ROOT, env=env, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    if not any(env.get(name) for name in ("SQLITE_PATH", "INSTANCE_HOST", "INSTANCE_UNIX_SOCKET",
+                                          "INSTANCE_CONNECTION_NAME")):
+        env["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-startup-"), "dpm.db")
+    subprocess.run([sys.executable, "migrations.py"], cwd=ROOT, env=env, capture_output=True, check=True)
+
+    print(f"median (min) ms over {args.repeat} fresh processes")
+    print(f"{'':20} {'import':>15} {'start':>15} {'first response':>15} {'total':>15}")
+    for mode, migrate in (("migrate on start", "1"), ("migrated already", "0")):
+        runs = [run(dict(env, MIGRATE_ON_START=migrate)) for _ in range(args.repeat)]
+        print(f"{mode:20}" + "".join(
+            f" {statistics.median(r[phase] for r in runs) * 1e3:>7.1f} ({min(r[phase] for r in runs) * 1e3:>5.1f})"
+            for phase in ("import", "start", "first response", "total")))
+
+
+if __name__ == "__main__":
+    main()
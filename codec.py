@@ -0,0 +1,133 @@
+"""Compact binary encoding of heart rate and activity uploads.
+
+Sent with Content-Type application/octet-stream instead of JSON. All fields
+are little-endian. A 20 byte header
+
+    uint8 version (1), uint8 kind (1 heart rate, 2 activity), uint8 flags,
+    uint8 reserved, uint32 user_id, int64 base timestamp, uint32 count
+
+is followed by `count` values of each column in turn:
+
+    heart rate: uint16 delta, then uint8 heart rate (uint16 with flags bit 0)
+    activity:   uint16 delta, then uint32 peer_id, then uint8 if_open
+
+where each delta is the number of seconds since the previous sample, or
+since the base timestamp for the first. Columns are decoded without copying
+with numpy.frombuffer and validated as a whole; the rows produced are the
+same as those of the JSON parsers in ingest.py.
+"""
+import struct
+
+import numpy as np
+
+import ingest
+
+CONTENT_TYPE = "application/octet-stream"
+
+VERSION = 1
+HEART_RATE = 1
+ACTIVITY = 2
+KIND_CODES = {"heart_rate": HEART_RATE, "activity": ACTIVITY}
+
+# flags
+WIDE_HEART_RATES = 0x01
+
+HEADER = struct.Struct("<BBBBIqI")
+
+
+class BatchTooLarge(ingest.InvalidSample):
+    """Raised when a payload holds more than ingest.MAX_BATCH_SIZE samples."""
+
+
+def _timestamps(base: int, deltas: np.ndarray) -> np.ndarray:
+    return base + np.cumsum(deltas, dtype=np.int64)
+
+
+def _deltas(base: int, timestamps) -> np.ndarray:
+    deltas = np.diff(np.asarray(timestamps, dtype=np.int64), prepend=base)
+    if len(deltas) and (deltas.min() < 0 or deltas.max() > 0xFFFF):
+        raise ValueError("timestamps must be sorted, at most 65535 s apart")
+    return deltas.astype("<u2")
+
+
+def encode_heart_rates(user_id: int, timestamps, heart_rates) -> bytes:
+    """Encode the heart rates of one user; timestamps must be sorted."""
+    heart_rates = np.asarray(heart_rates)
+    base = int(timestamps[0]) if len(timestamps) else 0
+    wide = len(heart_rates) and heart_rates.max() > 0xFF
+    header = HEADER.pack(VERSION, HEART_RATE, WIDE_HEART_RATES if wide else 0, 0,
+                         user_id, base, len(heart_rates))
+    return (header + _deltas(base, timestamps).tobytes()
+            + heart_rates.astype("<u2" if wide else "u1").tobytes())
+
+
+def encode_activities(user_id: int, timestamps, peer_ids, if_open) -> bytes:
+    """Encode the activity events of one user; timestamps must be sorted."""
+    base = int(timestamps[0]) if len(timestamps) else 0
+    header = HEADER.pack(VERSION, ACTIVITY, 0, 0, user_id, base, len(peer_ids))
+    return (header + _deltas(base, timestamps).tobytes()
+            + np.asarray(peer_ids).astype("<u4").tobytes()
+            + np.asarray(if_open).astype("u1").tobytes())
+
+
+def decode(kind: str, payload: bytes):
+    """Decode and validate a payload of the given upload kind.
+    Return the accepted rows and a list of rejections (index and reason), like
+    ingest.parse_batch. Raise InvalidSample if the payload as a whole is invalid,
+    BatchTooLarge before decoding anything if it holds too many samples."""
+    if len(payload) < HEADER.size:
+        raise ingest.InvalidSample("truncated header")
+    version, code, flags, _, user_id, base, count = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ingest.InvalidSample("unsupported version")
+    if code != KIND_CODES.get(kind):
+        raise ingest.InvalidSample(f"expected {kind} samples")
+    if user_id <= 0:
+        raise ingest.InvalidSample("invalid user_id")
+    if count > ingest.MAX_BATCH_SIZE:
+        raise BatchTooLarge(f"At most {ingest.MAX_BATCH_SIZE} samples per batch.")
+    # deltas are unsigned, so every timestamp is at least base
+    if not 0 <= base <= ingest.MAX_TIMESTAMP:
+        raise ingest.InvalidSample("invalid base timestamp")
+
+    if code == HEART_RATE:
+        columns = [("<u2", "delta"), ("<u2" if flags & WIDE_HEART_RATES else "u1", "heart_rate")]
+    else:
+        columns = [("<u2", "delta"), ("<u4", "peer_id"), ("u1", "if_open")]
+    size = HEADER.size + count * sum(np.dtype(dtype).itemsize for dtype, _ in columns)
+    if len(payload) != size:
+        raise ingest.InvalidSample("payload size does not match count")
+
+    values = {}
+    offset = HEADER.size
+    for dtype, name in columns:
+        values[name] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+        offset += values[name].nbytes
+
+    timestamps = _timestamps(base, values["delta"])
+    # checked in the order of the JSON parsers, so a sample gets the same error
+    if code == HEART_RATE:
+        heart_rates = values["heart_rate"]
+        checks = [((heart_rates < ingest.MIN_HEART_RATE) | (heart_rates > ingest.MAX_HEART_RATE),
+                   "heart_rate out of range")]
+    else:
+        checks = [(values["peer_id"] == 0, "invalid peer_id")]
+    checks.append(((timestamps <= 0) | (timestamps > ingest.MAX_TIMESTAMP), "invalid timestamp"))
+    invalid = np.zeros(count, dtype=bool)
+    errors = []
+    for mask, error in checks:
+        errors += [{"index": int(index), "error": error} for index in np.flatnonzero(mask & ~invalid)]
+        invalid |= mask
+    errors.sort(key=lambda error: error['index'])
+
+    accepted = np.flatnonzero(~invalid)
+    datetimes = [datetime.replace("T", " ") for datetime in
+                 np.datetime_as_string(timestamps[accepted].astype("datetime64[s]")).tolist()]
+    if code == HEART_RATE:
+        rows = [{"user_id": user_id, "heart_rate": heart_rate, "timestamp": timestamp}
+                for heart_rate, timestamp in zip(heart_rates[accepted].tolist(), datetimes)]
+    else:
+        rows = [{"user_id": user_id, "peer_id": peer_id, "timestamp": timestamp, "if_open": bool(if_open)}
+                for peer_id, if_open, timestamp in zip(values["peer_id"][accepted].tolist(),
+                                                       values["if_open"][accepted].tolist(), datetimes)]
+    return rows, errors
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import codec
+import ingest
+
+
+def test_heart_rates_match_json_parser():
+    rng = np.random.default_rng(0)
+    timestamps = 1657776614 + np.cumsum(rng.integers(0, 5, 1000))
+    heart_rates = rng.integers(10, 255, 1000)
+    payload = codec.encode_heart_rates(7, timestamps, heart_rates)
+    assert len(payload) == codec.HEADER.size + 3 * 1000
+
+    samples = [{"user_id": 7, "heart_rate": int(hr), "timestamp": int(ts)}
+               for ts, hr in zip(timestamps, heart_rates)]
+    assert codec.decode("heart_rate", payload) == ingest.parse_batch(samples, ingest.parse_heart_rate)
+
+
+def test_wide_heart_rates():
+    rows, errors = codec.decode("heart_rate", codec.encode_heart_rates(7, [10, 11], [80, 300]))
+    assert [row['heart_rate'] for row in rows] == [80]
+    assert errors == [{"index": 1, "error": "heart_rate out of range"}]
+
+
+def test_activities_match_json_parser():
+    timestamps = [1657776614, 1657776614, 1657776700]
+    peer_ids = [2, 0, 3]
+    if_open = [True, True, False]
+    payload = codec.encode_activities(7, timestamps, peer_ids, if_open)
+    samples = [{"user_id": 7, "peer_id": p, "timestamp": t, "if_open": o}
+               for t, p, o in zip(timestamps, peer_ids, if_open)]
+    assert codec.decode("activity", payload) == ingest.parse_batch(samples, ingest.parse_activity)
+
+
+def test_invalid_payloads():
+    payload = codec.encode_heart_rates(7, [10, 11], [80, 90])
+    for kind, data in (("heart_rate", payload[:10]),
+                       ("heart_rate", payload[:-1]),
+                       ("activity", payload),
+                       ("heart_rate", codec.encode_heart_rates(0, [10], [80]))):
+        with pytest.raises(ingest.InvalidSample):
+            codec.decode(kind, data)
+    with pytest.raises(ValueError):
+        codec.encode_heart_rates(7, [10, 5], [80, 90])
+
+
+def test_count_and_base_are_checked_before_decoding():
+    header = codec.HEADER.pack(codec.VERSION, codec.HEART_RATE, 0, 0, 7, 10, ingest.MAX_BATCH_SIZE + 1)
+    # refused from the header alone, the samples are never read
+    with pytest.raises(codec.BatchTooLarge):
+        codec.decode("heart_rate", header)
+
+    for base in (-1, ingest.MAX_TIMESTAMP + 1, 2**62):
+        with pytest.raises(ingest.InvalidSample, match="invalid base timestamp"):
+            codec.decode("heart_rate", codec.encode_heart_rates(7, [base], [80]))
+
+    rows, errors = codec.decode("heart_rate", codec.encode_heart_rates(
+        7, [ingest.MAX_TIMESTAMP - 1, ingest.MAX_TIMESTAMP, ingest.MAX_TIMESTAMP + 1], [80, 81, 82]))
+    assert [row["heart_rate"] for row in rows] == [80, 81]
+    assert errors == [{"index": 2, "error": "invalid timestamp"}]
@@ -0,0 +1,18 @@
+import pytest
+import sqlalchemy
+
+stmt_add_user = sqlalchemy.text(
+    """INSERT INTO users (first_name, last_name, group_id, age, max_heart_rate,
+    rest_heart_rate, hrr_cp, awc_tot, k_value, fatigue_level)
+    VALUES ('user', :last_name, :group_id, 30, 179, 60, 40, 100, 1, -1)""")
+
+
+@pytest.fixture(scope="session")
+def add_users():
+    """`add_users(db, group_ids=("a",))` registers one user per entry of
+    group_ids, named 'user 1', 'user 2', ... with the same profile. On a new
+    database their user_ids are 1, 2, ... `db` is an engine or a connection."""
+    def add(db, group_ids=("a",)) -> None:
+        db.execute(stmt_add_user, [{"last_name": str(n + 1), "group_id": group_id}
+                                   for n, group_id in enumerate(group_ids)])
+    return add
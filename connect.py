@@ -0,0 +1,53 @@
+"""Pick the database connection from the environment.
+
+Each backend is imported only when selected: the Cloud SQL connector alone
+takes longer to import than the rest of the app.
+"""
+import os
+
+import sqlalchemy
+
+
+def init_connection_pool() -> sqlalchemy.engine.base.Engine:
+    # use a TCP socket when INSTANCE_HOST (e.g. 127.0.0.1) is defined
+    if os.environ.get("INSTANCE_HOST"):
+        from connect_tcp import connect_tcp_socket
+        return connect_tcp_socket()
+
+    # use a Unix socket when INSTANCE_UNIX_SOCKET (e.g. /cloudsql/project:region:instance) is defined
+    if os.environ.get("INSTANCE_UNIX_SOCKET"):
+        from connect_unix import connect_unix_socket
+        return connect_unix_socket()
+
+    # use the connector when INSTANCE_CONNECTION_NAME (e.g. project:region:instance) is defined
+    if os.environ.get("INSTANCE_CONNECTION_NAME"):
+        from connect_connector import connect_with_connector
+        return connect_with_connector()
+
+    # use an embedded SQLite database when SQLITE_PATH (e.g. /var/lib/dpm/dpm.db) is defined
+    if os.environ.get("SQLITE_PATH"):
+        from connect_sqlite import connect_sqlite
+        return connect_sqlite()
+
+    raise ValueError(
+        "Missing database connection type. Please define one of INSTANCE_HOST, INSTANCE_UNIX_SOCKET, "
+        "INSTANCE_CONNECTION_NAME or SQLITE_PATH"
+    )
+
+
+def init_replica_pool():
+    """Connection pool to a read replica, or None without REPLICA_* variables."""
+    if os.environ.get("REPLICA_INSTANCE_HOST"):
+        from connect_tcp import connect_tcp_socket
+        return connect_tcp_socket(os.environ["REPLICA_INSTANCE_HOST"],
+                                  os.environ.get("REPLICA_DB_PORT"))
+    if os.environ.get("REPLICA_INSTANCE_UNIX_SOCKET"):
+        from connect_unix import connect_unix_socket
+        return connect_unix_socket(os.environ["REPLICA_INSTANCE_UNIX_SOCKET"])
+    if os.environ.get("REPLICA_INSTANCE_CONNECTION_NAME"):
+        from connect_connector import connect_with_connector
+        return connect_with_connector(os.environ["REPLICA_INSTANCE_CONNECTION_NAME"])
+    if os.environ.get("REPLICA_SQLITE_PATH"):
+        from connect_sqlite import connect_sqlite
+        return connect_sqlite(os.environ["REPLICA_SQLITE_PATH"])
+    return None
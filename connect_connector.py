@@ -20,16 +20,18 @@ import pymysql
 
 import sqlalchemy
 
+import db_pool
+
 
 # connect_with_connector initializes a connection pool for a
 # Cloud SQL instance of MySQL using the Cloud SQL Python Connector.
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+def connect_with_connector(instance_connection_name: str = None) -> sqlalchemy.engine.base.Engine:
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
 
-    instance_connection_name = os.environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
+    instance_connection_name = instance_connection_name or os.environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
     db_user = os.environ.get("DB_USER", "")  # e.g. 'my-db-user'
     db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
     db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
@@ -48,30 +50,11 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         )
         return conn
 
-    pool = sqlalchemy.create_engine(
+    pool = db_pool.create_pool(
         "mysql+pymysql://",
         creator=getconn,
         # [START_EXCLUDE]
-        # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
-
-        # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
-
-        # The total number of concurrent connections for your application will be
-        # a total of pool_size and max_overflow.
-
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
-
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # re-established
-        pool_recycle=1800,  # 30 minutes
-
-        echo=True,
+        # pool size, timeouts and health checks are configured in db_pool.py
         # [END_EXCLUDE]
     )
     return pool
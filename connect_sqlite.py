@@ -0,0 +1,45 @@
+"""Embedded SQLite backend, for a single node without network access (e.g. a
+site gateway), local development and tests.
+
+The database runs in WAL mode, so readers do not block the writer and a
+write commits with one append to the log; writers queue on SQLite's own
+lock for up to SQLITE_BUSY_TIMEOUT seconds. Statements that differ from
+MySQL are written with dialect.py.
+"""
+from datetime import datetime
+
+import os
+import sqlite3
+
+import sqlalchemy
+
+import db_pool
+
+# DATETIME columns are read back as datetime, like on MySQL
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+
+
+def connect_sqlite(path: str = None) -> sqlalchemy.engine.base.Engine:
+    path = path or os.environ["SQLITE_PATH"]  # e.g. '/var/lib/dpm/dpm.db'
+    pool = db_pool.create_pool(
+        f"sqlite:///{path}",
+        connect_args={
+            "detect_types": sqlite3.PARSE_DECLTYPES,
+            "timeout": float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30)),
+            # pooled connections move between request threads
+            "check_same_thread": False,
+        },
+    )
+
+    @sqlalchemy.event.listens_for(pool, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # durable at checkpoints rather than every commit, safe in WAL mode
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # off by default in SQLite; samples must belong to a user
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    return pool
@@ -18,19 +18,21 @@ import os
 
 import sqlalchemy
 
+import db_pool
+
 
 # connect_tcp_socket initializes a TCP connection pool
 # for a Cloud SQL instance of MySQL.
-def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
+def connect_tcp_socket(db_host: str = None, db_port: str = None) -> sqlalchemy.engine.base.Engine:
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
-    db_host = os.environ["INSTANCE_HOST"]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
+    db_host = db_host or os.environ["INSTANCE_HOST"]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
     db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
     db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
     db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
-    db_port = os.environ["DB_PORT"]  # e.g. 3306
+    db_port = db_port or os.environ["DB_PORT"]  # e.g. 3306
 
     connect_args = {}
     # [END cloud_sql_mysql_sqlalchemy_connect_tcp]
@@ -50,7 +52,7 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
         connect_args = ssl_args
 
     # [START cloud_sql_mysql_sqlalchemy_connect_tcp]
-    pool = sqlalchemy.create_engine(
+    pool = db_pool.create_pool(
         # Equivalent URL:
         # mysql+pymysql://<db_user>:<db_pass>@<db_host>:<db_port>/<db_name>
         sqlalchemy.engine.url.URL.create(
@@ -63,35 +65,7 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
         ),
         connect_args=connect_args,
         # [START_EXCLUDE]
-        # [START cloud_sql_mysql_sqlalchemy_limit]
-        # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
-        # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
-        # The total number of concurrent connections for your application will be
-        # a total of pool_size and max_overflow.
-        # [END cloud_sql_mysql_sqlalchemy_limit]
-
-        # [START cloud_sql_mysql_sqlalchemy_backoff]
-        # SQLAlchemy automatically uses delays between failed connection attempts,
-        # but provides no arguments for configuration.
-        # [END cloud_sql_mysql_sqlalchemy_backoff]
-
-        # [START cloud_sql_mysql_sqlalchemy_timeout]
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
-        # [END cloud_sql_mysql_sqlalchemy_timeout]
-
-        # [START cloud_sql_mysql_sqlalchemy_lifetime]
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # re-established
-        pool_recycle=1800,  # 30 minutes
-
-        echo=True,
-        # [END cloud_sql_mysql_sqlalchemy_lifetime]
+        # pool size, timeouts and health checks are configured in db_pool.py
         # [END_EXCLUDE]
     )
     return pool
@@ -17,10 +17,12 @@ import os
 
 import sqlalchemy
 
+import db_pool
+
 
 # connect_unix_socket initializes a Unix socket connection pool for
 # a Cloud SQL instance of MySQL.
-def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
+def connect_unix_socket(unix_socket_path: str = None) -> sqlalchemy.engine.base.Engine:
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
@@ -28,9 +30,9 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
     db_user = os.environ["DB_USER"]  # e.g. 'my-database-user'
     db_pass = os.environ["DB_PASS"]  # e.g. 'my-database-password'
     db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
-    unix_socket_path = os.environ["INSTANCE_UNIX_SOCKET"]  # e.g. '/cloudsql/project:region:instance'
+    unix_socket_path = unix_socket_path or os.environ["INSTANCE_UNIX_SOCKET"]  # e.g. '/cloudsql/project:region:instance'
 
-    pool = sqlalchemy.create_engine(
+    pool = db_pool.create_pool(
         # Equivalent URL:
         # mysql+pymysql://<db_user>:<db_pass>@/<db_name>?unix_socket=<socket_path>/<cloud_sql_instance_name>
         sqlalchemy.engine.url.URL.create(
@@ -41,26 +43,7 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
             query={"unix_socket": unix_socket_path},
         ),
         # [START_EXCLUDE]
-        # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
-
-        # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
-
-        # The total number of concurrent connections for your application will be
-        # a total of pool_size and max_overflow.
-
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
-
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # re-established
-        pool_recycle=1800,  # 30 minutes
-
-        echo=True,
+        # pool size, timeouts and health checks are configured in db_pool.py
         # [END_EXCLUDE]
     )
     return pool
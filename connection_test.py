@@ -19,7 +19,12 @@ from flask.testing import FlaskClient
 
 import pytest
 
-import app
+if "MYSQL_INSTANCE_HOST" not in os.environ:
+    pytest.skip("needs a MySQL instance", allow_module_level=True)
+
+import app  # noqa: E402
+import metrics  # noqa: E402
+from user_cache import UserCache  # noqa: E402
 
 logger = logging.getLogger()
 
@@ -35,6 +40,16 @@ def setup_test_env():
     os.environ["INSTANCE_CONNECTION_NAME"] = os.environ["MYSQL_INSTANCE"]
 
 
+def restart(monkeypatch) -> None:
+    """Start the app again, so its pools and read router use the current transport."""
+    monkeypatch.setattr(app, "_started", False)
+    # start() registers the pool gauges, once per process
+    monkeypatch.setattr(metrics, "registry", metrics.Registry())
+    # logins must reach the database
+    monkeypatch.setattr(app, "user_cache", UserCache())
+    app.start()
+
+
 @pytest.fixture(scope="module")
 def client() -> FlaskClient:
     setup_test_env()
@@ -44,33 +59,29 @@ def client() -> FlaskClient:
     return client
 
 
-def test_get_votes(client: FlaskClient) -> None:
+def test_index(client: FlaskClient) -> None:
     response = client.get("/")
-    text = "Tabs VS Spaces"
-    body = response.text
     assert response.status_code == 200
-    assert text in body
+    assert "Hello" in response.text
 
 
-def test_cast_vote(client: FlaskClient) -> None:
-    response = client.post("/votes", data={"team": "SPACES"})
-    text = "Vote successfully cast for 'SPACES'"
-    body = response.text
+def test_login(client: FlaskClient) -> None:
+    response = client.post("/api/v1/user/login/", json={"first_name": "connection", "last_name": "test"})
     assert response.status_code == 200
-    assert text in body
+    assert response.json["first_name"] == "connection"
 
 
-def test_unix_connection(client: FlaskClient) -> None:
+def test_unix_connection(client: FlaskClient, monkeypatch) -> None:
     del os.environ["INSTANCE_HOST"]
-    app.db = app.init_connection_pool()
+    restart(monkeypatch)
     assert "unix_socket" in str(app.db.url)
-    test_get_votes(client)
-    test_cast_vote(client)
+    test_index(client)
+    test_login(client)
 
 
-def test_connector_connection(client: FlaskClient) -> None:
+def test_connector_connection(client: FlaskClient, monkeypatch) -> None:
     del os.environ["INSTANCE_UNIX_SOCKET"]
-    app.db = app.init_connection_pool()
+    restart(monkeypatch)
     assert str(app.db.url) == "mysql+pymysql://"
-    test_get_votes(client)
-    test_cast_vote(client)
+    test_index(client)
+    test_login(client)
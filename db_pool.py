@@ -0,0 +1,156 @@
+"""Connection pool settings shared by every database transport.
+
+connect_tcp, connect_unix and connect_connector only differ in how they reach
+the database; they all build their engine with `create_pool`, so pool tuning
+applies to each of them. Settings are read from a JSON file named by
+DB_POOL_CONFIG, e.g. {"pool_size": 12, "upload_pool_timeout": 0.5}, then from
+the environment, which takes precedence:
+
+    DB_POOL_SIZE            connections kept open per process
+    DB_MAX_OVERFLOW         extra connections opened under load
+    DB_MAX_CONNECTIONS      connections this instance may open over all workers
+    DB_POOL_TIMEOUT         seconds to wait for a connection (default 10)
+    DB_UPLOAD_POOL_TIMEOUT  the same for upload routes, which fail fast (default 1)
+    DB_POOL_RECYCLE         seconds before a connection is replaced (default 1800)
+    DB_POOL_PRE_PING        test connections before use (default 1)
+
+By default the pool is sized from the gunicorn settings in gunicorn.conf.py:
+one connection per request thread, plus overflow for the background threads,
+and capped at DB_MAX_CONNECTIONS divided by the number of workers.
+"""
+from contextvars import ContextVar
+
+import contextlib
+import json
+import os
+import time
+
+import sqlalchemy
+
+import metrics
+
+# background threads holding a connection at the same time as requests:
+# write-behind, fatigue pipeline, downsampler and partition maintenance
+BACKGROUND_CONNECTIONS = 4
+
+SETTINGS = {
+    # name: (environment variable, type)
+    "pool_size": ("DB_POOL_SIZE", int),
+    "max_overflow": ("DB_MAX_OVERFLOW", int),
+    "max_connections": ("DB_MAX_CONNECTIONS", int),
+    "pool_timeout": ("DB_POOL_TIMEOUT", float),
+    "upload_pool_timeout": ("DB_UPLOAD_POOL_TIMEOUT", float),
+    "pool_recycle": ("DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("DB_POOL_PRE_PING", lambda value: str(value).lower() not in ("0", "false", "no")),
+}
+
+# pool timeout of the checkout in progress, when not the pool's own
+_checkout_timeout = ContextVar("checkout_timeout", default=None)
+
+
+def workers() -> int:
+    return int(os.environ.get("WEB_CONCURRENCY", 1))
+
+
+def threads() -> int:
+    return int(os.environ.get("GUNICORN_THREADS", 8))
+
+
+def size_pool(threads: int, workers: int = 1, max_connections: int = None):
+    """Return pool_size and max_overflow for one worker process."""
+    pool_size, max_overflow = threads, BACKGROUND_CONNECTIONS
+    if max_connections:
+        budget = max(1, max_connections // workers)
+        pool_size = min(pool_size, budget)
+        max_overflow = min(max_overflow, budget - pool_size)
+    return pool_size, max_overflow
+
+
+class PoolConfig:
+    """Connection pool settings, see the module docstring."""
+
+    def __init__(self, pool_size: int = None, max_overflow: int = None, max_connections: int = None,
+                 pool_timeout: float = 10, upload_pool_timeout: float = 1, pool_recycle: int = 1800,
+                 pool_pre_ping: bool = True) -> None:
+        default_size, default_overflow = size_pool(threads(), workers(), max_connections)
+        self.pool_size = default_size if pool_size is None else pool_size
+        self.max_overflow = default_overflow if max_overflow is None else max_overflow
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.upload_pool_timeout = upload_pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+
+    @classmethod
+    def from_env(cls, **overrides) -> "PoolConfig":
+        settings = {}
+        if os.environ.get("DB_POOL_CONFIG"):
+            with open(os.environ["DB_POOL_CONFIG"]) as f:
+                settings = json.load(f)
+            unknown = set(settings) - set(SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown pool settings in {os.environ['DB_POOL_CONFIG']}: {sorted(unknown)}")
+        for name, (variable, _) in SETTINGS.items():
+            if os.environ.get(variable):
+                settings[name] = os.environ[variable]
+        settings = {name: SETTINGS[name][1](value) for name, value in settings.items()}
+        settings.update(overrides)
+        return cls(**settings)
+
+    def engine_options(self) -> dict:
+        """Keyword arguments of create_engine for these settings."""
+        return {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "pool_recycle": self.pool_recycle,
+            "pool_pre_ping": self.pool_pre_ping,
+        }
+
+
+class _Checkout:
+    """Pool mixin recording how long checkouts wait for a connection and
+    honouring `checkout_timeout` over the pool's own timeout."""
+
+    @property
+    def _timeout(self):
+        timeout = _checkout_timeout.get()
+        return self._pool_timeout if timeout is None else timeout
+
+    @_timeout.setter
+    def _timeout(self, timeout):
+        self._pool_timeout = timeout
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            metrics.checkout_timeouts.inc()
+            raise
+        finally:
+            metrics.checkout_wait.observe(time.perf_counter() - start)
+
+
+class QueuePool(_Checkout, sqlalchemy.pool.QueuePool):
+    pass
+
+
+class AsyncQueuePool(_Checkout, sqlalchemy.pool.AsyncAdaptedQueuePool):
+    pass
+
+
+@contextlib.contextmanager
+def checkout_timeout(seconds: float):
+    """Wait at most that many seconds for connections checked out in the block."""
+    token = _checkout_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _checkout_timeout.reset(token)
+
+
+def create_pool(*args, config: PoolConfig = None, **kwargs) -> sqlalchemy.engine.base.Engine:
+    """sqlalchemy.create_engine with the pool settings of `config`, from the environment by default."""
+    config = config or PoolConfig.from_env()
+    return sqlalchemy.create_engine(*args, poolclass=QueuePool, **config.engine_options(), **kwargs)
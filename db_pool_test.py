@@ -0,0 +1,44 @@
+import json
+import time
+
+import pytest
+import sqlalchemy
+
+import db_pool
+
+
+def test_size_pool():
+    assert db_pool.size_pool(threads=8) == (8, db_pool.BACKGROUND_CONNECTIONS)
+    # 4 workers sharing 40 connections
+    assert db_pool.size_pool(threads=8, workers=4, max_connections=40) == (8, 2)
+    assert db_pool.size_pool(threads=8, workers=4, max_connections=16) == (4, 0)
+
+
+def test_config_from_file_and_env(tmp_path, monkeypatch):
+    path = tmp_path / "pool.json"
+    path.write_text(json.dumps({"pool_size": 12, "pool_timeout": 5, "pool_pre_ping": False}))
+    monkeypatch.setenv("DB_POOL_CONFIG", str(path))
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "2.5")
+    monkeypatch.setenv("GUNICORN_THREADS", "3")
+    config = db_pool.PoolConfig.from_env()
+    assert (config.pool_size, config.max_overflow) == (12, db_pool.BACKGROUND_CONNECTIONS)
+    assert config.pool_timeout == 2.5
+    assert config.pool_pre_ping is False
+    assert db_pool.PoolConfig.from_env(pool_size=1).pool_size == 1
+
+    path.write_text(json.dumps({"pool_sise": 12}))
+    with pytest.raises(ValueError):
+        db_pool.PoolConfig.from_env()
+
+
+def test_checkout_timeout_fails_fast():
+    config = db_pool.PoolConfig(pool_size=1, max_overflow=0, pool_timeout=30)
+    db = db_pool.create_pool("sqlite:///:memory:", config=config)
+    with db.connect():
+        start = time.perf_counter()
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            with db_pool.checkout_timeout(0.05), db.connect():
+                pass
+        assert time.perf_counter() - start < 5
+    # the pool's own timeout applies again outside the block
+    assert db.pool._timeout == 30
@@ -0,0 +1,122 @@
+"""SQL that differs between the MySQL and SQLite backends.
+
+Statements are written for MySQL. `DialectText` is a text statement carrying
+alternatives for other dialects; the one matching the connection is picked
+when the statement is compiled, so callers execute it like any other
+statement. `insert_ignore` and `upsert` build the two kinds of statement
+that need it most, and `named_lock` stands in for GET_LOCK.
+"""
+import contextlib
+import fcntl
+import re
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import TextClause
+
+# process-local locks of in-memory SQLite databases
+_memory_locks = {}
+_memory_locks_lock = threading.Lock()
+
+
+class DialectText(TextClause):
+    """A text statement for MySQL with alternatives for other dialects,
+    e.g. DialectText("... DATE_FORMAT(...) ...", sqlite="... strftime(...) ...")."""
+    inherit_cache = True
+
+    def __init__(self, text: str, **variants) -> None:
+        super().__init__(text)
+        self.variants = {name: sqlalchemy.text(variant) for name, variant in variants.items()}
+
+    def for_dialect(self, name: str) -> TextClause:
+        return self.variants.get(name, self)
+
+
+@compiles(DialectText)
+def _compile_dialect_text(element, compiler, **kw):
+    variant = element.variants.get(compiler.dialect.name)
+    if variant is None:
+        return compiler.visit_textclause(element, **kw)
+    return compiler.process(variant, **kw)
+
+
+def text_for(stmt, name: str) -> str:
+    """SQL of a statement, as run on the named dialect."""
+    if isinstance(stmt, DialectText):
+        stmt = stmt.for_dialect(name)
+    return stmt.text
+
+
+def insert_ignore(insert: str) -> DialectText:
+    """Turn an INSERT INTO statement into one skipping rows that would
+    duplicate a unique key."""
+    return DialectText(insert.replace("INSERT INTO", "INSERT IGNORE INTO", 1),
+                       sqlite=insert.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1))
+
+
+def _mysql_expression(expression: str) -> str:
+    return re.sub(r"\bexcluded\.(\w+)", r"VALUES(\1)", expression)
+
+
+def _sqlite_expression(expression: str) -> str:
+    # SQLite's multi-argument MIN and MAX are scalar functions
+    return re.sub(r"\bLEAST\(", "MIN(", re.sub(r"\bGREATEST\(", "MAX(", expression))
+
+
+def upsert(insert: str, keys: tuple, updates: dict) -> DialectText:
+    """Add an update of the existing row on a duplicate `keys` to an INSERT
+    statement. `updates` maps columns to expressions, which refer to the
+    inserted values as excluded.<column> and may use LEAST and GREATEST.
+    An INSERT ... SELECT needs a WHERE clause for SQLite to parse it."""
+    mysql = ", ".join(f"{column} = {_mysql_expression(expression)}" for column, expression in updates.items())
+    sqlite = ", ".join(f"{column} = {_sqlite_expression(expression)}" for column, expression in updates.items())
+    return DialectText(f"{insert}\n    ON DUPLICATE KEY UPDATE {mysql}",
+                       sqlite=f"{insert}\n    ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {sqlite}")
+
+
+@contextlib.contextmanager
+def named_lock(conn, name: str, timeout: float = 0):
+    """Hold the named lock for the block, shared by every process using the
+    database. Yield whether it was acquired within `timeout` seconds."""
+    if conn.dialect.name == "mysql":
+        acquired = conn.execute(sqlalchemy.text("SELECT GET_LOCK(:name, :timeout)"),
+                                name=name, timeout=timeout).scalar()
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                conn.execute(sqlalchemy.text("SELECT RELEASE_LOCK(:name)"), name=name)
+        return
+
+    path = conn.engine.url.database
+    if not path or path == ":memory:":
+        with _memory_locks_lock:
+            lock = _memory_locks.setdefault((id(conn.engine), name), threading.Lock())
+        acquired = lock.acquire(timeout=timeout) if timeout else lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+        return
+
+    # SQLite: an advisory lock on a file next to the database
+    with open(f"{path}-{name}.lock", "w") as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    acquired = False
+                    break
+                time.sleep(0.05)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,41 @@
+from sqlalchemy.dialects import mysql
+
+import dialect
+from connect_sqlite import connect_sqlite
+
+stmt_add = dialect.upsert(
+    "INSERT INTO totals (name, total, low) VALUES (:name, :total, :low)",
+    ("name",), {"total": "total + excluded.total", "low": "LEAST(low, excluded.low)"})
+
+
+def test_mysql_statements():
+    assert str(stmt_add.compile(dialect=mysql.dialect())).endswith(
+        "ON DUPLICATE KEY UPDATE total = total + VALUES(total), low = LEAST(low, VALUES(low))")
+    stmt = dialect.insert_ignore("INSERT INTO t (a) VALUES (:a)")
+    assert str(stmt.compile(dialect=mysql.dialect())) == "INSERT IGNORE INTO t (a) VALUES (%s)"
+
+
+def test_sqlite_statements(tmp_path):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    with db.connect() as conn:
+        assert conn.execute("PRAGMA journal_mode").scalar() == "wal"
+        conn.execute("CREATE TABLE totals (name VARCHAR(10) PRIMARY KEY, total INTEGER, low INTEGER)")
+        conn.execute(stmt_add, [{"name": "a", "total": 2, "low": 5}, {"name": "a", "total": 3, "low": 4},
+                                {"name": "b", "total": 1, "low": 1}])
+        conn.execute(dialect.insert_ignore("INSERT INTO totals (name, total, low) VALUES (:name, 0, 0)"),
+                     [{"name": "a"}, {"name": "c"}])
+        assert conn.execute("SELECT * FROM totals ORDER BY name").fetchall() == [
+            ("a", 5, 4), ("b", 1, 1), ("c", 0, 0)]
+
+
+def test_named_lock(tmp_path):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    with db.connect() as conn, db.connect() as other:
+        with dialect.named_lock(conn, "job") as acquired:
+            assert acquired
+            with dialect.named_lock(other, "job", timeout=0.1) as acquired:
+                assert not acquired
+            with dialect.named_lock(other, "other job") as acquired:
+                assert acquired
+        with dialect.named_lock(other, "job") as acquired:
+            assert acquired
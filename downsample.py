@@ -0,0 +1,175 @@
+"""Multi-resolution heart rate history.
+
+heart_rate_buckets keeps the count, sum, min and max of every user's heart
+rates per 1 minute, 15 minute, 1 hour and 1 day (UTC) bucket, so charts over
+long ranges read a few hundred rows instead of every sample; 1 second buckets
+are read from heart_rates itself.
+
+A background job folds new heart_rates rows into all tiers. It follows the
+auto-increment id, so late uploads are picked up whatever their timestamp.
+Each run only goes up to the highest id seen by the previous run, which
+leaves concurrent uploads one interval to commit before their ids are passed.
+
+    python downsample.py    # run once, e.g. from cron
+"""
+from datetime import datetime, timezone
+
+import calendar
+import logging
+import threading
+
+import sqlalchemy
+
+import dialect
+
+logger = logging.getLogger()
+
+# bucket sizes in seconds; 1 is served from the raw samples
+RESOLUTIONS = (1, 60, 900, 3600, 86400)
+TIERS = RESOLUTIONS[1:]
+
+# most buckets a history request may ask for
+MAX_POINTS = 10000
+
+# heart_rates rows folded per transaction
+BATCH_SIZE = 50000
+
+stmt_state = sqlalchemy.text(
+    "SELECT watermark, horizon FROM downsample_state WHERE name='heart_rates'")
+stmt_save_state = dialect.upsert(
+    """INSERT INTO downsample_state (name, watermark, horizon)
+    VALUES ('heart_rates', :watermark, :horizon)""",
+    ("name",), {"watermark": "excluded.watermark", "horizon": "excluded.horizon"})
+stmt_max_id = sqlalchemy.text("SELECT MAX(id) FROM heart_rates")
+stmt_new_rows = sqlalchemy.text(
+    """SELECT id, user_id, heart_rate, timestamp FROM heart_rates
+    WHERE id > :watermark AND id <= :horizon ORDER BY id LIMIT :limit""")
+stmt_add = dialect.upsert(
+    """INSERT INTO heart_rate_buckets (user_id, resolution, bucket, sample_count, hr_sum, hr_min, hr_max)
+    VALUES (:user_id, :resolution, :bucket, :sample_count, :hr_sum, :hr_min, :hr_max)""",
+    ("user_id", "resolution", "bucket"),
+    {"sample_count": "sample_count + excluded.sample_count",
+     "hr_sum": "hr_sum + excluded.hr_sum",
+     "hr_min": "LEAST(hr_min, excluded.hr_min)",
+     "hr_max": "GREATEST(hr_max, excluded.hr_max)"})
+stmt_select = sqlalchemy.text(
+    """SELECT bucket, sample_count, hr_sum, hr_min, hr_max FROM heart_rate_buckets
+    WHERE user_id=:user_id AND resolution=:resolution AND bucket >= :start AND bucket < :end
+    ORDER BY bucket""")
+stmt_select_raw = sqlalchemy.text(
+    """SELECT timestamp, COUNT(*), SUM(heart_rate), MIN(heart_rate), MAX(heart_rate)
+    FROM heart_rates WHERE user_id=:user_id AND timestamp >= :start AND timestamp < :end
+    GROUP BY timestamp ORDER BY timestamp""")
+
+
+def pick_resolution(start: int, end: int, max_points: int) -> int:
+    """Return the finest resolution whose bucket count over [start, end) fits in
+    `max_points`, or the coarsest one if none does."""
+    for resolution in RESOLUTIONS:
+        if (end - start) / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def add_heart_rates(conn, rows) -> None:
+    """Fold (user_id, heart_rate, timestamp) rows into every tier.
+    Rows are aggregated per bucket first, so a batch costs one upsert per bucket."""
+    buckets = {}
+    for user_id, heart_rate, timestamp in rows:
+        seconds = calendar.timegm(timestamp.utctimetuple())
+        for resolution in TIERS:
+            key = (user_id, resolution, seconds - seconds % resolution)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, heart_rate, heart_rate, heart_rate]
+            else:
+                bucket[0] += 1
+                bucket[1] += heart_rate
+                bucket[2] = min(bucket[2], heart_rate)
+                bucket[3] = max(bucket[3], heart_rate)
+    if buckets:
+        conn.execute(stmt_add, [{
+            "user_id": user_id,
+            "resolution": resolution,
+            "bucket": datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S'),
+            "sample_count": bucket[0],
+            "hr_sum": bucket[1],
+            "hr_min": bucket[2],
+            "hr_max": bucket[3],
+        } for (user_id, resolution, seconds), bucket in buckets.items()])
+
+
+def history(conn, user_id: int, start: int, end: int, resolution: int) -> list:
+    """Return (bucket start, count, min, max, mean) of a user's heart rates in
+    [start, end) unix seconds at one of RESOLUTIONS."""
+    params = {
+        "user_id": user_id,
+        "resolution": resolution,
+        "start": datetime.utcfromtimestamp(start - start % resolution),
+        "end": datetime.utcfromtimestamp(end),
+    }
+    stmt = stmt_select_raw if resolution == 1 else stmt_select
+    return [(int(row[0].replace(tzinfo=timezone.utc).timestamp()),
+             int(row[1]), int(row[3]), int(row[4]), float(row[2]) / int(row[1]))
+            for row in conn.execute(stmt, **params).fetchall()]
+
+
+def run(db: sqlalchemy.engine.base.Engine) -> int:
+    """Fold the heart rates uploaded since the last run into the tiers.
+    Return the number of samples processed."""
+    processed = 0
+    with db.connect() as conn:
+        # only one worker downsamples at a time
+        with dialect.named_lock(conn, "downsample") as acquired:
+            if not acquired:
+                return 0
+            state = conn.execute(stmt_state).fetchone()
+            watermark, horizon = state if state is not None else (0, 0)
+            while watermark < horizon:
+                rows = conn.execute(stmt_new_rows, watermark=watermark, horizon=horizon,
+                                    limit=BATCH_SIZE).fetchall()
+                if not rows:
+                    break
+                with conn.begin():
+                    add_heart_rates(conn, [row[1:] for row in rows])
+                    conn.execute(stmt_save_state, watermark=rows[-1][0], horizon=horizon)
+                watermark = rows[-1][0]
+                processed += len(rows)
+            # ids up to the current maximum are processed by the next run
+            conn.execute(stmt_save_state, watermark=max(watermark, horizon),
+                         horizon=conn.execute(stmt_max_id).scalar() or 0)
+    return processed
+
+
+class Downsampler:
+    """Background thread running the downsampling job every `interval` seconds."""
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, interval: float) -> None:
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="downsample", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                run(self.db)
+            except Exception as e:
+                logger.exception(e)
+
+
+def main():
+    from connect import init_connection_pool
+    processed = run(init_connection_pool())
+    print(f"downsampled {processed} heart rates")
+
+
+if __name__ == "__main__":
+    main()
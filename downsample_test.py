@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import downsample
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.params = []
+
+    def execute(self, stmt, params):
+        self.params.extend(params)
+
+
+def test_pick_resolution():
+    day = 24 * 3600
+    assert downsample.pick_resolution(0, 600, 1000) == 1
+    assert downsample.pick_resolution(0, day, 1500) == 60
+    assert downsample.pick_resolution(0, 7 * day, 1000) == 900
+    assert downsample.pick_resolution(0, 30 * day, 1000) == 3600
+    assert downsample.pick_resolution(0, 365 * day, 1000) == 86400
+    assert downsample.pick_resolution(0, 10000 * day, 1000) == 86400
+
+
+def test_add_heart_rates_aggregates_each_tier():
+    start = 1664582400
+    rows = [(7, 60 + i % 50, datetime.utcfromtimestamp(start + i)) for i in range(7200)]
+    conn = RecordingConnection()
+    downsample.add_heart_rates(conn, rows)
+
+    for resolution in downsample.TIERS:
+        buckets = [p for p in conn.params if p['resolution'] == resolution]
+        assert len(buckets) == -(-7200 // resolution)
+        assert sum(p['sample_count'] for p in buckets) == 7200
+        assert sum(p['hr_sum'] for p in buckets) == sum(row[1] for row in rows)
+    first_minute = next(p for p in conn.params if p['resolution'] == 60)
+    assert first_minute['bucket'] == '2022-10-01 00:00:00'
+    assert (first_minute['hr_min'], first_minute['hr_max']) == (60, 109)
@@ -0,0 +1,209 @@
+"""Bulk export of heart rates, fatigue levels and activities as CSV or Parquet.
+
+Samples are read user by user, each user's range through the (user_id,
+timestamp) index, on a server-side cursor (stream_results) in chunks of
+CHUNK_ROWS rows. Every chunk is encoded and handed on before the next one
+is fetched. Memory stays at about one chunk however large the export, and
+the Flask route streams the bytes as they are produced.
+
+    python export.py heart_rate --group-id 3 --start 2022-10-01 --end 2022-11-01 -o hr.csv.gz --gzip
+    python export.py activity --format parquet -o activities.parquet
+"""
+from datetime import datetime
+
+import argparse
+import csv
+import importlib.util
+import io
+import sys
+import zlib
+
+import sqlalchemy
+
+# kind -> table and exported columns, as uploaded
+KINDS = {
+    "heart_rate": ("heart_rates", ("user_id", "heart_rate", "timestamp")),
+    "fatigue_level": ("fatigue_levels", ("user_id", "fatigue_level", "timestamp")),
+    "activity": ("activities", ("user_id", "peer_id", "timestamp", "if_open")),
+}
+FORMATS = ("csv", "parquet")
+
+# rows fetched, encoded and sent at a time
+CHUNK_ROWS = 10000
+
+# default time range, everything
+START = datetime(1970, 1, 1)
+END = datetime(9999, 12, 31)
+
+stmt_users = sqlalchemy.text("SELECT user_id FROM users ORDER BY user_id")
+stmt_group_users = sqlalchemy.text("SELECT user_id FROM users WHERE group_id=:group_id ORDER BY user_id")
+
+
+def _stmt_samples(kind: str):
+    table, columns = KINDS[kind]
+    return sqlalchemy.text(
+        f"""SELECT {', '.join(columns)} FROM {table}
+        WHERE user_id=:user_id AND timestamp >= :start AND timestamp < :end
+        ORDER BY timestamp""")
+
+
+STMT_SAMPLES = {kind: _stmt_samples(kind) for kind in KINDS}
+
+
+def chunks(conn, kind: str, start: datetime, end: datetime, group_id: str = None, user_id: int = None):
+    """Yield lists of at most CHUNK_ROWS sample rows of [start, end), user by user."""
+    if user_id is not None:
+        user_ids = [user_id]
+    elif group_id is not None:
+        user_ids = [row[0] for row in conn.execute(stmt_group_users, group_id=group_id).fetchall()]
+    else:
+        user_ids = [row[0] for row in conn.execute(stmt_users).fetchall()]
+
+    streaming = conn.execution_options(stream_results=True)
+    for uid in user_ids:
+        result = streaming.execute(STMT_SAMPLES[kind], user_id=uid, start=start, end=end)
+        try:
+            while True:
+                rows = result.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            result.close()
+
+
+def csv_encoder(kind: str):
+    """Return a function encoding a chunk of rows as CSV, and the header line."""
+    _, columns = KINDS[kind]
+
+    def encode_rows(rows) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for row in rows:
+            writer.writerow([value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else value
+                             for value in row])
+        return buffer.getvalue().encode()
+
+    return encode_rows, (",".join(columns) + "\n").encode()
+
+
+def _parquet_schema(kind: str):
+    import pyarrow as pa
+    types = {"user_id": pa.int32(), "peer_id": pa.int32(), "heart_rate": pa.int16(),
+             "fatigue_level": pa.int32(), "timestamp": pa.timestamp("s"), "if_open": pa.bool_()}
+    return pa.schema([(column, types[column]) for column in KINDS[kind][1]])
+
+
+def encode(kind: str, fmt: str, chunks, gzip: bool = False):
+    """Yield the export file of `chunks` of rows in pieces, one or so per chunk."""
+    if fmt == "parquet":
+        pieces = _parquet(kind, chunks)
+    else:
+        encode_rows, header = csv_encoder(kind)
+        pieces = _prepend(header, (encode_rows(rows) for rows in chunks))
+    if not gzip:
+        yield from pieces
+        return
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for piece in pieces:
+        compressed = compressor.compress(piece)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def check_format(fmt: str) -> None:
+    """Raise ValueError if the format is unknown or cannot be written here."""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("parquet export needs pyarrow")
+
+
+def _prepend(first, pieces):
+    yield first
+    yield from pieces
+
+
+class _Sink(io.RawIOBase):
+    """File object collecting what the Parquet writer writes until taken."""
+
+    def __init__(self) -> None:
+        self.pieces = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.pieces)
+        self.pieces = []
+        return data
+
+
+def _parquet(kind: str, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(kind)
+    sink = _Sink()
+    # one row group per chunk
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                # SQLite returns booleans as integers
+                [pa.array([bool(v) for v in values] if field.type == pa.bool_() else values, field.type)
+                 for field, values in zip(schema, columns)], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def export(conn, out, kind: str, fmt: str = "csv", start: datetime = START,
+           end: datetime = END, group_id: str = None, user_id: int = None,
+           gzip: bool = False) -> int:
+    """Write an export to the binary file `out`. Return the number of rows."""
+    count = 0
+
+    def counted(pieces):
+        nonlocal count
+        for rows in pieces:
+            count += len(rows)
+            yield rows
+
+    for piece in encode(kind, fmt, counted(chunks(conn, kind, start, end, group_id, user_id)), gzip):
+        out.write(piece)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("kind", choices=sorted(KINDS))
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--group-id")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=START,
+                        help="UTC date or time, e.g. 2022-10-01")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=END)
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("-o", "--output", help="file to write, standard output if omitted")
+    args = parser.parse_args()
+    try:
+        check_format(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    from connect import init_connection_pool
+    db = init_connection_pool()
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    with db.connect() as conn, out:
+        count = export(conn, out, args.kind, args.format, args.start, args.end,
+                       args.group_id, args.user_id, args.gzip)
+    print(f"exported {count} {args.kind} rows", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import gzip
+import io
+
+import pytest
+import sqlalchemy
+
+from connect_sqlite import connect_sqlite
+import export
+import migrations
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, add_users):
+    monkeypatch.setattr(export, "CHUNK_ROWS", 3)
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    with db.connect() as conn:
+        add_users(conn, ["a", "b"])
+        conn.execute(sqlalchemy.text(
+            "INSERT INTO heart_rates (user_id, heart_rate, timestamp) VALUES (:user_id, :heart_rate, :timestamp)"),
+            [{"user_id": user_id, "heart_rate": 60 + i, "timestamp": datetime(2022, 10, 1, 0, 0, i)}
+             for user_id in (1, 2) for i in range(5)])
+    return db
+
+
+def test_export_streams_in_chunks(db):
+    with db.connect() as conn:
+        chunks = list(export.chunks(conn, "heart_rate", export.START, export.END, group_id="a"))
+        assert [len(rows) for rows in chunks] == [3, 2]
+
+        out = io.BytesIO()
+        assert export.export(conn, out, "heart_rate", end=datetime(2022, 10, 1, 0, 0, 2), gzip=True) == 4
+    assert gzip.decompress(out.getvalue()).decode().splitlines() == [
+        "user_id,heart_rate,timestamp",
+        "1,60,2022-10-01 00:00:00",
+        "1,61,2022-10-01 00:00:01",
+        "2,60,2022-10-01 00:00:00",
+        "2,61,2022-10-01 00:00:01",
+    ]
+
+
+def test_parquet_export(db):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with db.connect() as conn:
+        pieces = list(export.encode("heart_rate", "parquet", export.chunks(
+            conn, "heart_rate", export.START, export.END, user_id=1)))
+    # the first row group is out before the second chunk is read
+    assert len(pieces) == 3 and pieces[1]
+    table = pq.ParquetFile(io.BytesIO(b"".join(pieces)))
+    assert [table.metadata.row_group(i).num_rows for i in range(table.num_row_groups)] == [3, 2]
+    assert table.read().to_pydict() == {
+        "user_id": [1] * 5,
+        "heart_rate": [60, 61, 62, 63, 64],
+        "timestamp": [datetime(2022, 10, 1, 0, 0, i) for i in range(5)],
+    }
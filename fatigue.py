@@ -1,6 +1,207 @@
 import numpy as np
 
 
+class GrowableArray:
+    """1-D float array with amortized O(1) appends.
+    Capacity doubles when full, instead of copying on every append like np.append."""
+
+    __slots__ = ("_data", "_size")
+
+    def __init__(self, capacity=1440):
+        self._data = np.empty(max(capacity, 1))
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, values):
+        values = np.ravel(values)
+        end = self._size + len(values)
+        if end > len(self._data):
+            data = np.empty(max(end, 2 * len(self._data)))
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:end] = values
+        self._size = end
+
+    def clear(self):
+        self._size = 0
+
+    @property
+    def values(self):
+        return self._data[:self._size]
+
+
+def w_exp_step(W_exp_prev, HRR, HRR_CP, K=1, R=1):
+    """Advance W_exp by one minute at heart rate reserve HRR."""
+    if HRR > HRR_CP:
+        return W_exp_prev + K * (HRR - HRR_CP)
+    # W_exp cannot be below zero.
+    return max(W_exp_prev - R * (HRR_CP - HRR), 0)
+
+
+# corrections of the cumulative-sum estimate before w_exp_recurrence finishes
+# a sequence one step at a time, which bounds its cost on adversarial input
+MAX_CORRECTIONS = 8
+# runs between clamp resets at least this long are accumulated one by one
+LONG_RUN = 256
+
+
+def _segmented_cumsum(gain, clamp, W_exp_init):
+    """Estimate the clamped recurrence of every row of the 2-D `gain`, each
+    starting from its W_exp_init.
+
+    Clamp-reset points are located with a cumulative-sum (Lindley) estimate;
+    the runs between them are accumulated exactly, each from its base (the
+    row's W_exp_init, or 0 after a reset), the long ones one by one and the
+    short ones with one np.cumsum over all runs of similar length. Exact
+    wherever the reset estimate is right."""
+    rows, n = gain.shape
+    s = np.cumsum(gain, axis=1)
+    s += W_exp_init[:, None]
+    floor = np.minimum(s, 0)
+    np.minimum.accumulate(floor, axis=1, out=floor)
+    resets = np.empty((rows, n), dtype=bool)
+    resets[:, 0] = s[:, 0] < 0
+    np.less(s[:, 1:], floor[:, :-1], out=resets[:, 1:])
+    resets &= clamp
+    resets = resets.ravel()
+
+    W_exp = np.zeros(rows * n)
+    # runs start at every row and after every reset, and stop at the next
+    # reset or the end of the row
+    starts = np.zeros(rows * n, dtype=bool)
+    starts[::n] = True
+    starts[1:] |= resets[:-1]
+    starts &= ~resets
+    first = np.flatnonzero(starts)
+    if not len(first):
+        return W_exp.reshape(rows, n)
+    stops = np.append(resets, False)
+    stops[n::n] = True
+    stops = np.flatnonzero(stops)
+    lengths = stops[np.searchsorted(stops, first, side="right")] - first
+    bases = np.where(first % n == 0, W_exp_init[first // n], 0.0)
+    d = gain.ravel()
+
+    # long runs one at a time, at most one per LONG_RUN values
+    long = lengths >= LONG_RUN
+    for a, length, base in zip(first[long], lengths[long], bases[long]):
+        W_exp[a:a + length] = np.cumsum(np.concatenate(([base], d[a:a + length])))[1:]
+
+    # short runs padded to the next power of two of their length, so at most
+    # twice the work; whatever follows a run in its window is never read
+    short = np.flatnonzero(~long)
+    d = np.concatenate((d, np.zeros(LONG_RUN)))
+    sizes = np.ceil(np.log2(lengths[short])).astype(int)
+    for size in np.unique(sizes):
+        runs = short[sizes == size]
+        width = lengths[runs].max()
+        padded = np.empty((len(runs), width + 1))
+        padded[:, 0] = bases[runs]
+        padded[:, 1:] = np.lib.stride_tricks.sliding_window_view(d, width)[first[runs]]
+        valid = np.arange(width) < lengths[runs][:, None]
+        W_exp[(first[runs][:, None] + np.arange(width))[valid]] = np.cumsum(padded, axis=1)[:, 1:][valid]
+    return W_exp.reshape(rows, n)
+
+
+def _mismatches(gain, clamp, W_exp_init, W_exp):
+    """One exact step of the recurrence from each value of the 2-D W_exp.
+    Return the expected values and where W_exp differs from them."""
+    x = np.empty_like(W_exp)
+    x[:, 0] = W_exp_init
+    x[:, 1:] = W_exp[:, :-1]
+    x += gain
+    expected = np.where(clamp & (x < 0), 0.0, x)
+    return expected, expected.view(np.int64) != W_exp.view(np.int64)
+
+
+def w_exp_recurrence(gain, clamp, W_exp_init):
+    """Compute W[i] = W[i-1] + gain[i], where steps with clamp[i] set cannot
+    take W below zero, starting from W[-1] = W_exp_init.
+
+    Bit-identical to evaluating the recurrence one element at a time. The
+    segmented cumulative sum of _segmented_cumsum is checked against one exact
+    step of the recurrence; the first mismatch, if any, is corrected and
+    evaluation resumes from there. Past MAX_CORRECTIONS, the rest is stepped
+    one element at a time.
+    """
+    gain = np.asarray(gain, dtype=float)
+    clamp = np.asarray(clamp, dtype=bool)
+    W_exp = np.empty(len(gain))
+    start = 0
+    w = float(W_exp_init)
+
+    for _ in range(MAX_CORRECTIONS + 1):
+        if start == len(gain):
+            return W_exp
+        d = gain[None, start:]
+        c = clamp[None, start:]
+        out = _segmented_cumsum(d, c, np.array([w]))
+        expected, mismatch = _mismatches(d, c, np.array([w]), out)
+        W_exp[start:] = out[0]
+        wrong = np.flatnonzero(mismatch[0])
+        if not len(wrong):
+            return W_exp
+        q = wrong[0]
+        W_exp[start + q] = w = expected[0, q]
+        start += q + 1
+
+    for i in range(start, len(gain)):
+        x = w + gain[i]
+        w = W_exp[i] = 0.0 if clamp[i] and x < 0 else x
+    return W_exp
+
+
+def fatigue_assess_batch(HR, Rest_HR, Max_HR, HRR_CP, W_exp_init, K=1, R=1, chunk=1024):
+    """Evaluate the W' balance of many users at once.
+
+    HR is a (users x minutes) array; the parameters are scalars or per-user
+    arrays of length `users`. Return the (users x minutes) W_exp array,
+    bit-identical to Fatigue.fatigue_assess run on each user's row of HR
+    given as int64 or float64. Every `chunk` minutes of all users are
+    evaluated with one segmented cumulative sum (see w_exp_recurrence); the
+    rare users whose estimate needs a correction are finished one by one.
+    """
+    HR = np.asarray(HR)
+    users, minutes = HR.shape
+
+    def column(value):
+        return np.broadcast_to(np.asarray(value, dtype=float), (users,))[:, None]
+
+    Rest_HR, Max_HR, HRR_CP, K, R = column(Rest_HR), column(Max_HR), column(HRR_CP), column(K), column(R)
+
+    W_exp = np.empty((users, minutes))
+    if not minutes:
+        return W_exp
+    w = np.array(column(W_exp_init)[:, 0])
+
+    for begin in range(0, minutes, chunk):
+        end = min(begin + chunk, minutes)
+        HRR = (HR[:, begin:end] - Rest_HR) / (Max_HR - Rest_HR) * 100
+        above = HRR > HRR_CP
+        gain = np.where(above, K * (HRR - HRR_CP), -(R * (HRR_CP - HRR)))
+        out = W_exp[:, begin:end]
+        if begin == 0:
+            # the first minute is never reduced, only increased above HRR_CP
+            out[:, 0] = np.where(above[:, 0], w + gain[:, 0], w)
+            w = out[:, 0].copy()
+            gain, above, out = gain[:, 1:], above[:, 1:], out[:, 1:]
+            if not out.shape[1]:
+                break
+        clamp = ~above
+
+        out[:] = _segmented_cumsum(gain, clamp, w)
+        expected, mismatch = _mismatches(gain, clamp, w, out)
+        for u in np.flatnonzero(mismatch.any(axis=1)):
+            q = np.flatnonzero(mismatch[u])[0]
+            out[u, q] = expected[u, q]
+            out[u, q + 1:] = w_exp_recurrence(gain[u, q + 1:], clamp[u, q + 1:], out[u, q])
+        w = out[:, -1].copy()
+
+    return W_exp
+
+
 class Fatigue:
     def __init__(self, username):
         self.username = username
@@ -18,15 +219,41 @@ class Fatigue:
         self.K = 1
         self.R = 1    # will be th e set 1 for the same reasons as k.
 
-        self.W_exp_today = []
+        # WBF of every minute assessed today
+        self._W_exp_today = GrowableArray()
+
+    @classmethod
+    def from_user(cls, user):
+        """Create the model of a row of the users table."""
+        fatigue = cls(f"{user['first_name']} {user['last_name']}")
+        fatigue.age = user['age']
+        fatigue.HRR_CP = user['hrr_cp']
+        fatigue.W_total = user['awc_tot']
+        fatigue.Rest_HR = user['rest_heart_rate']
+        fatigue.Max_HR = user['max_heart_rate']
+        fatigue.K = user['k_value']
+        return fatigue
+
+    @property
+    def W_exp_today(self):
+        return self._W_exp_today.values
+
+    @W_exp_today.setter
+    def W_exp_today(self, values):
+        self._W_exp_today.clear()
+        self._W_exp_today.extend(values)
 
     def fatigue_assess(self, HR, Num_session, W_exp_init):
+        """Append the WBF of each minute of HR to W_exp_today.
+        Return W_exp, whose last value initializes the next session."""
 
         # Heart rate reserve for each minute
-        HRR = (HR - self.Rest_HR) / (self.Max_HR - self.Rest_HR) * 100
+        HRR = (np.ravel(HR) - self.Rest_HR) / (self.Max_HR - self.Rest_HR) * 100
 
-        len_ = len(HR)
+        len_ = len(HRR)
         W_exp = np.zeros(len_)  # empty array to record W_exp for each minute
+        if not len_:
+            return W_exp
 
         # if Num_session == 0:
         #     W_exp_init = 0
@@ -41,17 +268,29 @@ class Fatigue:
         else:
             W_exp[0] = W_exp_init
 
-        for i in range(1, len_):
-            if HRR[i] > self.HRR_CP:
-                W_exp[i] = W_exp[i - 1] + self.K * (HRR[i] - self.HRR_CP)
-
-            else:
-                # W_exp cannot be below zero.
-                W_exp[i] = max(W_exp[i - 1] - self.R * (self.HRR_CP - HRR[i]), 0)
+        # W_exp grows by K per HRR point above HRR_CP and recovers by R per
+        # point below it, but cannot be below zero.
+        above = HRR[1:] > self.HRR_CP
+        gain = np.where(above, self.K * (HRR[1:] - self.HRR_CP), -(self.R * (self.HRR_CP - HRR[1:])))
+        W_exp[1:] = w_exp_recurrence(gain, ~above, W_exp[0])
 
         WBF = W_exp / self.W_total
 
-        self.W_exp_today = np.append(self.W_exp_today, WBF)
+        self._W_exp_today.extend(WBF)
+        return W_exp
+
+    def fatigue_continue(self, HR, W_exp_prev):
+        """Like fatigue_assess, but every minute of HR, including the first,
+        is one regular step on from W_exp_prev, the W_exp of the minute before.
+        A stream split at arbitrary points gives the same result as a whole."""
+        HRR = (np.ravel(HR) - self.Rest_HR) / (self.Max_HR - self.Rest_HR) * 100
+
+        above = HRR > self.HRR_CP
+        gain = np.where(above, self.K * (HRR - self.HRR_CP), -(self.R * (self.HRR_CP - HRR)))
+        W_exp = w_exp_recurrence(gain, ~above, W_exp_prev)
+
+        self._W_exp_today.extend(W_exp / self.W_total)
+        return W_exp
 
 
 def main():
@@ -0,0 +1,155 @@
+"""Incremental server-side fatigue computation from stored heart rates.
+
+Each run averages the heart rates uploaded since a user's watermark into
+one value per minute, continues that user's W' balance from the last stored
+W_exp and writes one fatigue level per minute to fatigue_levels, the latest
+one to users.fatigue_level, and the new W_exp and watermark to fatigue_state.
+Work per run is proportional to the new samples, not to the history.
+
+    python fatigue_pipeline.py    # run once, e.g. from cron
+"""
+from datetime import datetime, timedelta, timezone
+
+import logging
+import threading
+
+import numpy as np
+import sqlalchemy
+
+import dialect
+from fatigue import Fatigue
+import ingest
+
+logger = logging.getLogger()
+
+# a gap without samples longer than this starts over from a rested W_exp of 0
+RESET_GAP = timedelta(hours=4)
+
+# minutes newer than this are left for the next run, so late uploads still make it
+LAG = timedelta(seconds=30)
+
+stmt_users = sqlalchemy.text(
+    """SELECT u.user_id, u.first_name, u.last_name, u.age, u.max_heart_rate,
+    u.rest_heart_rate, u.hrr_cp, u.awc_tot, u.k_value,
+    s.w_exp, s.last_minute, s.watermark
+    FROM users u LEFT JOIN fatigue_state s ON s.user_id = u.user_id""")
+stmt_heart_rates = sqlalchemy.text(
+    """SELECT heart_rate, timestamp FROM heart_rates
+    WHERE user_id=:user_id AND timestamp >= :since AND timestamp < :until
+    ORDER BY timestamp""")
+stmt_state = dialect.upsert(
+    """INSERT INTO fatigue_state (user_id, w_exp, last_minute, watermark)
+    VALUES (:user_id, :w_exp, :last_minute, :watermark)""",
+    ("user_id",),
+    {"w_exp": "excluded.w_exp", "last_minute": "excluded.last_minute", "watermark": "excluded.watermark"})
+
+
+def fatigue_level(W_exp, W_total):
+    """Fatigue level reported to peers: W' expended as a percentage of AWC."""
+    return int(round(100 * W_exp / W_total))
+
+
+def minute_heart_rates(rows):
+    """Average (heart_rate, timestamp) rows sorted by time into one value per minute.
+    Return the unix minute numbers and their mean heart rates."""
+    hr = np.array([row[0] for row in rows], dtype=float)
+    minutes = np.array(
+        [int(row[1].replace(tzinfo=timezone.utc).timestamp()) // 60 for row in rows])
+    minutes, first = np.unique(minutes, return_index=True)
+    counts = np.diff(np.append(first, len(hr)))
+    return minutes, np.add.reduceat(hr, first) / counts
+
+
+def process_user(conn, user, until: datetime) -> int:
+    """Compute fatigue from the heart rates of one user between the watermark and `until`.
+    Return the number of minutes written."""
+    since = user['watermark'] or datetime(1970, 1, 1)
+    rows = conn.execute(stmt_heart_rates, user_id=user['user_id'], since=since, until=until).fetchall()
+    if not rows:
+        return 0
+
+    minutes, hr = minute_heart_rates(rows)
+
+    # continue from the stored W_exp unless the user has rested in between
+    last_minute = minutes[0]
+    if user['last_minute'] is not None:
+        last_minute = int(user['last_minute'].replace(tzinfo=timezone.utc).timestamp()) // 60
+    reset = np.diff(np.concatenate(([last_minute], minutes))) > RESET_GAP.total_seconds() // 60
+    bounds = np.unique(np.concatenate(([0], np.flatnonzero(reset), [len(hr)])))
+
+    model = Fatigue.from_user(user)
+    W_exp = np.empty(len(hr))
+    W_exp_prev = user['w_exp'] or 0.0
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        if reset[begin]:
+            W_exp_prev = 0.0
+        W_exp[begin:end] = model.fatigue_continue(hr[begin:end], W_exp_prev)
+        W_exp_prev = W_exp[end - 1]
+
+    fatigue_rows = [{
+        "user_id": user['user_id'],
+        "fatigue_level": fatigue_level(w, model.W_total),
+        "timestamp": ingest.to_datetime(int(minute) * 60),
+    } for minute, w in zip(minutes, W_exp)]
+
+    # the fatigue levels and the new state in one transaction
+    state = {
+        "user_id": user['user_id'],
+        "w_exp": float(W_exp[-1]),
+        "last_minute": fatigue_rows[-1]['timestamp'],
+        "watermark": until,
+    }
+    ingest.execute_plan(conn, ingest.plan_fatigue_levels(fatigue_rows) + [(stmt_state, [state])])
+    return len(fatigue_rows)
+
+
+def run(db: sqlalchemy.engine.base.Engine, now: datetime = None) -> int:
+    """Process every user with new heart rates. Return the number of minutes written."""
+    now = now or datetime.utcnow()
+    until = (now - LAG).replace(second=0, microsecond=0)
+    written = 0
+    with db.connect() as conn:
+        # only one worker runs the pipeline at a time
+        with dialect.named_lock(conn, "fatigue_pipeline") as acquired:
+            if not acquired:
+                return 0
+            for user in conn.execute(stmt_users).fetchall():
+                try:
+                    written += process_user(conn, user, until)
+                except Exception as e:
+                    logger.exception(e)
+    return written
+
+
+class FatiguePipeline:
+    """Background thread running the pipeline every `interval` seconds."""
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, interval: float) -> None:
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fatigue-pipeline", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                run(self.db)
+            except Exception as e:
+                logger.exception(e)
+
+
+def main():
+    from connect import init_connection_pool
+    written = run(init_connection_pool())
+    print(f"wrote {written} fatigue levels")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""In-process registry of per-user streaming fatigue state.
+
+Every uploaded heart rate updates its user's state in O(1): samples are
+summed per minute and, once a minute is complete, its mean advances W_exp by
+one step, exactly as fatigue_pipeline does for stored heart rates. The current
+fatigue level is therefore available without reading any history. Inactive
+users are evicted (LRU with TTL) and reloaded from the database on a miss;
+a profile update marks the user's parameters for reloading (`invalidate`).
+
+The state is not shared between processes: every sample of a user must reach
+the same registry, so the app runs it in a single worker (see app.start).
+"""
+from collections import OrderedDict
+from datetime import timezone
+
+import os
+import threading
+import time
+
+import sqlalchemy
+
+from fatigue import w_exp_step
+from fatigue_pipeline import RESET_GAP, fatigue_level
+
+stmt_load = sqlalchemy.text(
+    """SELECT u.max_heart_rate, u.rest_heart_rate, u.hrr_cp, u.awc_tot, u.k_value,
+    s.w_exp, s.last_minute
+    FROM users u LEFT JOIN fatigue_state s ON s.user_id = u.user_id
+    WHERE u.user_id=:user_id""")
+
+
+class UserFatigueState:
+    """Fatigue parameters and running W' balance of one user."""
+
+    __slots__ = ("Rest_HR", "Max_HR", "HRR_CP", "W_total", "K", "R",
+                 "W_exp", "minute", "pending", "hr_sum", "hr_count", "last_seen", "stale")
+
+    def __init__(self, Rest_HR, Max_HR, HRR_CP, W_total, K, R=1, W_exp=0.0, minute=None):
+        self.Rest_HR = Rest_HR
+        self.Max_HR = Max_HR
+        self.HRR_CP = HRR_CP
+        self.W_total = W_total
+        self.K = K
+        self.R = R
+        # W_exp at the end of `minute`, the last complete minute
+        self.W_exp = W_exp
+        self.minute = minute
+        # heart rates of the minute in progress
+        self.pending = None
+        self.hr_sum = 0
+        self.hr_count = 0
+        self.last_seen = 0.0
+        # the profile changed since the parameters were loaded
+        self.stale = False
+
+    def set_parameters(self, other: "UserFatigueState") -> None:
+        """Take the fatigue parameters of `other`, keeping the running W' balance."""
+        self.Rest_HR = other.Rest_HR
+        self.Max_HR = other.Max_HR
+        self.HRR_CP = other.HRR_CP
+        self.W_total = other.W_total
+        self.K = other.K
+        self.stale = False
+
+    @property
+    def fatigue_level(self) -> int:
+        return fatigue_level(self.W_exp, self.W_total)
+
+    def update(self, heart_rate: int, timestamp: int) -> None:
+        minute = timestamp // 60
+        if self.pending is not None:
+            if minute < self.pending:
+                return  # late sample of a completed minute
+            if minute > self.pending:
+                self._complete()
+        elif self.minute is not None and minute <= self.minute:
+            return  # already accounted for
+
+        if self.pending is None:
+            # a long rest starts over from a W_exp of 0, as in fatigue_pipeline
+            if self.minute is not None and minute - self.minute > RESET_GAP.total_seconds() // 60:
+                self.W_exp = 0.0
+            self.pending = minute
+        self.hr_sum += heart_rate
+        self.hr_count += 1
+
+    def _complete(self) -> None:
+        HRR = (self.hr_sum / self.hr_count - self.Rest_HR) / (self.Max_HR - self.Rest_HR) * 100
+        self.W_exp = w_exp_step(self.W_exp, HRR, self.HRR_CP, self.K, self.R)
+        self.minute = self.pending
+        self.pending = None
+        self.hr_sum = 0
+        self.hr_count = 0
+
+
+class FatigueRegistry:
+    """LRU map of user_id to UserFatigueState, bounded in size and idle time."""
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, max_users: int = 10000,
+                 ttl: float = 3600.0) -> None:
+        self.db = db
+        self.max_users = max_users
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls, db: sqlalchemy.engine.base.Engine) -> "FatigueRegistry":
+        return cls(
+            db,
+            max_users=int(os.environ.get("FATIGUE_STREAMING_MAX_USERS", 10000)),
+            ttl=float(os.environ.get("FATIGUE_STREAMING_TTL", 3600)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get(self, user_id: int):
+        """Return the state of a user, loading it on a miss; None for unknown users."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None and not state.stale:
+                self._states.move_to_end(user_id)
+                state.last_seen = now
+                self.hits += 1
+                return state
+            self.misses += 1
+
+        # load outside the lock so a slow query does not stall other users
+        loaded = self._load(user_id)
+        with self._lock:
+            if loaded is None:
+                self._states.pop(user_id, None)
+                return None
+            state = self._states.setdefault(user_id, loaded)
+            if state.stale:
+                state.set_parameters(loaded)
+            self._states.move_to_end(user_id)
+            state.last_seen = now
+            self._evict(now)
+        return state
+
+    def invalidate(self, user_id: int) -> None:
+        """Reload the parameters of a user whose profile changed on their next sample.
+        Active users are never evicted, so they would otherwise keep the old ones."""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is not None:
+                state.stale = True
+
+    def update(self, user_id: int, heart_rate: int, timestamp: int):
+        """Feed one heart rate sample. Return the user's state, or None if unknown."""
+        state = self.get(user_id)
+        if state is not None:
+            with self._lock:
+                state.update(heart_rate, timestamp)
+        return state
+
+    def _load(self, user_id: int):
+        with self.db.connect() as conn:
+            row = conn.execute(stmt_load, user_id=user_id).fetchone()
+        if row is None:
+            return None
+        minute = None
+        if row['last_minute'] is not None:
+            minute = int(row['last_minute'].replace(tzinfo=timezone.utc).timestamp()) // 60
+        return UserFatigueState(row['rest_heart_rate'], row['max_heart_rate'], row['hrr_cp'],
+                                row['awc_tot'], row['k_value'],
+                                W_exp=row['w_exp'] or 0.0, minute=minute)
+
+    def _evict(self, now: float) -> None:
+        while self._states:
+            user_id, oldest = next(iter(self._states.items()))
+            if len(self._states) <= self.max_users and now - oldest.last_seen < self.ttl:
+                break
+            del self._states[user_id]
+            self.evictions += 1
@@ -0,0 +1,205 @@
+import numpy as np
+
+import pytest
+
+import fatigue
+from fatigue import Fatigue, GrowableArray, fatigue_assess_batch
+
+
+# the original per-minute loop of Fatigue.fatigue_assess
+def reference_w_exp(HR, Rest_HR, Max_HR, HRR_CP, K, R, W_exp_init):
+    HRR = (HR - Rest_HR) / (Max_HR - Rest_HR) * 100
+    W_exp = np.zeros(len(HR))
+    if HRR[0] > HRR_CP:
+        W_exp[0] = W_exp_init + K * (HRR[0] - HRR_CP)
+    else:
+        W_exp[0] = W_exp_init
+    for i in range(1, len(HR)):
+        if HRR[i] > HRR_CP:
+            W_exp[i] = W_exp[i - 1] + K * (HRR[i] - HRR_CP)
+        else:
+            W_exp[i] = max(W_exp[i - 1] - R * (HRR_CP - HRR[i]), 0)
+    return W_exp
+
+
+def random_walk(rng, users, minutes, start=70):
+    steps = rng.normal(scale=4, size=(users, minutes))
+    return np.clip(start + np.cumsum(steps, axis=1), 40, 200)
+
+
+def assert_bit_identical(actual, expected):
+    assert actual.shape == expected.shape
+    assert (actual.view(np.int64) == expected.view(np.int64)).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fatigue_assess_matches_loop(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    HR = random_walk(rng, 1, 2000)[0]
+    john = Fatigue("John")
+
+    W_exp = john.fatigue_assess(HR, 1, 3)
+
+    expected = reference_w_exp(HR, john.Rest_HR, john.Max_HR, john.HRR_CP, john.K, john.R, 3)
+    assert_bit_identical(W_exp, expected)
+    assert_bit_identical(john.W_exp_today, expected / john.W_total)
+
+
+def test_fatigue_assess_integer_heart_rates_at_threshold() -> None:
+    # integer HR sitting exactly on HRR_CP exercises -0.0 gains and resets
+    john = Fatigue("John")
+    cp_hr = john.Rest_HR + john.HRR_CP * (john.Max_HR - john.Rest_HR) / 100
+    HR = np.array([60, 120, int(cp_hr), 40, 40, 150, 41, 200, 50] * 50)
+
+    W_exp = john.fatigue_assess(HR, 1, 0)
+
+    expected = reference_w_exp(HR, john.Rest_HR, john.Max_HR, john.HRR_CP, john.K, john.R, 0)
+    assert_bit_identical(W_exp, expected)
+
+
+def test_fatigue_assess_appends_sessions() -> None:
+    rng = np.random.default_rng(7)
+    john = Fatigue("John")
+    sessions = [random_walk(rng, 1, 30)[0] for _ in range(100)]
+
+    W_exp_init = 0
+    expected = []
+    for num_session, HR in enumerate(sessions):
+        expected.append(reference_w_exp(HR, john.Rest_HR, john.Max_HR, john.HRR_CP,
+                                        john.K, john.R, W_exp_init))
+        W_exp_init = john.fatigue_assess(HR, num_session, W_exp_init)[-1]
+
+    assert len(john.W_exp_today) == 3000
+    assert_bit_identical(john.W_exp_today, np.concatenate(expected) / john.W_total)
+
+
+def test_fatigue_assess_batch_matches_loop() -> None:
+    rng = np.random.default_rng(11)
+    users, minutes = 6, 1500
+    HR = np.rint(random_walk(rng, users, minutes)).astype(np.uint8)
+    Rest_HR = rng.integers(40, 70, users)
+    Max_HR = 200 - 0.7 * rng.integers(20, 60, users)
+    HRR_CP = rng.integers(20, 35, users)
+    K = rng.integers(1, 3, users)
+    W_exp_init = rng.random(users) * 50
+
+    W_exp = fatigue_assess_batch(HR, Rest_HR, Max_HR, HRR_CP, W_exp_init, K=K, chunk=256)
+
+    for u in range(users):
+        expected = reference_w_exp(HR[u].astype(int), Rest_HR[u], Max_HR[u], HRR_CP[u], K[u], 1, W_exp_init[u])
+        assert_bit_identical(np.ascontiguousarray(W_exp[u]), expected)
+
+
+@pytest.mark.parametrize("pattern", [[-1e15, -0.7], [-1e17, 0.5, -0.7]])
+def test_w_exp_recurrence_bounds_corrections(pattern, monkeypatch) -> None:
+    # at this magnitude the cumulative sum absorbs the small recoveries, so
+    # the reset estimate is wrong again after every correction
+    gain = np.tile(pattern, 3000)
+    calls = []
+    segmented_cumsum = fatigue._segmented_cumsum
+    monkeypatch.setattr(fatigue, "_segmented_cumsum", lambda *args: calls.append(1) or segmented_cumsum(*args))
+
+    W_exp = fatigue.w_exp_recurrence(gain, gain < 0, 0.0)
+
+    expected = np.empty(len(gain))
+    w = 0.0
+    for i, g in enumerate(gain):
+        w = expected[i] = max(w + g, 0) if g < 0 else w + g
+    assert_bit_identical(W_exp, expected)
+    assert len(calls) == fatigue.MAX_CORRECTIONS + 1
+
+
+def test_growable_array() -> None:
+    buffer = GrowableArray(capacity=2)
+    buffer.extend([1.0, 2.0])
+    buffer.extend(np.arange(5.0))
+    assert len(buffer) == 7
+    assert buffer.values.tolist() == [1.0, 2.0, 0.0, 1.0, 2.0, 3.0, 4.0]
+
+
+def test_streaming_state_matches_minute_batches() -> None:
+    from fatigue_pipeline import fatigue_level
+    from fatigue_registry import UserFatigueState
+
+    rng = np.random.default_rng(3)
+    HR = np.rint(random_walk(rng, 1, 3600)[0]).astype(int)
+    john = Fatigue("John")
+    state = UserFatigueState(john.Rest_HR, john.Max_HR, john.HRR_CP, john.W_total, john.K)
+
+    levels = []
+    for second, heart_rate in enumerate(HR):
+        state.update(int(heart_rate), 1658863200 + second)
+        if second % 60 == 59:
+            levels.append(state.fatigue_level)
+    # the last minute completes with the first sample of the next one
+    state.update(70, 1658863200 + 3600)
+    levels = levels[1:] + [state.fatigue_level]
+
+    W_exp = john.fatigue_continue(HR.reshape(60, 60).mean(axis=1), 0.0)
+    assert levels == [fatigue_level(w, john.W_total) for w in W_exp]
+
+
+def test_pipeline_writes_levels_and_state(tmp_path, add_users) -> None:
+    from datetime import datetime, timedelta
+
+    from connect_sqlite import connect_sqlite
+    import fatigue_pipeline
+    import migrations
+
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    start = datetime(2022, 10, 1, 12)
+    with db.connect() as conn:
+        add_users(conn)
+        conn.execute("INSERT INTO heart_rates (user_id, heart_rate, timestamp) VALUES (1, :heart_rate, :timestamp)",
+                     [{"heart_rate": 150, "timestamp": start + timedelta(seconds=second)} for second in range(600)])
+
+    assert fatigue_pipeline.run(db, now=start + timedelta(minutes=20)) == 10
+    # nothing new since the watermark
+    assert fatigue_pipeline.run(db, now=start + timedelta(minutes=21)) == 0
+    with db.connect() as conn:
+        levels = [row[0] for row in conn.execute("SELECT fatigue_level FROM fatigue_levels ORDER BY timestamp")]
+        state = conn.execute("SELECT w_exp, last_minute, watermark FROM fatigue_state WHERE user_id=1").fetchone()
+        current = conn.execute("SELECT fatigue_level FROM users WHERE user_id=1").scalar()
+    assert len(levels) == 10 and levels == sorted(levels) and current == levels[-1]
+    assert state[1] == start + timedelta(minutes=9)
+    assert state[2] == start + timedelta(minutes=19)
+
+
+def test_registry_evicts_and_reloads(tmp_path, monkeypatch, add_users) -> None:
+    from connect_sqlite import connect_sqlite
+    import fatigue_registry
+    import migrations
+
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    with db.connect() as conn:
+        add_users(conn, ["a"] * 3)
+        conn.execute("""INSERT INTO fatigue_state (user_id, w_exp, last_minute, watermark)
+            VALUES (1, 50.0, '2022-07-26 19:59:00', '2022-07-26 20:00:00')""")
+
+    clock = [0.0]
+    monkeypatch.setattr(fatigue_registry.time, "monotonic", lambda: clock[0])
+    registry = fatigue_registry.FatigueRegistry(db, max_users=2, ttl=60)
+    assert registry.get(99) is None
+
+    # loaded from fatigue_state
+    state = registry.get(1)
+    assert (state.W_exp, state.minute, state.fatigue_level) == (50.0, 1658865540 // 60, 50)
+    registry.update(1, 150, 1658865600)
+    assert registry.get(1) is state and registry.hits == 2
+
+    # over max_users, the least recently used is evicted
+    registry.get(2)
+    registry.get(1)
+    registry.get(3)
+    assert len(registry) == 2 and registry.evictions == 1
+    assert registry.get(1) is state
+
+    # idle for ttl seconds, evicted by the next load, then reloaded as stored
+    clock[0] = 61
+    misses = registry.misses
+    registry.get(2)
+    assert len(registry) == 1 and registry.misses == misses + 1
+    reloaded = registry.get(1)
+    assert reloaded is not state and reloaded.W_exp == 50.0 and reloaded.pending is None
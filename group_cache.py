@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+import hashlib
+import threading
+import time
+
+
+class GroupCache:
+    """Short-lived cache of rendered peer group responses, keyed by group_id.
+
+    Entries expire after `ttl` seconds and are dropped explicitly whenever a
+    member's profile changes. Each entry also records the `version` of the
+    group it was read at, e.g. a fingerprint of its members' last_update, and
+    is only served while the caller still sees that version, so fatigue
+    levels written by any process show up on the next request. Each entry
+    carries an ETag so unchanged dashboards can be answered with 304 Not
+    Modified.
+
+    Members are only tracked while their group is cached, and only the
+    `max_groups` most recent invalidations are remembered; groups invalidated
+    before them share `_floor`, the generation of the last one forgotten.
+    """
+
+    def __init__(self, ttl: float = 5.0, max_groups: int = 1000) -> None:
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self._entries = OrderedDict()  # group_id -> (expires, etag, body, user_ids, version)
+        self._members = {}  # user_id -> cached group_id the user is listed in
+        self._generations = OrderedDict()  # group_id -> generation of its last invalidation
+        self._generation = 0  # generations are numbered across groups
+        self._floor = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return hashlib.sha1(body).hexdigest()
+
+    def get(self, group_id: str, version=None):
+        """Return (etag, body) of a fresh entry read at `version`, or None."""
+        with self._lock:
+            entry = self._entries.get(group_id)
+            if entry is None or entry[0] < time.monotonic() or entry[4] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(group_id)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def token(self, group_id: str) -> int:
+        """Take before querying the database and hand to `put`, so a response
+        read before an invalidation is not cached after it."""
+        with self._lock:
+            return self._generations.get(group_id, self._floor)
+
+    def put(self, group_id: str, body: bytes, user_ids: list, token: int, version=None) -> str:
+        """Cache the response body of a group and its members, read at
+        `version`. Return its ETag."""
+        etag = self.etag(body)
+        user_ids = [int(user_id) for user_id in user_ids]
+        with self._lock:
+            if self._generations.get(group_id, self._floor) != token:
+                return etag
+            self._remove(group_id)
+            self._entries[group_id] = (time.monotonic() + self.ttl, etag, body, user_ids, version)
+            for user_id in user_ids:
+                self._members[user_id] = group_id
+            while len(self._entries) > self.max_groups:
+                self._remove(next(iter(self._entries)))
+        return etag
+
+    def invalidate_group(self, group_id: str) -> None:
+        with self._lock:
+            self._drop(group_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop the group the user was last listed in, if any."""
+        with self._lock:
+            group_id = self._members.get(int(user_id))
+            if group_id is not None:
+                self._drop(group_id)
+
+    def _drop(self, group_id: str) -> None:
+        self._remove(group_id)
+        self._generation += 1
+        self._generations[group_id] = self._generation
+        self._generations.move_to_end(group_id)
+        while len(self._generations) > self.max_groups:
+            _, self._floor = self._generations.popitem(last=False)
+
+    def _remove(self, group_id: str) -> None:
+        entry = self._entries.pop(group_id, None)
+        if entry is None:
+            return
+        for user_id in entry[3]:
+            if self._members.get(user_id) == group_id:
+                del self._members[user_id]
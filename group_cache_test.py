@@ -0,0 +1,81 @@
+import group_cache
+from group_cache import GroupCache
+
+
+def test_hit_miss_and_etag():
+    cache = GroupCache(ttl=5)
+    assert cache.get("a") is None
+    etag = cache.put("a", b'{"peers": []}', [1, 2], cache.token("a"))
+    assert etag == GroupCache.etag(b'{"peers": []}')
+    assert cache.get("a") == (etag, b'{"peers": []}')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_expire(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(group_cache.time, "monotonic", lambda: clock[0])
+    cache = GroupCache(ttl=5)
+    cache.put("a", b"body", [1], cache.token("a"))
+    clock[0] = 5
+    assert cache.get("a") is not None
+    clock[0] = 5.1
+    assert cache.get("a") is None
+
+
+def test_invalidation():
+    cache = GroupCache()
+    cache.put("a", b"a", [1, 2], cache.token("a"))
+    cache.put("b", b"b", [3], cache.token("b"))
+    cache.invalidate_user(2)
+    assert cache.get("a") is None and cache.get("b") is not None
+    cache.invalidate_group("b")
+    assert cache.get("b") is None
+    # unknown users and groups are fine
+    cache.invalidate_user(99)
+    cache.invalidate_group("c")
+
+
+def test_response_read_before_an_invalidation_is_not_cached():
+    cache = GroupCache()
+    token = cache.token("a")
+    cache.invalidate_group("a")
+    cache.put("a", b"stale", [1], token)
+    assert cache.get("a") is None
+    cache.put("a", b"fresh", [1], cache.token("a"))
+    assert cache.get("a")[1] == b"fresh"
+
+
+def test_bookkeeping_is_bounded():
+    cache = GroupCache(max_groups=10)
+    for n in range(1000):
+        group_id = str(n)
+        cache.put(group_id, b"body", [2 * n, 2 * n + 1], cache.token(group_id))
+        cache.invalidate_group(str(n - 5))
+    assert len(cache._entries) == 5
+    assert len(cache._members) == 10
+    assert len(cache._generations) == 10
+
+    # a forgotten invalidation still prevents caching a response read before it
+    token = cache.token("x")
+    cache.invalidate_group("x")
+    for n in range(20):
+        cache.invalidate_group(f"y{n}")
+    assert "x" not in cache._generations
+    cache.put("x", b"stale", [1], token)
+    assert cache.get("x") is None
+
+    # moving a user to another group keeps the new membership
+    cache.put("p", b"p", [7], cache.token("p"))
+    cache.put("q", b"q", [7], cache.token("q"))
+    cache.invalidate_group("p")
+    cache.invalidate_user(7)
+    assert cache.get("q") is None
+
+
+def test_entries_are_served_at_their_version():
+    cache = GroupCache()
+    cache.put("a", b"a", [1], cache.token("a"), version=(1, 100))
+    assert cache.get("a", (1, 100)) is not None
+    # e.g. a member's fatigue level written by another process
+    assert cache.get("a", (1, 160)) is None
+    assert cache.get("a") is None
@@ -0,0 +1,36 @@
+# gunicorn picks this file up automatically from the working directory.
+import os
+import sys
+
+import db_pool
+
+# the connection pool of each worker is sized from these, see db_pool.py
+workers = db_pool.workers()
+threads = db_pool.threads()
+
+# workers import the app and connect after the fork, never sharing a pool or a thread
+preload_app = False
+
+
+def on_starting(server):
+    # apply pending migrations once, in the master, rather than in every worker
+    if os.environ.get("MIGRATE_ON_START", "1") == "0":
+        return
+    from connect import init_connection_pool
+    import migrations
+    import partitions
+    db = init_connection_pool()
+    try:
+        migrations.migrate(db)
+        if not os.environ.get("PARTITION_MAINTENANCE_INTERVAL"):
+            partitions.maintain(db)
+    finally:
+        db.dispose()
+    os.environ["MIGRATE_ON_START"] = "0"
+
+
+def worker_exit(server, worker):
+    # flush samples still held by the write-behind buffer before the worker goes away
+    app = sys.modules.get("app")
+    if app is not None and app.write_buffer is not None:
+        app.write_buffer.close()
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+import threading
+
+# columns identifying a sample, as in the unique keys of the sample tables
+KEY_COLUMNS = {
+    "heart_rate": ("user_id", "timestamp"),
+    "fatigue_level": ("user_id", "timestamp"),
+    "activity": ("user_id", "peer_id", "timestamp"),
+}
+
+
+class RecentKeys:
+    """LRU set of the keys of recently written samples.
+
+    Retried uploads are dropped here before they reach the database, which
+    skips them anyway thanks to the unique keys. Keys are remembered only once
+    their samples are written, so a failed upload can always be retried.
+    """
+
+    def __init__(self, max_keys: int = 100000) -> None:
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.duplicates = 0
+
+    @staticmethod
+    def key(kind: str, row: dict) -> tuple:
+        return (kind,) + tuple(row[column] for column in KEY_COLUMNS[kind])
+
+    def filter(self, kind: str, rows: list) -> list:
+        """Return the rows neither written recently nor repeated earlier in `rows`."""
+        fresh = []
+        batch = set()
+        with self._lock:
+            for row in rows:
+                key = self.key(kind, row)
+                if key in self._keys or key in batch:
+                    self.duplicates += 1
+                    continue
+                batch.add(key)
+                fresh.append(row)
+        return fresh
+
+    def add(self, kind: str, rows: list) -> None:
+        """Remember the rows as written."""
+        with self._lock:
+            for row in rows:
+                key = self.key(kind, row)
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
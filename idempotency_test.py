@@ -0,0 +1,30 @@
+from idempotency import RecentKeys
+
+
+def row(timestamp, user_id=1):
+    return {"user_id": user_id, "heart_rate": 80, "timestamp": timestamp}
+
+
+def test_filter_drops_written_and_repeated_rows():
+    keys = RecentKeys(max_keys=10)
+    rows = [row("2022-07-14 05:30:14"), row("2022-07-14 05:30:14"), row("2022-07-14 05:30:15")]
+    fresh = keys.filter("heart_rate", rows)
+    assert fresh == [rows[0], rows[2]]
+
+    # nothing is remembered until written, so a failed write can be retried
+    assert keys.filter("heart_rate", rows[:1]) == rows[:1]
+    keys.add("heart_rate", fresh)
+    assert keys.filter("heart_rate", rows + [row("2022-07-14 05:30:15", user_id=2)]) == \
+        [row("2022-07-14 05:30:15", user_id=2)]
+    # kinds do not share keys
+    assert len(keys.filter("fatigue_level", [{"user_id": 1, "fatigue_level": 5,
+                                              "timestamp": "2022-07-14 05:30:14"}])) == 1
+    assert keys.duplicates == 4
+
+
+def test_least_recently_written_keys_are_evicted():
+    keys = RecentKeys(max_keys=2)
+    keys.add("heart_rate", [row("2022-07-14 05:30:14"), row("2022-07-14 05:30:15")])
+    keys.add("heart_rate", [row("2022-07-14 05:30:14"), row("2022-07-14 05:30:16")])
+    assert keys.filter("heart_rate", [row("2022-07-14 05:30:15")]) == [row("2022-07-14 05:30:15")]
+    assert keys.filter("heart_rate", [row("2022-07-14 05:30:14")]) == []
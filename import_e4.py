@@ -0,0 +1,257 @@
+"""Offline import of Empatica E4 heart rate recordings.
+
+Reads the HR.csv files of E4 session exports, where the first line is the
+session start in unix seconds, the second the sample rate in Hz and every
+further line one heart rate. Samples are validated as uploads are (see
+ingest.py), repeated seconds are dropped and the rest written straight to
+heart_rates in large batches, with LOAD DATA LOCAL INFILE on MySQL if
+--load-data is given. The unique key skips samples already in the database,
+so files can be imported again safely; downsampling and the fatigue
+pipeline pick the new rows up like uploaded ones. Files of users that do not
+exist are rejected before anything is imported.
+
+Files are imported in parallel by a pool of processes, each with its own
+connection pool. Every imported file is recorded in the checkpoint file and
+skipped by the next run unless it changed, so an interrupted import resumes
+where it stopped.
+
+    python import_e4.py recordings/    # recordings/<user_id>/<session>/HR.csv
+    python import_e4.py session/HR.csv --user-id 7
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import argparse
+import csv
+import math
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+import ingest
+
+# heart rates written per transaction
+BATCH_SIZE = 50000
+
+stmt_known_users = sqlalchemy.text("SELECT user_id FROM users WHERE user_id IN :user_ids").bindparams(
+    sqlalchemy.bindparam("user_ids", expanding=True))
+stmt_load_data = sqlalchemy.text(
+    """LOAD DATA LOCAL INFILE :path IGNORE INTO TABLE heart_rates
+    FIELDS TERMINATED BY ',' (user_id, heart_rate, timestamp)""")
+
+# connection pool of a worker process, created after the fork, and whether it loads with LOAD DATA
+_db = None
+_load_data = False
+
+
+def find_files(paths: list) -> list:
+    """HR.csv files among `paths` and in the directories below them."""
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for directory, _, names in os.walk(path):
+            files += [os.path.join(directory, name) for name in names if name.lower() == "hr.csv"]
+    return sorted(files)
+
+
+def user_of(path: str) -> int:
+    """The user of a recording: the nearest enclosing directory named by a number."""
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != os.path.dirname(directory):
+        if os.path.basename(directory).isdigit():
+            return int(os.path.basename(directory))
+        directory = os.path.dirname(directory)
+    raise ValueError(f"{path}: no user_id directory above it, pass --user-id")
+
+
+def read_heart_rates(path: str, user_id: int):
+    """Parse and validate an HR.csv file.
+    Return the rows to insert, the number of rejected samples and of repeated seconds."""
+    rows = []
+    rejected = duplicates = 0
+    seen = set()
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        try:
+            start = float(next(reader)[0])
+            rate = float(next(reader)[0])
+        except (StopIteration, IndexError, ValueError):
+            raise ValueError(f"{path}: expected the start time and sample rate on the first two lines")
+        if not 0 < start <= ingest.MAX_TIMESTAMP:
+            raise ValueError(f"{path}: invalid start time {start}")
+        if not rate > 0:
+            raise ValueError(f"{path}: invalid sample rate {rate}")
+        for index, line in enumerate(reader):
+            try:
+                heart_rate = round(float(line[0]))
+            except (IndexError, ValueError):
+                rejected += 1
+                continue
+            if not ingest.MIN_HEART_RATE <= heart_rate <= ingest.MAX_HEART_RATE:
+                rejected += 1
+                continue
+            timestamp = math.floor(start + index / rate)
+            if timestamp > ingest.MAX_TIMESTAMP:
+                rejected += 1
+                continue
+            if timestamp in seen:
+                duplicates += 1
+                continue
+            seen.add(timestamp)
+            rows.append({"user_id": user_id, "heart_rate": heart_rate, "timestamp": ingest.to_datetime(timestamp)})
+    return rows, rejected, duplicates
+
+
+def unknown_users(db: sqlalchemy.engine.base.Engine, user_ids) -> set:
+    """The user_ids that belong to no user. On MySQL heart_rates is partitioned
+    and has no foreign key, so their rows would be stored all the same."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    with db.connect() as conn:
+        known = {row[0] for row in conn.execute(stmt_known_users, user_ids=sorted(user_ids))}
+    return user_ids - known
+
+
+def load_data(conn, rows: list) -> int:
+    """Write rows with LOAD DATA LOCAL INFILE, through a temporary CSV file.
+    Return the number of rows inserted."""
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerows((row["user_id"], row["heart_rate"], row["timestamp"]) for row in rows)
+        f.flush()
+        with conn.begin():
+            return conn.execute(stmt_load_data, path=f.name).rowcount
+
+
+def check_load_data() -> None:
+    """Raise ValueError unless the database is MySQL over a socket LOAD DATA LOCAL INFILE works on.
+    Checked before the workers start, as an error in their initializer breaks the pool."""
+    if not (os.environ.get("INSTANCE_HOST") or os.environ.get("INSTANCE_UNIX_SOCKET")):
+        raise ValueError("--load-data needs MySQL over INSTANCE_HOST or INSTANCE_UNIX_SOCKET")
+
+
+def init_worker(use_load_data: bool) -> None:
+    """Connect a worker process."""
+    global _db, _load_data
+    from connect import init_connection_pool
+    _db = init_connection_pool()
+    _load_data = use_load_data
+    if use_load_data:
+        # the client refuses LOAD DATA LOCAL unless enabled on connect
+        url = _db.url.update_query_dict({"local_infile": "1"})
+        _db.dispose()
+        _db = sqlalchemy.create_engine(url)
+
+
+def import_file(path: str, user_id: int, batch_size: int = BATCH_SIZE) -> dict:
+    """Import one file in the worker process. Return its statistics: the valid
+    rows read, those inserted rather than skipped as already in the database,
+    the rejected samples and the repeated seconds."""
+    start = time.perf_counter()
+    rows, rejected, duplicates = read_heart_rates(path, user_id)
+    inserted = 0
+    with _db.connect() as conn:
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            if _load_data:
+                inserted += load_data(conn, batch)
+            else:
+                inserted += ingest.insert_heart_rates(conn, batch)
+    return {"path": path, "rows": len(rows), "inserted": inserted, "rejected": rejected,
+            "duplicates": duplicates, "seconds": time.perf_counter() - start}
+
+
+class Checkpoint:
+    """Append-only record of the files imported, by path, size and modification time."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f}
+
+    @staticmethod
+    def key(path: str) -> str:
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+    def __contains__(self, path: str) -> bool:
+        return self.key(path) in self.done
+
+    def add(self, path: str) -> None:
+        key = self.key(path)
+        with open(self.path, "a") as f:
+            f.write(key + "\n")
+        self.done.add(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="HR.csv files or directories containing them")
+    parser.add_argument("--user-id", type=int, help="user of every file, else taken from the directories")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--checkpoint", default="import_e4.checkpoint")
+    parser.add_argument("--load-data", action="store_true", help="write with LOAD DATA LOCAL INFILE (MySQL)")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    files = [path for path in find_files(args.paths) if path not in checkpoint]
+    try:
+        users = {path: args.user_id or user_of(path) for path in files}
+    except ValueError as e:
+        parser.error(str(e))
+    if args.load_data:
+        try:
+            check_load_data()
+        except ValueError as e:
+            parser.error(str(e))
+
+    # checked once here rather than by every worker
+    from connect import init_connection_pool
+    db = init_connection_pool()
+    unknown = unknown_users(db, users.values())
+    db.dispose()
+    unknown_files = [path for path in files if users[path] in unknown]
+    for path in unknown_files:
+        print(f"{path}: rejected, unknown user {users[path]}", file=sys.stderr)
+    files = [path for path in files if users[path] not in unknown]
+    print(f"importing {len(files)} files with {args.workers} workers")
+
+    start = time.perf_counter()
+    rows = inserted = rejected = duplicates = failed = 0
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.load_data,)) as pool:
+        futures = {pool.submit(import_file, path, users[path], args.batch_size): path for path in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{path}: failed, {e}", file=sys.stderr)
+                continue
+            checkpoint.add(path)
+            rows += stats["rows"]
+            inserted += stats["inserted"]
+            rejected += stats["rejected"]
+            duplicates += stats["duplicates"]
+            print(f"{path}: {stats['rows']} rows, {stats['inserted']} inserted, {stats['rejected']} rejected, "
+                  f"{stats['duplicates']} repeated, {stats['rows'] / stats['seconds']:.0f} rows/s")
+
+    seconds = time.perf_counter() - start
+    print(f"imported {rows} heart rates from {len(files) - failed} files in {seconds:.1f}s "
+          f"({rows / seconds:.0f} rows/s), {inserted} inserted and {rows - inserted} already stored, "
+          f"{rejected} rejected, {duplicates} repeated, {failed} files failed, "
+          f"{len(unknown_files)} files of unknown users rejected")
+    if failed or unknown_files:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
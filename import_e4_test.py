@@ -0,0 +1,90 @@
+import pytest
+import sqlalchemy
+
+from connect_sqlite import connect_sqlite
+import import_e4
+import migrations
+
+
+def write_recording(directory, lines):
+    directory.mkdir(parents=True)
+    path = directory / "HR.csv"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_read_heart_rates_validates_and_dedups(tmp_path):
+    path = write_recording(tmp_path / "7" / "1664625600_A01234", [
+        "1664625600.000000", "2.000000",
+        "71.5", "72.0", "300.0", "abc", "80.2", "81.0"])
+
+    assert import_e4.find_files([str(tmp_path)]) == [path]
+    assert import_e4.user_of(path) == 7
+    rows, rejected, duplicates = import_e4.read_heart_rates(path, 7)
+    # two samples a second: the second of each pair repeats a second
+    assert rows == [
+        {"user_id": 7, "heart_rate": 72, "timestamp": "2022-10-01 12:00:00"},
+        {"user_id": 7, "heart_rate": 80, "timestamp": "2022-10-01 12:00:02"},
+    ]
+    assert (rejected, duplicates) == (2, 2)
+
+
+def test_import_file_and_checkpoint(tmp_path, monkeypatch, add_users):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    add_users(db)
+    path = write_recording(tmp_path / "1" / "session", ["1664625600", "1"] + [str(60 + i) for i in range(5)])
+
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "dpm.db"))
+    import_e4.init_worker(False)
+    stats = import_e4.import_file(path, 1, batch_size=2)
+    assert (stats["rows"], stats["inserted"]) == (5, 5)
+    # importing again writes nothing new
+    stats = import_e4.import_file(path, 1)
+    assert (stats["rows"], stats["inserted"]) == (5, 0)
+    with db.connect() as conn:
+        assert conn.execute(sqlalchemy.text("SELECT COUNT(*) FROM heart_rates")).scalar() == 5
+
+    checkpoint = import_e4.Checkpoint(str(tmp_path / "checkpoint"))
+    checkpoint.add(path)
+    assert path in import_e4.Checkpoint(str(tmp_path / "checkpoint"))
+    with open(path, "a") as f:
+        f.write("70\n")
+    assert path not in import_e4.Checkpoint(str(tmp_path / "checkpoint"))
+
+
+def test_load_data_is_checked_before_the_workers_start(tmp_path, monkeypatch, capsys):
+    for name in ("INSTANCE_HOST", "INSTANCE_UNIX_SOCKET"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "dpm.db"))
+    path = write_recording(tmp_path / "1" / "session", ["1664625600", "1", "60"])
+    monkeypatch.setattr("sys.argv", ["import_e4.py", path, "--load-data",
+                                     "--checkpoint", str(tmp_path / "checkpoint")])
+    with pytest.raises(SystemExit):
+        import_e4.main()
+    assert "--load-data needs MySQL" in capsys.readouterr().err
+
+
+def test_files_of_unknown_users_are_rejected(tmp_path, monkeypatch, capsys, add_users):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    add_users(db)
+    known = write_recording(tmp_path / "recordings" / "1" / "session", ["1664625600", "1", "60", "61"])
+    unknown = write_recording(tmp_path / "recordings" / "2" / "session", ["1664625600", "1", "60"])
+    for name in ("INSTANCE_HOST", "INSTANCE_UNIX_SOCKET"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "dpm.db"))
+    checkpoint = str(tmp_path / "checkpoint")
+    monkeypatch.setattr("sys.argv", ["import_e4.py", str(tmp_path / "recordings"), "--workers", "1",
+                                     "--checkpoint", checkpoint])
+
+    with pytest.raises(SystemExit):
+        import_e4.main()
+
+    output = capsys.readouterr()
+    assert f"{unknown}: rejected, unknown user 2" in output.err
+    assert "1 files of unknown users rejected" in output.out
+    with db.connect() as conn:
+        assert conn.execute(sqlalchemy.text("SELECT user_id, COUNT(*) FROM heart_rates GROUP BY user_id")).fetchall() \
+            == [(1, 2)]
+    assert known in import_e4.Checkpoint(checkpoint) and unknown not in import_e4.Checkpoint(checkpoint)
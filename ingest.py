@@ -0,0 +1,232 @@
+from datetime import datetime
+
+import sqlalchemy
+
+import dialect
+import rollup
+
+# upper bound on samples accepted by a single batch upload
+MAX_BATCH_SIZE = 5000
+
+# plausible range for a wrist-worn heart rate sensor (beats per minute)
+MIN_HEART_RATE = 20
+MAX_HEART_RATE = 250
+
+# accepted unix timestamps, up to the end of signed 32 bit time; later ones
+# are garbage from the device and cannot all be stored as DATETIME anyway
+MAX_TIMESTAMP = 2**31 - 1
+
+# samples are unique per user and timestamp (activities per user, peer and
+# timestamp), so a retried upload is skipped by the database
+stmt_heart_rate = dialect.insert_ignore(
+    """INSERT INTO heart_rates (user_id, heart_rate, timestamp)
+    VALUES (:user_id, :heart_rate, :timestamp)""")
+stmt_fatigue_level = dialect.insert_ignore(
+    """INSERT INTO fatigue_levels (user_id, fatigue_level, timestamp)
+    VALUES (:user_id, :fatigue_level, :timestamp)""")
+stmt_user_fatigue = sqlalchemy.text(
+    """UPDATE users SET fatigue_level=:fatigue_level, last_update=:timestamp
+    WHERE user_id=:user_id AND (last_update IS NULL OR last_update <= :timestamp)""")
+stmt_activity = dialect.insert_ignore(
+    """INSERT INTO activities (user_id, peer_id, timestamp, if_open)
+    VALUES (:user_id, :peer_id, :timestamp, :if_open)""")
+
+
+class InvalidSample(ValueError):
+    """Raised when an uploaded sample fails validation."""
+
+
+def to_datetime(timestamp: int) -> str:
+    """Format a unix timestamp as the UTC DATETIME string stored in the database."""
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _to_int(sample: dict, key: str) -> int:
+    try:
+        value = sample[key]
+    except KeyError:
+        raise InvalidSample(f"missing {key}")
+    if isinstance(value, bool):
+        raise InvalidSample(f"invalid {key}")
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidSample(f"invalid {key}")
+
+
+def parse_heart_rate(sample) -> dict:
+    """Validate one `{user_id, heart_rate, timestamp}` sample.
+    Return the row to insert into heart_rates."""
+    if not isinstance(sample, dict):
+        raise InvalidSample("sample must be an object")
+
+    user_id = _to_int(sample, 'user_id')
+    heart_rate = _to_int(sample, 'heart_rate')
+    timestamp = _to_int(sample, 'timestamp')
+
+    if user_id <= 0:
+        raise InvalidSample("invalid user_id")
+    if not MIN_HEART_RATE <= heart_rate <= MAX_HEART_RATE:
+        raise InvalidSample("heart_rate out of range")
+    if not 0 < timestamp <= MAX_TIMESTAMP:
+        raise InvalidSample("invalid timestamp")
+
+    return {
+        "user_id": user_id,
+        "heart_rate": heart_rate,
+        "timestamp": to_datetime(timestamp),
+    }
+
+
+def parse_fatigue_level(sample) -> dict:
+    """Validate one `{user_id, fatigue_level, timestamp}` sample.
+    Return the row to insert into fatigue_levels."""
+    if not isinstance(sample, dict):
+        raise InvalidSample("sample must be an object")
+
+    user_id = _to_int(sample, 'user_id')
+    fatigue_level = _to_int(sample, 'fatigue_level')
+    timestamp = _to_int(sample, 'timestamp')
+
+    if user_id <= 0:
+        raise InvalidSample("invalid user_id")
+    if not 0 < timestamp <= MAX_TIMESTAMP:
+        raise InvalidSample("invalid timestamp")
+
+    return {
+        "user_id": user_id,
+        "fatigue_level": fatigue_level,
+        "timestamp": to_datetime(timestamp),
+    }
+
+
+def parse_activity(sample) -> dict:
+    """Validate one `{user_id, peer_id, timestamp, if_open}` event.
+    Return the row to insert into activities."""
+    if not isinstance(sample, dict):
+        raise InvalidSample("sample must be an object")
+
+    user_id = _to_int(sample, 'user_id')
+    peer_id = _to_int(sample, 'peer_id')
+    timestamp = _to_int(sample, 'timestamp')
+    if 'if_open' not in sample:
+        raise InvalidSample("missing if_open")
+
+    if user_id <= 0:
+        raise InvalidSample("invalid user_id")
+    if peer_id <= 0:
+        raise InvalidSample("invalid peer_id")
+    if not 0 < timestamp <= MAX_TIMESTAMP:
+        raise InvalidSample("invalid timestamp")
+
+    return {
+        "user_id": user_id,
+        "peer_id": peer_id,
+        "timestamp": to_datetime(timestamp),
+        "if_open": bool(sample['if_open']),
+    }
+
+
+def parse_batch(samples, parse):
+    """Validate every sample of a batch with `parse`.
+    Return the accepted rows and a list of rejections (index and reason)."""
+    rows = []
+    errors = []
+    for index, sample in enumerate(samples):
+        try:
+            rows.append(parse(sample))
+        except InvalidSample as e:
+            errors.append({"index": index, "error": str(e)})
+    return rows, errors
+
+
+def reject_users(rows: list, errors: list, unknown: set):
+    """Move the rows of `unknown` user_ids from the accepted rows of parse_batch
+    (or codec.decode) to its rejections, under the index of their sample."""
+    if not unknown:
+        return rows, errors
+    rejected = {error["index"] for error in errors}
+    indexes = (index for index in range(len(rows) + len(errors)) if index not in rejected)
+    accepted = []
+    errors = list(errors)
+    for index, row in zip(indexes, rows):
+        if row["user_id"] in unknown:
+            errors.append({"index": index, "error": "unknown user"})
+        else:
+            accepted.append(row)
+    errors.sort(key=lambda error: error["index"])
+    return accepted, errors
+
+
+# Writes are expressed as plans, lists of (statement, executemany parameters)
+# run in one transaction, so the Flask app and the async ingestion server
+# (ingest_asgi.py) share the exact same SQL.
+
+def plan_heart_rates(rows: list) -> list:
+    return [(stmt_heart_rate, rows)]
+
+
+def plan_fatigue_levels(rows: list) -> list:
+    """Insert the rows, move each user's current fatigue level to their most
+    recent sample and update the hourly rollup."""
+    latest = {}
+    for row in rows:
+        current = latest.get(row['user_id'])
+        if current is None or row['timestamp'] >= current['timestamp']:
+            latest[row['user_id']] = row
+    return [
+        (stmt_fatigue_level, rows),
+        (stmt_user_fatigue, list(latest.values())),
+        (rollup.stmt_refresh, rollup.hours(rows)),
+    ]
+
+
+def plan_activities(rows: list) -> list:
+    return [(stmt_activity, rows)]
+
+
+def execute_plan(conn, plan: list) -> list:
+    """Run a write plan with one multi-row executemany per statement in one transaction.
+    Return the number of rows each statement changed; an insert skips duplicates."""
+    counts = [0] * len(plan)
+    if not any(params for _, params in plan):
+        return counts
+    with conn.begin():
+        for index, (stmt, params) in enumerate(plan):
+            if params:
+                counts[index] = conn.execute(stmt, params).rowcount
+    return counts
+
+
+def insert_heart_rates(conn, rows: list) -> int:
+    """Write heart rate rows with a single multi-row executemany in one transaction.
+    Return the number of rows inserted."""
+    return execute_plan(conn, plan_heart_rates(rows))[0]
+
+
+def insert_fatigue_levels(conn, rows: list) -> int:
+    """Write fatigue level rows in one transaction, move each user's
+    current fatigue level to their most recent sample and update the hourly rollup.
+    Return the number of rows inserted."""
+    return execute_plan(conn, plan_fatigue_levels(rows))[0]
+
+
+def insert_activities(conn, rows: list) -> int:
+    """Write activity rows with a single multi-row executemany in one transaction.
+    Return the number of rows inserted."""
+    return execute_plan(conn, plan_activities(rows))[0]
+
+
+# upload kind -> (validator, bulk writer)
+KINDS = {
+    "heart_rate": (parse_heart_rate, insert_heart_rates),
+    "fatigue_level": (parse_fatigue_level, insert_fatigue_levels),
+    "activity": (parse_activity, insert_activities),
+}
+
+# upload kind -> write plan
+PLANS = {
+    "heart_rate": plan_heart_rates,
+    "fatigue_level": plan_fatigue_levels,
+    "activity": plan_activities,
+}
@@ -0,0 +1,379 @@
+"""Asynchronous ingestion server for the /api/v1/upload/* routes.
+
+A plain ASGI application on an asyncio MySQL pool (SQLAlchemy asyncio with
+aiomysql). Waiting on the database does not hold a thread, so one process can
+keep thousands of wearables connected while the pool bounds the number of
+concurrent queries. Uploads are validated and written with the same parsers
+and write plans as the Flask app (see ingest.py); the user and peer routes
+stay in app.py, which also owns the schema. Devices can also keep a
+WebSocket open on /api/v1/upload/stream/ and stream frames, see stream.py.
+
+    uvicorn ingest_asgi:app --port 8081
+
+The Flask process' in-memory streaming fatigue registry does not see uploads
+received here and should be left off in this setup; its peer group cache
+notices their fatigue levels through users.last_update.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import codec
+import db_pool
+from idempotency import RecentKeys
+import ingest
+import logs
+import metrics
+from rate_limit import RateLimiter
+import stream
+
+logs.configure()
+logger = logging.getLogger()
+
+UPLOAD_ROUTES = {
+    "/api/v1/upload/heart_rate/": "heart_rate",
+    "/api/v1/upload/fatigue_level/": "fatigue_level",
+    "/api/v1/upload/activity/": "activity",
+}
+BATCH_ROUTES = {
+    "/api/v1/upload/heart_rate/batch/": "heart_rate",
+}
+STREAM_ROUTE = "/api/v1/upload/stream/"
+METRICS_ROUTE = "/metrics"
+
+# largest request body read, room for a full batch of JSON samples with
+# generous whitespace; larger uploads are answered with 413 unread
+MAX_BODY_BYTES = ingest.MAX_BATCH_SIZE * 256
+
+
+def init_async_pool():
+    """Create the asyncio connection pool from the same environment as app.py."""
+    query = {}
+    host = os.environ.get("INSTANCE_HOST")
+    if not host:
+        if not os.environ.get("INSTANCE_UNIX_SOCKET"):
+            raise ValueError(
+                "Missing database connection type. Please define one of INSTANCE_HOST or INSTANCE_UNIX_SOCKET"
+            )
+        query = {"unix_socket": os.environ["INSTANCE_UNIX_SOCKET"]}
+    return create_async_engine(
+        sqlalchemy.engine.url.URL.create(
+            drivername="mysql+aiomysql",
+            username=os.environ["DB_USER"],
+            password=os.environ["DB_PASS"],
+            host=host,
+            port=os.environ.get("DB_PORT") if host else None,
+            database=os.environ["DB_NAME"],
+            query=query,
+        ),
+        poolclass=db_pool.AsyncQueuePool,
+        # no threads here, so the pool is sized for concurrent requests instead
+        **db_pool.PoolConfig.from_env(
+            pool_size=int(os.environ.get("ASYNC_DB_POOL_SIZE", 20)),
+            max_overflow=int(os.environ.get("ASYNC_DB_MAX_OVERFLOW", 10)),
+        ).engine_options(),
+    )
+
+
+async def execute_plan(db, plan: list) -> list:
+    """Async counterpart of ingest.execute_plan."""
+    counts = [0] * len(plan)
+    if not any(params for _, params in plan):
+        return counts
+    async with db.begin() as conn:
+        for index, (stmt, params) in enumerate(plan):
+            if params:
+                counts[index] = (await conn.execute(stmt, params)).rowcount
+    return counts
+
+
+class IngestServer:
+    """ASGI application serving the upload routes."""
+
+    def __init__(self, db=None) -> None:
+        self.db = db
+        self.recent_keys = RecentKeys(max_keys=int(os.environ.get("RECENT_KEYS", 100000)))
+        self.rate_limiter = None
+        if os.environ.get("UPLOAD_RATE_LIMIT"):
+            self.rate_limiter = RateLimiter.from_env()
+        self.request_sampler = logs.RouteSampler.from_env()
+        self.upload_pool_timeout = db_pool.PoolConfig.from_env().upload_pool_timeout
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            start = time.perf_counter()
+            metrics.start_request()
+            status, body, headers = await self.handle(scope, receive)
+            await respond(send, status, body, headers)
+            route = scope["path"]
+            duration = time.perf_counter() - start
+            # unknown paths share one label to bound the number of series
+            label = "not_found"
+            if route in UPLOAD_ROUTES or route in BATCH_ROUTES or route == METRICS_ROUTE:
+                label = route
+            metrics.request_duration.observe(duration, label, scope["method"])
+            metrics.request_db_duration.observe(metrics.request_db_time(), label)
+            metrics.requests_total.inc(1, label, scope["method"], status)
+            # failed requests are always logged, the rest sampled per route
+            if status >= 500 or self.request_sampler.sample(route):
+                logger.info("request", extra={
+                    "route": route,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 3),
+                    "db_ms": round(metrics.request_db_time() * 1000, 3),
+                })
+        elif scope["type"] == "websocket":
+            if scope["path"] == STREAM_ROUTE:
+                await self.stream(receive, send)
+            else:
+                await send({"type": "websocket.close", "code": 1008})
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.db is None:
+                    self.db = init_async_pool()
+                logs.set_sql_echo(self.db.sync_engine, float(os.environ.get("SQL_ECHO_SAMPLE", 0)))
+                metrics.instrument_engine(self.db.sync_engine)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.db is not None:
+                    await self.db.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle(self, scope, receive):
+        """Return the status, body and extra headers of the response to a request."""
+        path = scope["path"]
+        if path == METRICS_ROUTE:
+            if scope["method"] != "GET":
+                return 405, "Method Not Allowed", {"allow": "GET"}
+            return 200, metrics.registry.render(), {"content-type": metrics.CONTENT_TYPE}
+        if path not in UPLOAD_ROUTES and path not in BATCH_ROUTES:
+            return 404, "Not Found", {}
+        if scope["method"] != "POST":
+            return 405, "Method Not Allowed", {"allow": "POST"}
+
+        body = await read_body(receive, MAX_BODY_BYTES)
+        if body is None:
+            return 413, f"At most {MAX_BODY_BYTES} bytes per upload.", {}
+        kind = BATCH_ROUTES.get(path) or UPLOAD_ROUTES[path]
+        content_type = dict(scope["headers"]).get(b"content-type", b"").split(b";")[0].strip()
+        if content_type == codec.CONTENT_TYPE.encode():
+            if kind not in codec.KIND_CODES:
+                return 415, f"{codec.CONTENT_TYPE} is not supported for {kind} uploads.", {}
+            return await self.upload_binary(kind, body)
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, "Expected a JSON body.", {}
+
+        if path in BATCH_ROUTES:
+            return await self.upload_batch(kind, payload)
+        return await self.upload(kind, payload)
+
+    def rate_limited(self, rows: list):
+        """Charge one request to every user in rows. Return a 429 response if any is over the limit."""
+        if self.rate_limiter is None:
+            return None
+        wait = max([self.rate_limiter.acquire(user_id) for user_id in {row['user_id'] for row in rows}],
+                   default=0)
+        if not wait:
+            return None
+        return 429, "Too many uploads, please retry later.", {"retry-after": str(math.ceil(wait))}
+
+    async def write_rows(self, kind: str, rows: list) -> int:
+        """Write validated rows that were not written recently. Return the number inserted."""
+        rows = self.recent_keys.filter(kind, rows)
+        # fail fast rather than queue behind other requests when the pool is exhausted
+        with db_pool.checkout_timeout(self.upload_pool_timeout):
+            inserted = (await execute_plan(self.db, ingest.PLANS[kind](rows)))[0]
+        self.recent_keys.add(kind, rows)
+        metrics.ingested_rows.inc(inserted, kind)
+        return inserted
+
+    async def unknown_users(self, rows: list) -> set:
+        """The user_ids of rows that belong to no user; their samples would fail the foreign key."""
+        unknown = set()
+        with db_pool.checkout_timeout(self.upload_pool_timeout):
+            async with self.db.connect() as conn:
+                for user_id in {row['user_id'] for row in rows}:
+                    if (await conn.execute(stream.stmt_user, {"user_id": user_id})).fetchone() is None:
+                        unknown.add(user_id)
+        return unknown
+
+    async def upload(self, kind: str, sample):
+        parse, _ = ingest.KINDS[kind]
+        try:
+            rows = [parse(sample)]
+        except ingest.InvalidSample as e:
+            return 400, str(e), {}
+        limited = self.rate_limited(rows)
+        if limited is not None:
+            return limited
+        try:
+            if await self.unknown_users(rows):
+                return 404, "Unknown user.", {}
+            await self.write_rows(kind, rows)
+            return 200, "Success", {}
+        except sqlalchemy.exc.TimeoutError:
+            return 503, "Database is busy, please retry later.", {"retry-after": "1"}
+        except Exception as e:
+            logger.exception(e)
+            return 500, ("Unable to successfully upload data! Please check the "
+                         "application logs for more details."), {}
+
+    async def upload_batch(self, kind: str, samples):
+        if not isinstance(samples, list):
+            return 400, "Expected a JSON array of heart rate samples.", {}
+        if len(samples) > ingest.MAX_BATCH_SIZE:
+            return 413, f"At most {ingest.MAX_BATCH_SIZE} samples per batch.", {}
+
+        parse, _ = ingest.KINDS[kind]
+        return await self.save_batch(kind, *ingest.parse_batch(samples, parse))
+
+    async def upload_binary(self, kind: str, payload: bytes):
+        try:
+            rows, errors = codec.decode(kind, payload)
+        except codec.BatchTooLarge as e:
+            return 413, str(e), {}
+        except ingest.InvalidSample as e:
+            return 400, str(e), {}
+        return await self.save_batch(kind, rows, errors)
+
+    async def save_batch(self, kind: str, rows: list, errors: list):
+        limited = self.rate_limited(rows)
+        if limited is not None:
+            return limited
+        try:
+            rows, errors = ingest.reject_users(rows, errors, await self.unknown_users(rows))
+            accepted = await self.write_rows(kind, rows)
+            context = {
+                "accepted": accepted,
+                "duplicates": len(rows) - accepted,
+                "rejected": len(errors),
+                "errors": errors,
+            }
+            return 200, context, {}
+        except sqlalchemy.exc.TimeoutError:
+            return 503, "Database is busy, please retry later.", {"retry-after": "1"}
+        except Exception as e:
+            logger.exception(e)
+            return 500, ("Unable to successfully upload data! Please check the "
+                         "application logs for more details."), {}
+
+    async def stream(self, receive, send) -> None:
+        """Serve a WebSocket upload stream, see stream.py."""
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        await send({"type": "websocket.accept"})
+
+        message = await receive()
+        if message["type"] != "websocket.receive":
+            return
+        try:
+            session = stream.StreamSession(stream.hello(message_text(message)))
+            async with self.db.connect() as conn:
+                user = await conn.execute(stream.stmt_user, {"user_id": session.user_id})
+                if user.fetchone() is None:
+                    raise ingest.InvalidSample("unknown user")
+        except ingest.InvalidSample as e:
+            await send({"type": "websocket.send", "text": json.dumps({"error": str(e)})})
+            await send({"type": "websocket.close", "code": 1008})
+            return
+
+        closed = False
+        try:
+            while not closed:
+                try:
+                    # wake up when the window is due even if the device goes quiet
+                    message = await asyncio.wait_for(receive(), session.timeout())
+                except asyncio.TimeoutError:
+                    message = None
+                if message is not None:
+                    if message["type"] == "websocket.disconnect":
+                        closed = True
+                    else:
+                        for line in message_text(message).splitlines():
+                            if line.strip():
+                                session.feed(line)
+                if session.due() or (closed and session.timeout() is not None):
+                    rows, ack = session.take()
+                    if self.rate_limiter is not None:
+                        # slow the stream down rather than drop frames
+                        await asyncio.sleep(self.rate_limiter.acquire(session.user_id))
+                    rows = {kind: self.recent_keys.filter(kind, kind_rows) for kind, kind_rows in rows.items()}
+                    with db_pool.checkout_timeout(self.upload_pool_timeout):
+                        # one insert per kind, in FRAME_KINDS order
+                        inserted = dict(zip(stream.FRAME_KINDS, await execute_plan(self.db, stream.plan(rows))))
+                    for kind, kind_rows in rows.items():
+                        self.recent_keys.add(kind, kind_rows)
+                        metrics.ingested_rows.inc(inserted[kind], kind)
+                    if not closed:
+                        await send({"type": "websocket.send", "text": json.dumps(ack)})
+        except Exception as e:
+            logger.exception(e)
+            if not closed:
+                await send({"type": "websocket.send", "text": json.dumps({
+                    "error": "Unable to successfully upload data! Please check the "
+                    "application logs for more details."})})
+                await send({"type": "websocket.close", "code": 1011})
+
+
+def message_text(message: dict) -> str:
+    """Text of a WebSocket message, whether sent as text or binary."""
+    if message.get("text") is not None:
+        return message["text"]
+    return (message.get("bytes") or b"").decode()
+
+
+async def read_body(receive, limit: int) -> bytes:
+    """Read a request body. Return None, without reading the rest, once it is
+    longer than `limit` bytes."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status: int, body, headers: dict) -> None:
+    """Send a response; dict bodies are sent as JSON, strings as HTML like Flask
+    unless headers has a content-type."""
+    headers = dict(headers)
+    if isinstance(body, dict):
+        content = json.dumps(body).encode()
+        content_type = b"application/json"
+    else:
+        content = body.encode()
+        content_type = headers.pop("content-type", "text/html; charset=utf-8").encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type),
+                    (b"content-length", str(len(content)).encode())]
+        + [(name.encode(), value.encode()) for name, value in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+app = IngestServer()
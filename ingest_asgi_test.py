@@ -0,0 +1,182 @@
+import asyncio
+import json
+
+import pytest
+import sqlalchemy
+
+pytest.importorskip("aiosqlite")
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+import codec  # noqa: E402
+from connect_sqlite import connect_sqlite  # noqa: E402
+import db_pool  # noqa: E402
+import ingest  # noqa: E402
+import ingest_asgi  # noqa: E402
+from ingest_asgi import IngestServer  # noqa: E402
+import migrations  # noqa: E402
+
+T0 = 1664625600
+
+
+@pytest.fixture
+def path(tmp_path, add_users):
+    path = str(tmp_path / "dpm.db")
+    db = connect_sqlite(path)
+    migrations.migrate(db)
+    add_users(db)
+    db.dispose()
+    return path
+
+
+def serve(path, scenario, **pool):
+    """Run `scenario(server, db)` against an IngestServer on the SQLite database."""
+    async def main():
+        db = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=db_pool.AsyncQueuePool,
+                                 **{"pool_size": 2, "max_overflow": 0, "pool_timeout": 5, **pool})
+        try:
+            await scenario(IngestServer(db), db)
+        finally:
+            await db.dispose()
+    asyncio.run(main())
+
+
+async def request(server, path, body=b"", method="POST", content_type=b"application/json", chunks=1):
+    """Send an HTTP request, split in `chunks` body messages. Return status, headers and body."""
+    size = -(-len(body) // chunks) or 1
+    messages = [{"type": "http.request", "body": body[i:i + size], "more_body": i + size < len(body)}
+                for i in range(0, max(len(body), 1), size)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "method": method, "headers": [(b"content-type", content_type)]}
+    await server(scope, receive, send)
+    start, response = sent
+    return start["status"], dict(start["headers"]), response["body"]
+
+
+def stored(path, table="heart_rates"):
+    db = connect_sqlite(path)
+    with db.connect() as conn:
+        count = conn.execute(f"SELECT COUNT(*) FROM {table}").scalar()
+    db.dispose()
+    return count
+
+
+def test_upload_routes(path):
+    async def scenario(server, db):
+        sample = {"user_id": 1, "heart_rate": 80, "timestamp": T0}
+        assert await request(server, "/api/v1/upload/heart_rate/", json.dumps(sample).encode()) == \
+            (200, {b"content-type": b"text/html; charset=utf-8", b"content-length": b"7"}, b"Success")
+        assert (await request(server, "/api/v1/upload/heart_rate/", b"{"))[0] == 400
+        assert (await request(server, "/api/v1/upload/heart_rate/", json.dumps(
+            {**sample, "timestamp": 10**12}).encode()))[2] == b"invalid timestamp"
+        assert (await request(server, "/api/v1/upload/heart_rate/", method="GET"))[0] == 405
+        assert (await request(server, "/api/v1/nope/"))[0] == 404
+        assert (await request(server, "/api/v1/upload/heart_rate/", json.dumps(
+            {**sample, "user_id": 2}).encode()))[:3:2] == (404, b"Unknown user.")
+
+        batch = [{"user_id": 1, "heart_rate": 81, "timestamp": T0 + i} for i in range(1, 4)] + [{"user_id": 1}]
+        batch.append({"user_id": 2, "heart_rate": 81, "timestamp": T0})
+        status, headers, body = await request(server, "/api/v1/upload/heart_rate/batch/",
+                                              json.dumps(batch).encode(), chunks=3)
+        assert status == 200 and headers[b"content-type"] == b"application/json"
+        assert json.loads(body) == {"accepted": 3, "duplicates": 0, "rejected": 2,
+                                    "errors": [{"index": 3, "error": "missing heart_rate"},
+                                               {"index": 4, "error": "unknown user"}]}
+
+        payload = codec.encode_heart_rates(1, [T0 + 10, T0 + 11], [90, 91])
+        status, _, body = await request(server, "/api/v1/upload/heart_rate/batch/", payload,
+                                        content_type=codec.CONTENT_TYPE.encode())
+        assert status == 200 and json.loads(body)["accepted"] == 2
+        status, _, _ = await request(server, "/api/v1/upload/fatigue_level/", payload,
+                                     content_type=codec.CONTENT_TYPE.encode())
+        assert status == 415
+
+    serve(path, scenario)
+    assert stored(path) == 6
+
+
+def test_batch_too_large(path):
+    async def scenario(server, db):
+        batch = [{"user_id": 1, "heart_rate": 80, "timestamp": T0 + i} for i in range(ingest.MAX_BATCH_SIZE + 1)]
+        assert (await request(server, "/api/v1/upload/heart_rate/batch/", json.dumps(batch).encode()))[0] == 413
+
+    serve(path, scenario)
+    assert stored(path) == 0
+
+
+def test_body_too_large(path):
+    async def scenario(server, db):
+        sample = json.dumps({"user_id": 1, "heart_rate": 80, "timestamp": T0}).encode()
+        body = sample + b" " * ingest_asgi.MAX_BODY_BYTES
+        status, _, response = await request(server, "/api/v1/upload/heart_rate/", body, chunks=4)
+        assert status == 413
+        assert response == f"At most {ingest_asgi.MAX_BODY_BYTES} bytes per upload.".encode()
+
+    serve(path, scenario)
+    assert stored(path) == 0
+
+
+def test_pool_timeout(path):
+    async def scenario(server, db):
+        server.upload_pool_timeout = 0.05
+        sample = json.dumps({"user_id": 1, "heart_rate": 80, "timestamp": T0}).encode()
+        # every connection is taken
+        async with db.connect() as conn:
+            await conn.execute(sqlalchemy.text("SELECT 1"))
+            status, headers, _ = await request(server, "/api/v1/upload/heart_rate/", sample)
+        assert status == 503 and headers[b"retry-after"] == b"1"
+        assert (await request(server, "/api/v1/upload/heart_rate/", sample))[0] == 200
+
+    serve(path, scenario, pool_size=1)
+    assert stored(path) == 1
+
+
+async def websocket(server, messages):
+    """Play WebSocket messages to the stream route. Return what was sent back."""
+    messages = [{"type": "websocket.connect"}] + messages + [{"type": "websocket.disconnect", "code": 1000}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await server({"type": "websocket", "path": "/api/v1/upload/stream/"}, receive, send)
+    return sent
+
+
+def test_websocket_stream(path):
+    frames = [json.dumps({"heart_rate": 80, "timestamp": T0 + i}) for i in range(99)] + ["{"]
+
+    async def scenario(server, db):
+        sent = await websocket(server, [{"type": "websocket.receive", "text": '{"user_id": 1}'},
+                                        {"type": "websocket.receive", "text": "\n".join(frames)}])
+        assert sent[0] == {"type": "websocket.accept"}
+        assert json.loads(sent[1]["text"]) == {"ack": 100, "accepted": 99,
+                                               "rejected": [{"index": 99, "error": "invalid JSON"}]}
+        assert len(sent) == 2
+
+        sent = await websocket(server, [{"type": "websocket.receive", "bytes": b'{"user_id": 2}'}])
+        assert json.loads(sent[1]["text"]) == {"error": "unknown user"}
+        assert sent[2] == {"type": "websocket.close", "code": 1008}
+
+        sent = []
+
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await server({"type": "websocket", "path": "/elsewhere/"}, receive, send)
+        assert sent == [{"type": "websocket.close", "code": 1008}]
+
+    serve(path, scenario)
+    assert stored(path) == 99
@@ -0,0 +1,137 @@
+"""Logging setup shared by the Flask app and the async ingestion server.
+
+Records are formatted as one JSON object per line and handed to a queue; a
+single listener thread does the formatting and the writing to stderr, so
+request threads never block on log I/O. Request logs are sampled per route
+and SQL statement logging is off unless explicitly switched on.
+
+    LOG_LEVEL            root log level (default INFO)
+    LOG_FORMAT           json (default) or text
+    LOG_SAMPLE_RATE      fraction of requests logged (default 0.01)
+    LOG_SAMPLE_RATES     per-route overrides, e.g. "get_peer=1,post_heart_rate=0.001"
+    SQL_ECHO_SAMPLE      fraction of SQL statements logged (default 0, off)
+"""
+from logging.handlers import QueueHandler, QueueListener
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import time
+
+import sqlalchemy
+
+# attributes every LogRecord has; anything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+_sql_echo = {}  # engine -> sample rate
+
+sql_logger = logging.getLogger("sql")
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON, including fields passed with `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """Queue records unformatted, for the listener's formatter. The stdlib
+    prepare() folds the traceback into the message and drops exc_info."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the text, not the traceback and the frames it keeps alive
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure() -> None:
+    """Route all logging through a queue to a background writer. Idempotent."""
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler()
+    if os.environ.get("LOG_FORMAT", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(records)]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class RouteSampler:
+    """Decide which requests are logged, at a sampling rate per route."""
+
+    def __init__(self, rate: float = 0.01, rates: dict = None) -> None:
+        self.rate = rate
+        self.rates = rates or {}
+
+    @classmethod
+    def from_env(cls) -> "RouteSampler":
+        rates = {}
+        for item in os.environ.get("LOG_SAMPLE_RATES", "").split(","):
+            if "=" in item:
+                route, rate = item.split("=", 1)
+                rates[route.strip()] = float(rate)
+        return cls(float(os.environ.get("LOG_SAMPLE_RATE", 0.01)), rates)
+
+    def sample(self, route: str) -> bool:
+        rate = self.rates.get(route, self.rate)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def set_sql_echo(engine: sqlalchemy.engine.base.Engine, sample_rate: float) -> None:
+    """Log that fraction of the engine's SQL statements to the "sql" logger,
+    or stop logging them with 0. Can be called at any time."""
+    if sample_rate > 0:
+        if engine not in _sql_echo:
+            sqlalchemy.event.listen(engine, "before_cursor_execute", _echo)
+        _sql_echo[engine] = sample_rate
+    elif engine in _sql_echo:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", _echo)
+        del _sql_echo[engine]
+
+
+def sql_echo(engine: sqlalchemy.engine.base.Engine) -> float:
+    """The fraction of the engine's SQL statements logged."""
+    return _sql_echo.get(engine, 0.0)
+
+
+def _echo(conn, cursor, statement, parameters, context, executemany):
+    rate = _sql_echo.get(conn.engine, 0)
+    if rate >= 1 or random.random() < rate:
+        sql_logger.info(" ".join(statement.split()), extra={
+            "rows": len(parameters) if executemany else 1,
+            "parameters": None if executemany else parameters,
+        })
@@ -0,0 +1,53 @@
+import atexit
+import json
+import logging
+
+import sqlalchemy
+
+import logs
+
+
+def test_json_formatter_includes_extra_fields():
+    record = logging.LogRecord("app", logging.INFO, __file__, 1, "request", (), None)
+    record.route = "post_heart_rate"
+    record.status = 200
+    entry = json.loads(logs.JsonFormatter().format(record))
+    assert entry["level"] == "INFO"
+    assert entry["message"] == "request"
+    assert (entry["route"], entry["status"]) == ("post_heart_rate", 200)
+
+
+def test_route_sampler():
+    sampler = logs.RouteSampler(0, {"get_peer": 1})
+    assert sampler.sample("get_peer")
+    assert not any(sampler.sample("post_heart_rate") for _ in range(100))
+
+
+def test_sql_echo_can_be_switched_at_runtime(caplog):
+    caplog.set_level(logging.INFO, logger="sql")
+    db = sqlalchemy.create_engine("sqlite://")
+    with db.connect() as conn:
+        conn.execute("SELECT 1")
+        logs.set_sql_echo(db, 1)
+        conn.execute("SELECT   2")
+        logs.set_sql_echo(db, 0)
+        conn.execute("SELECT 3")
+    assert [record.getMessage() for record in caplog.records if record.name == "sql"] == ["SELECT 2"]
+
+
+def test_exceptions_reach_the_formatter(monkeypatch, capsys):
+    monkeypatch.setattr(logs, "_listener", None)
+    monkeypatch.setattr(logging.getLogger(), "handlers", [])
+    monkeypatch.setattr(logging.getLogger(), "level", logging.getLogger().level)
+    monkeypatch.setenv("LOG_FORMAT", "json")
+    logs.configure()
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logging.getLogger("test").exception("failed %s", "upload", extra={"route": "post_heart_rate"})
+    logs._listener.stop()
+    atexit.unregister(logs._listener.stop)
+    entry = json.loads(capsys.readouterr().err.splitlines()[-1])
+    assert entry["message"] == "failed upload"
+    assert entry["route"] == "post_heart_rate"
+    assert entry["exception"].startswith("Traceback") and "ZeroDivisionError" in entry["exception"]
@@ -0,0 +1,212 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+A minimal registry of counters, gauges and histograms, plus the
+instrumentation of SQLAlchemy engines: time spent in SQL statements, in
+total and per request, and the time requests wait for a pooled connection.
+Serve `registry.render()` at /metrics and let Prometheus compute rates.
+"""
+from contextvars import ContextVar
+
+import bisect
+import threading
+import time
+
+import sqlalchemy
+
+# seconds; from sub-millisecond queries to pool checkout timeouts
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames=()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _samples(self, labels, value) -> list:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value read from `function` at every scrape."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function) -> None:
+        super().__init__(name, help)
+        self.function = function
+
+    def render(self) -> list:
+        value = self.function()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # per bucket counts, then +Inf count and sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self, labels, counts) -> list:
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric. Raise ValueError if one with that name exists, which
+        would render the name twice."""
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics = self._metrics + [metric]
+        return metric
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._metrics = [metric for metric in self._metrics if metric.name != name]
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, function) -> Gauge:
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to handle a request.", ("route", "method"))
+requests_total = registry.counter(
+    "http_requests_total", "Requests handled.", ("route", "method", "status"))
+request_db_duration = registry.histogram(
+    "http_request_db_seconds", "Time a request spent in SQL statements.", ("route",))
+query_duration = registry.histogram(
+    "db_query_duration_seconds", "Time to execute one SQL statement.")
+checkout_wait = registry.histogram(
+    "db_pool_checkout_wait_seconds", "Time waiting for a pooled connection.")
+checkout_timeouts = registry.counter(
+    "db_pool_checkout_timeouts_total", "Connection checkouts that timed out.")
+replica_fallbacks = registry.counter(
+    "db_replica_fallbacks_total", "Reads sent to the primary because the replica was stale or down.")
+ingested_rows = registry.counter(
+    "ingested_rows_total", "Uploaded rows written or queued for writing.", ("kind",))
+
+# SQL time of the request in progress, in a one-item list
+_request_db_time = ContextVar("request_db_time", default=None)
+
+
+def start_request() -> None:
+    _request_db_time.set([0.0])
+
+
+def request_db_time() -> float:
+    total = _request_db_time.get()
+    return total[0] if total is not None else 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _observe_query(conn) -> None:
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    query_duration.observe(elapsed)
+    total = _request_db_time.get()
+    if total is not None:
+        total[0] += elapsed
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _observe_query(conn)
+
+
+def _handle_error(exception_context):
+    # a failed statement never gets to after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start"):
+        _observe_query(conn)
+
+
+def instrument_engine(engine: sqlalchemy.engine.base.Engine, prefix: str = "db_pool",
+                      target: Registry = None) -> None:
+    """Time the engine's SQL statements and report its pool's state under `prefix`
+    in `target`, the module's registry by default. Checkout waits are recorded by
+    the pool classes of db_pool.py."""
+    target = target or registry
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", _handle_error)
+
+    def pool_stat(name):
+        def read():
+            method = getattr(engine.pool, name, None)
+            return method() if method is not None else None
+        return read
+
+    target.gauge(f"{prefix}_size", "Connections the pool keeps open.", pool_stat("size"))
+    target.gauge(f"{prefix}_checked_out", "Connections in use.", pool_stat("checkedout"))
+    target.gauge(f"{prefix}_overflow", "Connections open beyond the pool size.", pool_stat("overflow"))
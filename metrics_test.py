@@ -0,0 +1,64 @@
+import pytest
+import sqlalchemy
+
+import db_pool
+import metrics
+
+
+def test_render_histogram_and_counter():
+    registry = metrics.Registry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1))
+    rows = registry.counter("rows_total", "Rows.", ("kind",))
+    registry.gauge("depth", "Depth.", lambda: 7)
+    latency.observe(0.05, "a")
+    latency.observe(0.5, "a")
+    latency.observe(5, "a")
+    rows.inc(3, 'he said "hi"')
+
+    lines = registry.render().splitlines()
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{route="a",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="a",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{route="a",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{route="a"} 5.55' in lines
+    assert 'latency_seconds_count{route="a"} 3' in lines
+    assert 'rows_total{kind="he said \\"hi\\""} 3' in lines
+    assert "depth 7" in lines
+
+
+def test_engine_timing():
+    db = sqlalchemy.create_engine("sqlite://", poolclass=db_pool.QueuePool)
+    registry = metrics.Registry()
+    metrics.instrument_engine(db, target=registry)
+    waits = metrics.checkout_wait._values.get((), [0])[:-1]
+    metrics.start_request()
+    with db.connect() as conn:
+        conn.execute("SELECT 1")
+        conn.execute("SELECT 2")
+    assert metrics.request_db_time() > 0
+    assert sum(metrics.checkout_wait._values[()][:-1]) == sum(waits) + 1
+
+    rendered = registry.render()
+    assert "db_pool_size 5" in rendered
+    assert "db_pool_checked_out 0" in rendered
+
+
+def test_duplicate_names_are_refused():
+    registry = metrics.Registry()
+    registry.counter("rows_total", "Rows.")
+    with pytest.raises(ValueError):
+        registry.gauge("rows_total", "Rows.", lambda: 1)
+    registry.unregister("rows_total")
+    registry.gauge("rows_total", "Rows.", lambda: 1)
+    assert registry.render().count("# TYPE rows_total") == 1
+
+
+def test_failed_statement_is_timed():
+    db = sqlalchemy.create_engine("sqlite://", poolclass=db_pool.QueuePool)
+    metrics.instrument_engine(db, target=metrics.Registry())
+    with db.connect() as conn:
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            conn.execute("SELECT * FROM nowhere")
+        assert conn.info["query_start"] == []
+        conn.execute("SELECT 1")
+        assert conn.info["query_start"] == []
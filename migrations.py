@@ -0,0 +1,309 @@
+"""Versioned schema migrations.
+
+Every migration has a version, a name and a function returning its steps
+for a database dialect ("mysql" or "sqlite"), each either a SQL statement or
+a callable taking the connection. `migrate` applies the
+migrations newer than the version recorded in schema_version, in order, and
+records each one once all its steps succeeded.
+
+Schema changes on existing tables are written to run online (in place,
+without blocking concurrent reads and, where MySQL allows it, writes).
+MySQL commits DDL implicitly, so keep each step safe to re-run by hand if a
+migration stops half way. Partitioning a table (migration 3) is the exception:
+it copies the table and blocks writes to it meanwhile.
+
+SQLite databases are created at the same versions with equivalent DDL: the
+sample tables get their surrogate key in the baseline, as SQLite cannot add
+a primary key later, and are not partitioned.
+
+    python migrations.py    # apply pending migrations and exit
+"""
+from datetime import datetime
+
+import functools
+import logging
+
+import sqlalchemy
+
+import dialect
+import partitions
+import rollup
+
+logger = logging.getLogger()
+
+
+def _baseline(dialect_name):
+    user_key = "INTEGER AUTO_INCREMENT PRIMARY KEY" if dialect_name == "mysql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    # see _indexes for MySQL
+    sample_key = "" if dialect_name == "mysql" else "id INTEGER PRIMARY KEY, "
+    return [
+        # user table
+        "CREATE TABLE IF NOT EXISTS users "
+        f"(user_id {user_key}, "
+        "first_name VARCHAR(40) NOT NULL, "
+        "last_name VARCHAR(40) NOT NULL, "
+        "group_id VARCHAR(20) NOT NULL, "
+        "age INTEGER NOT NULL, "
+        "max_heart_rate INTEGER NOT NULL, "
+        "rest_heart_rate INTEGER NOT NULL, "
+        "hrr_cp INTEGER NOT NULL, "
+        "awc_tot INTEGER NOT NULL, "
+        "k_value INTEGER NOT NULL, "
+        "fatigue_level INTEGER NOT NULL, "
+        "last_update DATETIME, "
+        "created DATETIME DEFAULT CURRENT_TIMESTAMP); ",
+
+        # heart_rates table
+        "CREATE TABLE IF NOT EXISTS heart_rates "
+        f"({sample_key}user_id INTEGER NOT NULL, "
+        "heart_rate INTEGER NOT NULL, "
+        "timestamp DATETIME NOT NULL, "
+        "FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE); ",
+
+        # fatigue_levels table
+        "CREATE TABLE IF NOT EXISTS fatigue_levels "
+        f"({sample_key}user_id INTEGER NOT NULL, "
+        "fatigue_level INTEGER NOT NULL, "
+        "timestamp DATETIME NOT NULL, "
+        "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); ",
+
+        # activities table
+        "CREATE TABLE IF NOT EXISTS activities "
+        f"({sample_key}user_id INTEGER NOT NULL, "
+        "peer_id INTEGER NOT NULL, "
+        "timestamp DATETIME NOT NULL, "
+        "if_open BOOLEAN NOT NULL, "
+        "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); ",
+
+        # fatigue_state table: where the server-side fatigue pipeline left off
+        "CREATE TABLE IF NOT EXISTS fatigue_state "
+        "(user_id INTEGER PRIMARY KEY, "
+        "w_exp DOUBLE NOT NULL, "
+        "last_minute DATETIME NOT NULL, "
+        "watermark DATETIME NOT NULL, "
+        "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); ",
+
+        # fatigue_hourly table: per-hour rollup of fatigue_levels
+        "CREATE TABLE IF NOT EXISTS fatigue_hourly "
+        "(user_id INTEGER NOT NULL, "
+        "hour DATETIME NOT NULL, "
+        "sample_count INTEGER NOT NULL, "
+        "level_sum BIGINT NOT NULL, "
+        "level_min INTEGER NOT NULL, "
+        "level_max INTEGER NOT NULL, "
+        "PRIMARY KEY (user_id, hour), "
+        "FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE); ",
+        rollup.backfill,
+    ]
+
+
+def _indexes(dialect_name):
+    steps = []
+    # surrogate keys for the sample tables; adding an AUTO_INCREMENT column
+    # rebuilds the table in place and keeps it readable meanwhile
+    for table in ("heart_rates", "fatigue_levels", "activities"):
+        if dialect_name == "mysql":
+            steps.append(
+                f"ALTER TABLE {table} "
+                "ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST, "
+                "ALGORITHM=INPLACE, LOCK=SHARED")
+    # secondary indexes are built without blocking reads or writes
+    for table, name, columns in (
+            ("users", "ix_users_name", "first_name, last_name"),
+            ("users", "ix_users_group", "group_id"),
+            ("heart_rates", "ix_heart_rates_user_time", "user_id, timestamp"),
+            ("fatigue_levels", "ix_fatigue_levels_user_time", "user_id, timestamp"),
+            ("activities", "ix_activities_user_time", "user_id, timestamp")):
+        steps.append(_add_index(dialect_name, table, name, columns))
+    return steps
+
+
+def _add_index(dialect_name, table, name, columns, unique=False):
+    """Build an index online on MySQL."""
+    if dialect_name == "mysql":
+        return (f"ALTER TABLE {table} ADD {'UNIQUE ' if unique else ''}INDEX {name} ({columns}), "
+                "ALGORITHM=INPLACE, LOCK=NONE")
+    return f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+
+
+def _drop_index(dialect_name, table, name):
+    if dialect_name == "mysql":
+        return f"ALTER TABLE {table} DROP INDEX {name}"
+    return f"DROP INDEX IF EXISTS {name}"
+
+
+def _partitions(dialect_name):
+    if dialect_name != "mysql":
+        return []
+    # partitions for the days ahead are added by partitions.maintain right after
+    today = datetime.utcnow().date()
+    return [functools.partial(partitions.partition_table, table=table, today=today, ahead=0)
+            for table in partitions.PARTITIONED_TABLES]
+
+
+def _heart_rate_tiers(dialect_name):
+    return [
+        # heart_rate_buckets table: downsampled heart rates, see downsample.py
+        "CREATE TABLE IF NOT EXISTS heart_rate_buckets "
+        "(user_id INTEGER NOT NULL, "
+        "resolution INTEGER NOT NULL, "
+        "bucket DATETIME NOT NULL, "
+        "sample_count INTEGER NOT NULL, "
+        "hr_sum BIGINT NOT NULL, "
+        "hr_min INTEGER NOT NULL, "
+        "hr_max INTEGER NOT NULL, "
+        "PRIMARY KEY (user_id, resolution, bucket)); ",
+
+        # downsample_state table: heart_rates ids already folded into the tiers
+        "CREATE TABLE IF NOT EXISTS downsample_state "
+        "(name VARCHAR(40) PRIMARY KEY, "
+        "watermark BIGINT NOT NULL, "
+        "horizon BIGINT NOT NULL); ",
+    ]
+
+
+def _unique_samples(dialect_name):
+    steps = []
+    for table, name, columns in (
+            ("heart_rates", "heart_rates_user_time", ("user_id", "timestamp")),
+            ("fatigue_levels", "fatigue_levels_user_time", ("user_id", "timestamp")),
+            ("activities", "activities_user_peer_time", ("user_id", "peer_id", "timestamp"))):
+        # keep the first of every set of duplicates
+        if dialect_name == "mysql":
+            steps.append(
+                f"DELETE later FROM {table} later JOIN {table} earlier "
+                f"ON {' AND '.join(f'later.{c} = earlier.{c}' for c in columns)} AND later.id > earlier.id")
+        else:
+            steps.append(
+                f"DELETE FROM {table} WHERE id NOT IN "
+                f"(SELECT MIN(id) FROM {table} GROUP BY {', '.join(columns)})")
+        steps.append(_add_index(dialect_name, table, f"ux_{name}", ", ".join(columns), unique=True))
+    steps += [
+        _drop_index(dialect_name, "heart_rates", "ix_heart_rates_user_time"),
+        _drop_index(dialect_name, "fatigue_levels", "ix_fatigue_levels_user_time"),
+        # aggregates counted the duplicates; rebuild them
+        "DELETE FROM fatigue_hourly",
+        rollup.stmt_rebuild,
+        "DELETE FROM heart_rate_buckets",
+        "DELETE FROM downsample_state",
+    ]
+    return steps
+
+
+def _replica_heartbeat(dialect_name):
+    return [
+        # replica_heartbeat table: written on the primary, read on replicas, see replica.py
+        "CREATE TABLE IF NOT EXISTS replica_heartbeat "
+        "(id INTEGER PRIMARY KEY, "
+        "beat DATETIME(6) NOT NULL); ",
+        "INSERT IGNORE INTO replica_heartbeat (id, beat) VALUES (1, UTC_TIMESTAMP(6))"
+        if dialect_name == "mysql" else
+        "INSERT OR IGNORE INTO replica_heartbeat (id, beat) VALUES (1, CURRENT_TIMESTAMP)",
+    ]
+
+
+def _view_sessions(dialect_name):
+    session_key = "BIGINT AUTO_INCREMENT PRIMARY KEY" if dialect_name == "mysql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    return [
+        # view_sessions table: activities paired into intervals, see sessions.py
+        "CREATE TABLE IF NOT EXISTS view_sessions "
+        f"(id {session_key}, "
+        "user_id INTEGER NOT NULL, "
+        "peer_id INTEGER NOT NULL, "
+        "started DATETIME NOT NULL, "
+        "ended DATETIME NULL, "
+        "timed_out BOOLEAN NOT NULL DEFAULT FALSE); ",
+        _add_index(dialect_name, "view_sessions", "ix_view_sessions_user_time", "user_id, started"),
+        _add_index(dialect_name, "view_sessions", "ix_view_sessions_peer_time", "peer_id, started"),
+        _add_index(dialect_name, "view_sessions", "ix_view_sessions_ended", "ended"),
+    ]
+
+
+def _view_session_state(dialect_name):
+    return [
+        # view_session_state table: activities ids already paired, see sessions.py; it was
+        # kept in downsample_state, which belongs to downsample.py
+        "CREATE TABLE IF NOT EXISTS view_session_state "
+        "(id INTEGER PRIMARY KEY, "
+        "watermark BIGINT NOT NULL, "
+        "horizon BIGINT NOT NULL); ",
+        "INSERT INTO view_session_state (id, watermark, horizon) "
+        "SELECT 1, watermark, horizon FROM downsample_state WHERE name = 'activities'",
+        "DELETE FROM downsample_state WHERE name = 'activities'",
+    ]
+
+
+def _daily_heart_rate_tier(dialect_name):
+    day = "DATE(bucket)" if dialect_name == "mysql" else "datetime(bucket, 'start of day')"
+    return [
+        # daily buckets of heart_rate_buckets, summed from the hourly ones; new
+        # heart rates are folded into them by downsample.py from now on
+        dialect.insert_ignore(
+            "INSERT INTO heart_rate_buckets "
+            "(user_id, resolution, bucket, sample_count, hr_sum, hr_min, hr_max) "
+            f"SELECT user_id, 86400, {day}, SUM(sample_count), SUM(hr_sum), MIN(hr_min), MAX(hr_max) "
+            "FROM heart_rate_buckets WHERE resolution = 3600 "
+            f"GROUP BY user_id, {day}"),
+    ]
+
+
+# (version, name, steps), in order; never edit a migration once released
+MIGRATIONS = [
+    (1, "baseline tables", _baseline),
+    (2, "surrogate keys and indexes for hot queries", _indexes),
+    (3, "daily partitions for sample tables", _partitions),
+    (4, "downsampled heart rate tiers", _heart_rate_tiers),
+    (5, "unique samples per user and timestamp", _unique_samples),
+    (6, "replica heartbeat", _replica_heartbeat),
+    (7, "peer viewing sessions", _view_sessions),
+    (8, "view session state", _view_session_state),
+    (9, "daily heart rate tier", _daily_heart_rate_tier),
+]
+
+stmt_version_table = (
+    "CREATE TABLE IF NOT EXISTS schema_version "
+    "(version INTEGER PRIMARY KEY, "
+    "name VARCHAR(100) NOT NULL, "
+    "applied DATETIME DEFAULT CURRENT_TIMESTAMP); ")
+stmt_record = sqlalchemy.text(
+    "INSERT INTO schema_version (version, name) VALUES (:version, :name)")
+
+
+def current_version(conn) -> int:
+    conn.execute(stmt_version_table)
+    return conn.execute("SELECT MAX(version) FROM schema_version").scalar() or 0
+
+
+def migrate(db: sqlalchemy.engine.base.Engine) -> list:
+    """Apply pending migrations. Return the versions applied."""
+    applied = []
+    with db.connect() as conn:
+        # workers starting together wait for the first one to finish
+        with dialect.named_lock(conn, "schema_migrations", 600) as acquired:
+            if not acquired:
+                raise RuntimeError("Timed out waiting for the schema migration lock")
+            version = current_version(conn)
+            for number, name, steps in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info(f"applying migration {number}: {name}")
+                for step in steps(conn.dialect.name):
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(stmt_record, version=number, name=name)
+                applied.append(number)
+    return applied
+
+
+def main():
+    from connect import init_connection_pool
+    db = init_connection_pool()
+    migrate(db)
+    with db.connect() as conn:
+        print(f"schema at version {current_version(conn)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import os
+
+import pytest
+import sqlalchemy
+
+import app
+from connect_sqlite import connect_sqlite
+import dialect
+import fatigue_pipeline
+import fatigue_registry
+import migrations
+import partitions
+import rollup
+import sessions
+
+BACKENDS = [
+    "sqlite",
+    pytest.param("mysql", marks=pytest.mark.skipif(
+        "MYSQL_INSTANCE_HOST" not in os.environ,
+        reason="needs a MySQL test database (MYSQL_INSTANCE_HOST, MYSQL_USER, ...)")),
+]
+
+# hot queries and their parameters; each must be answered from an index
+HOT_QUERIES = [
+    ("user login", sqlalchemy.text(
+        "SELECT * FROM users WHERE first_name=:first_name AND last_name=:last_name"),
+     {"first_name": "user", "last_name": "7"}),
+    ("peer group", sqlalchemy.text(
+        "SELECT user_id, first_name, fatigue_level, last_update FROM users WHERE group_id=:group_id"),
+     {"group_id": "3"}),
+    ("peer group version", app.stmt_group_version, {"group_id": "3"}),
+    ("hourly rollup", rollup.stmt_select,
+     {"user_id": 7, "start": "2022-10-01 00:00:00", "end": "2022-10-02 00:00:00"}),
+    ("pipeline heart rates", fatigue_pipeline.stmt_heart_rates,
+     {"user_id": 7, "since": "2022-10-01 12:00:00", "until": "2022-10-01 13:00:00"}),
+    ("streaming state", fatigue_registry.stmt_load, {"user_id": 7}),
+    ("open view sessions", sessions.stmt_open, {}),
+    ("viewers", sessions.stmt_viewers, {"user_id": 7, "earliest": "2022-09-30 23:30:00",
+                                        "start": "2022-10-01 00:00:00", "end": "2022-10-02 00:00:00"}),
+    ("viewed", sessions.stmt_viewed, {"user_id": 7, "earliest": "2022-09-30 23:30:00",
+                                      "start": "2022-10-01 00:00:00", "end": "2022-10-02 00:00:00"}),
+]
+
+
+@pytest.fixture(scope="module", params=BACKENDS)
+def db(request, tmp_path_factory, add_users) -> sqlalchemy.engine.base.Engine:
+    if request.param == "sqlite":
+        db = connect_sqlite(str(tmp_path_factory.mktemp("sqlite") / "dpm.db"))
+    else:
+        db = sqlalchemy.create_engine(
+            sqlalchemy.engine.url.URL.create(
+                drivername="mysql+pymysql",
+                username=os.environ["MYSQL_USER"],
+                password=os.environ["MYSQL_PASSWORD"],
+                host=os.environ["MYSQL_INSTANCE_HOST"],
+                port=os.environ.get("MYSQL_PORT", 3306),
+                database=os.environ["MYSQL_DATABASE"],
+            ))
+    migrations.migrate(db)
+    with db.connect() as conn:
+        if not conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            add_users(conn, [str(n % 10) for n in range(200)])
+            conn.execute(sqlalchemy.text(
+                """INSERT INTO heart_rates (user_id, heart_rate, timestamp)
+                VALUES (:user_id, 80, :timestamp)"""),
+                [{"user_id": user_id, "timestamp": datetime(2022, 10, 1) + timedelta(seconds=offset)}
+                 for user_id in range(1, 201) for offset in range(0, 3600, 60)])
+        if db.dialect.name == "mysql":
+            for table in ("users", "heart_rates", "fatigue_levels", "fatigue_hourly"):
+                conn.execute(f"ANALYZE TABLE {table}")
+        else:
+            conn.execute("ANALYZE")
+    return db
+
+
+def test_migrate_is_idempotent(db):
+    assert migrations.migrate(db) == []
+    with db.connect() as conn:
+        assert migrations.current_version(conn) == migrations.MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize("name,stmt,params", HOT_QUERIES, ids=[q[0] for q in HOT_QUERIES])
+def test_query_plan_uses_index(db, name, stmt, params):
+    if db.dialect.name == "sqlite":
+        explain = sqlalchemy.text("EXPLAIN QUERY PLAN " + dialect.text_for(stmt, "sqlite"))
+        with db.connect() as conn:
+            plan = [row['detail'] for row in conn.execute(explain, **params).fetchall()]
+        for detail in plan:
+            assert not detail.startswith("SCAN") or "INDEX" in detail, f"{name}: {detail}"
+        return
+
+    explain = sqlalchemy.text("EXPLAIN " + stmt.text)
+    with db.connect() as conn:
+        plan = conn.execute(explain, **params).fetchall()
+    for row in plan:
+        if row['table'] is None or row['type'] == 'system':
+            continue  # nothing to read, e.g. an empty joined table
+        assert row['type'] != 'ALL', f"{name} scans all of {row['table']}"
+        assert row['key'] is not None, f"{name} uses no index on {row['table']}"
+
+
+def test_time_bounded_reads_are_pruned(db):
+    if db.dialect.name != "mysql":
+        pytest.skip("partitions are MySQL only")
+    partitions.maintain(db)
+    with db.connect() as conn:
+        names = [name for name, _ in partitions.partitions(conn, "heart_rates")]
+        assert "p_history" in names and "p_future" in names
+        plan = conn.execute(sqlalchemy.text(
+            "EXPLAIN " + fatigue_pipeline.stmt_heart_rates.text),
+            user_id=7, since=datetime.utcnow() - timedelta(hours=24),
+            until=datetime.utcnow()).fetchall()
+    # yesterday and today only
+    assert 1 <= len(plan[0]['partitions'].split(",")) <= 2
+
+
+def test_daily_tier_is_summed_from_hourly_buckets(db):
+    stmt_bucket = sqlalchemy.text(
+        """INSERT INTO heart_rate_buckets (user_id, resolution, bucket, sample_count, hr_sum, hr_min, hr_max)
+        VALUES (9, 3600, :bucket, 60, :hr_sum, :hr_min, :hr_max)""")
+    with db.connect() as conn:
+        conn.execute(stmt_bucket, [
+            {"bucket": datetime(2022, 10, 1, hour), "hr_sum": 60 * (70 + hour), "hr_min": 60 + hour,
+             "hr_max": 80 + hour} for hour in (0, 12, 23)] + [
+            {"bucket": datetime(2022, 10, 2, 1), "hr_sum": 6000, "hr_min": 90, "hr_max": 110}])
+        for step in migrations._daily_heart_rate_tier(db.dialect.name):
+            conn.execute(step)
+        daily = conn.execute(sqlalchemy.text(
+            """SELECT bucket, sample_count, hr_sum, hr_min, hr_max FROM heart_rate_buckets
+            WHERE user_id = 9 AND resolution = 86400 ORDER BY bucket""")).fetchall()
+        conn.execute("DELETE FROM heart_rate_buckets WHERE user_id = 9")
+    assert [tuple(row[1:]) for row in daily] == [(180, 60 * (70 * 3 + 35), 60, 103), (60, 6000, 90, 110)]
+    assert [str(row[0]) for row in daily] == ["2022-10-01 00:00:00", "2022-10-02 00:00:00"]
@@ -0,0 +1,175 @@
+"""Daily time partitions and retention for the sample tables.
+
+heart_rates and fatigue_levels are partitioned by RANGE (TO_DAYS(timestamp)),
+one partition per UTC day named pYYYYMMDD, plus a catch-all p_future. Reads
+bounded in time, such as the fatigue pipeline's, only open the partitions
+their range overlaps. `maintain` keeps partitions created ahead of time by
+splitting the (empty) p_future, and retires partitions older than the
+retention period by dropping them, or by exchanging them into a standalone
+archive table first, instead of running DELETE.
+
+    python partitions.py    # run once, e.g. daily from cron
+
+Partitions are MySQL only; on SQLite `maintain` leaves the tables as they are.
+"""
+from datetime import date, datetime, timedelta
+
+import logging
+import os
+import threading
+
+import sqlalchemy
+
+import dialect
+
+logger = logging.getLogger()
+
+PARTITIONED_TABLES = ("heart_rates", "fatigue_levels")
+
+# MySQL TO_DAYS() of a date minus Python's date.toordinal()
+TO_DAYS_OFFSET = 365
+
+stmt_partitions = sqlalchemy.text(
+    """SELECT partition_name, partition_description FROM information_schema.partitions
+    WHERE table_schema = DATABASE() AND table_name = :table AND partition_name IS NOT NULL
+    ORDER BY partition_ordinal_position""")
+stmt_foreign_keys = sqlalchemy.text(
+    """SELECT constraint_name FROM information_schema.referential_constraints
+    WHERE constraint_schema = DATABASE() AND table_name = :table""")
+
+
+def partition_name(day: date) -> str:
+    return f"p{day:%Y%m%d}"
+
+
+def _partition(day: date) -> str:
+    """Definition of the partition holding the rows of `day`."""
+    return f"PARTITION {partition_name(day)} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))"
+
+
+def partitions(conn, table: str) -> list:
+    """Return (name, first day after the partition) of a table's partitions;
+    the day is None for p_future and the list is empty if it is not partitioned."""
+    result = []
+    for name, description in conn.execute(stmt_partitions, table=table).fetchall():
+        end = None
+        if description != "MAXVALUE":
+            end = date.fromordinal(int(description) - TO_DAYS_OFFSET)
+        result.append((name, end))
+    return result
+
+
+def partition_table(conn, table: str, today: date, ahead: int) -> None:
+    """Partition an existing table: all rows before today go to p_history.
+    Foreign keys are dropped, as partitioned InnoDB tables cannot have them, and
+    the primary key is widened to include the partitioning column."""
+    if partitions(conn, table):
+        return
+    for (name,) in conn.execute(stmt_foreign_keys, table=table).fetchall():
+        conn.execute(f"ALTER TABLE {table} DROP FOREIGN KEY {name}")
+    conn.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)")
+    definitions = [f"PARTITION p_history VALUES LESS THAN (TO_DAYS('{today}'))"]
+    definitions += [_partition(today + timedelta(days=n)) for n in range(ahead + 1)]
+    definitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+    # rebuilds the table, blocking writes meanwhile
+    conn.execute(f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(timestamp)) "
+                 f"({', '.join(definitions)})")
+
+
+def ensure_future(conn, table: str, today: date, ahead: int) -> list:
+    """Create the daily partitions up to `ahead` days after today. Return their names."""
+    ends = [end for _, end in partitions(conn, table) if end is not None]
+    if not ends:
+        return []
+    days = []
+    day = max(ends)
+    while day <= today + timedelta(days=ahead):
+        days.append(day)
+        day += timedelta(days=1)
+    if days:
+        definitions = [_partition(day) for day in days]
+        definitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+        conn.execute(f"ALTER TABLE {table} REORGANIZE PARTITION p_future "
+                     f"INTO ({', '.join(definitions)})")
+    return [partition_name(day) for day in days]
+
+
+def expire(conn, table: str, today: date, retention: int, archive: bool = False) -> list:
+    """Retire the partitions whose rows are all older than `retention` days.
+    With `archive`, each is first swapped into a table named <table>_<partition>.
+    Return the names of the retired partitions."""
+    cutoff = today - timedelta(days=retention)
+    retired = []
+    for name, end in partitions(conn, table):
+        if end is None or end > cutoff:
+            continue
+        if archive:
+            archive_table = f"{table}_{name}"
+            conn.execute(f"CREATE TABLE {archive_table} LIKE {table}")
+            conn.execute(f"ALTER TABLE {archive_table} REMOVE PARTITIONING")
+            conn.execute(f"ALTER TABLE {table} EXCHANGE PARTITION {name} WITH TABLE {archive_table}")
+        conn.execute(f"ALTER TABLE {table} DROP PARTITION {name}")
+        retired.append(name)
+    return retired
+
+
+def maintain(db: sqlalchemy.engine.base.Engine, now: datetime = None) -> dict:
+    """Create upcoming partitions and retire expired ones on every partitioned table.
+    Return the created and retired partition names per table."""
+    today = (now or datetime.utcnow()).date()
+    ahead = int(os.environ.get("PARTITION_AHEAD_DAYS", 7))
+    # retention is opt-in: without PARTITION_RETENTION_DAYS nothing is retired
+    retention = os.environ.get("PARTITION_RETENTION_DAYS")
+    archive = bool(os.environ.get("PARTITION_ARCHIVE"))
+    result = {}
+    if db.dialect.name != "mysql":
+        # SQLite tables are not partitioned
+        return result
+    with db.connect() as conn:
+        # only one worker alters partitions at a time
+        with dialect.named_lock(conn, "partition_maintenance") as acquired:
+            if not acquired:
+                return result
+            for table in PARTITIONED_TABLES:
+                result[table] = {
+                    "created": ensure_future(conn, table, today, ahead),
+                    "retired": expire(conn, table, today, int(retention), archive)
+                    if retention else [],
+                }
+    return result
+
+
+class PartitionMaintenance:
+    """Background thread running `maintain` every `interval` seconds."""
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, interval: float) -> None:
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="partition-maintenance", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                maintain(self.db)
+            except Exception as e:
+                logger.exception(e)
+            if self._stop.wait(self.interval):
+                break
+
+
+def main():
+    from connect import init_connection_pool
+    for table, changes in maintain(init_connection_pool()).items():
+        print(f"{table}: created {len(changes['created'])}, retired {len(changes['retired'])} partitions")
+
+
+if __name__ == "__main__":
+    main()
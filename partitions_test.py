@@ -0,0 +1,121 @@
+from datetime import date
+
+import pytest
+
+import partitions
+
+
+class FakeResult:
+    def __init__(self, rows: list) -> None:
+        self.rows = rows
+
+    def fetchall(self) -> list:
+        return self.rows
+
+
+class FakeConnection:
+    """Answers the information_schema queries of partitions.py from `tables`,
+    {table: [(partition_name, partition_description)]}, and records the
+    ALTER and CREATE statements it is given."""
+
+    def __init__(self, tables: dict) -> None:
+        self.tables = tables
+        self.statements = []
+
+    def execute(self, stmt, **params):
+        if stmt is partitions.stmt_partitions:
+            return FakeResult(self.tables.get(params["table"], []))
+        if stmt is partitions.stmt_foreign_keys:
+            return FakeResult([("heart_rates_ibfk_1",)])
+        self.statements.append(stmt)
+
+
+def to_days(day: date) -> str:
+    return str(day.toordinal() + partitions.TO_DAYS_OFFSET)
+
+
+def daily(*days: date) -> list:
+    """Partitions holding each of `days`, then p_future."""
+    return [(partitions.partition_name(day), to_days(date.fromordinal(day.toordinal() + 1))) for day in days] + [
+        ("p_future", "MAXVALUE")]
+
+
+def test_to_days_offset() -> None:
+    # the example of the MySQL manual: TO_DAYS('2007-10-07') = 733321
+    assert to_days(date(2007, 10, 7)) == "733321"
+
+
+def test_partitions_reads_the_end_of_each_day() -> None:
+    conn = FakeConnection({"heart_rates": daily(date(2022, 9, 30), date(2022, 10, 1))})
+    assert partitions.partitions(conn, "heart_rates") == [
+        ("p20220930", date(2022, 10, 1)), ("p20221001", date(2022, 10, 2)), ("p_future", None)]
+    assert partitions.partitions(conn, "fatigue_levels") == []
+
+
+def test_ensure_future_splits_p_future() -> None:
+    conn = FakeConnection({"heart_rates": daily(date(2022, 9, 30), date(2022, 10, 1))})
+
+    created = partitions.ensure_future(conn, "heart_rates", date(2022, 10, 1), ahead=2)
+
+    assert created == ["p20221002", "p20221003"]
+    assert conn.statements == [
+        "ALTER TABLE heart_rates REORGANIZE PARTITION p_future INTO ("
+        "PARTITION p20221002 VALUES LESS THAN (TO_DAYS('2022-10-03')), "
+        "PARTITION p20221003 VALUES LESS THAN (TO_DAYS('2022-10-04')), "
+        "PARTITION p_future VALUES LESS THAN MAXVALUE)"]
+
+
+@pytest.mark.parametrize("tables", [
+    # already far enough ahead
+    {"heart_rates": daily(date(2022, 10, 1), date(2022, 10, 2), date(2022, 10, 3))},
+    # not partitioned
+    {},
+])
+def test_ensure_future_leaves_the_table(tables: dict) -> None:
+    conn = FakeConnection(tables)
+    assert partitions.ensure_future(conn, "heart_rates", date(2022, 10, 1), ahead=2) == []
+    assert conn.statements == []
+
+
+def test_expire_drops_partitions_past_the_retention() -> None:
+    conn = FakeConnection({"heart_rates": [("p_history", to_days(date(2022, 9, 1)))] + daily(
+        date(2022, 9, 29), date(2022, 9, 30), date(2022, 10, 1))})
+
+    # rows of 2022-09-29 are all older than 2022-09-30, the cutoff of 1 day of retention
+    retired = partitions.expire(conn, "heart_rates", date(2022, 10, 1), retention=1)
+
+    assert retired == ["p_history", "p20220929"]
+    assert conn.statements == [
+        "ALTER TABLE heart_rates DROP PARTITION p_history",
+        "ALTER TABLE heart_rates DROP PARTITION p20220929"]
+
+
+def test_expire_archives_before_dropping() -> None:
+    conn = FakeConnection({"heart_rates": daily(date(2022, 9, 29), date(2022, 9, 30))})
+
+    assert partitions.expire(conn, "heart_rates", date(2022, 10, 1), retention=1, archive=True) == ["p20220929"]
+    assert conn.statements == [
+        "CREATE TABLE heart_rates_p20220929 LIKE heart_rates",
+        "ALTER TABLE heart_rates_p20220929 REMOVE PARTITIONING",
+        "ALTER TABLE heart_rates EXCHANGE PARTITION p20220929 WITH TABLE heart_rates_p20220929",
+        "ALTER TABLE heart_rates DROP PARTITION p20220929"]
+
+
+def test_partition_table() -> None:
+    conn = FakeConnection({})
+
+    partitions.partition_table(conn, "heart_rates", date(2022, 10, 1), ahead=1)
+
+    assert conn.statements == [
+        "ALTER TABLE heart_rates DROP FOREIGN KEY heart_rates_ibfk_1",
+        "ALTER TABLE heart_rates DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)",
+        "ALTER TABLE heart_rates PARTITION BY RANGE (TO_DAYS(timestamp)) ("
+        "PARTITION p_history VALUES LESS THAN (TO_DAYS('2022-10-01')), "
+        "PARTITION p20221001 VALUES LESS THAN (TO_DAYS('2022-10-02')), "
+        "PARTITION p20221002 VALUES LESS THAN (TO_DAYS('2022-10-03')), "
+        "PARTITION p_future VALUES LESS THAN MAXVALUE)"]
+
+    # already partitioned
+    conn = FakeConnection({"heart_rates": daily(date(2022, 10, 1))})
+    partitions.partition_table(conn, "heart_rates", date(2022, 10, 1), ahead=1)
+    assert conn.statements == []
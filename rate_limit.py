@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+import os
+import threading
+import time
+
+
+class RateLimiter:
+    """Per-user token buckets: `rate` requests per second, bursts up to `burst`.
+
+    Buckets of users not seen for a while are evicted in LRU order beyond
+    `max_users`; an evicted user simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_users: int = 100000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user_id -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+        self.limited = 0
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        rate = float(os.environ["UPLOAD_RATE_LIMIT"])
+        return cls(rate, burst=float(os.environ.get("UPLOAD_RATE_BURST", 10 * rate)))
+
+    def acquire(self, user_id: int, cost: float = 1.0) -> float:
+        """Take `cost` tokens from the user's bucket.
+        Return 0 if they were available, else the seconds until they will be."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = [self.burst, now]
+                while len(self._buckets) > self.max_users:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(user_id)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            self.limited += 1
+            return (cost - bucket[0]) / self.rate
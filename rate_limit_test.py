@@ -0,0 +1,20 @@
+import rate_limit
+from rate_limit import RateLimiter
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter(rate=2, burst=3)
+
+    assert [limiter.acquire(1) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire(1) == 0.5
+    # other users have their own bucket
+    assert limiter.acquire(2) == 0
+
+    now[0] += 0.5
+    assert limiter.acquire(1) == 0
+    assert limiter.acquire(1) == 0.5
+    now[0] += 10
+    assert [limiter.acquire(1) for _ in range(4)] == [0, 0, 0, 0.5]
+    assert limiter.limited == 3
@@ -0,0 +1,99 @@
+"""Routing of read-only queries to a read replica.
+
+`ReadRouter.connect` hands out connections to the replica while it is known
+to be fresh, and to the primary otherwise. Freshness is measured with a
+heartbeat: every `interval` seconds the router writes the current time to
+replica_heartbeat on the primary and reads it back from the replica, whose
+lag is how far behind the newest heartbeat it has applied is. When the lag
+exceeds `max_lag`, or the replica cannot be reached, reads fall back to the
+primary until a later probe succeeds.
+
+Only route reads that tolerate `max_lag` seconds of staleness; anything
+that reads its own writes stays on the primary.
+"""
+from datetime import datetime
+
+import contextlib
+import logging
+import threading
+
+import sqlalchemy
+
+import metrics
+
+logger = logging.getLogger()
+
+stmt_beat = sqlalchemy.text("UPDATE replica_heartbeat SET beat = :beat WHERE id = 1")
+stmt_read_beat = sqlalchemy.text("SELECT beat FROM replica_heartbeat WHERE id = 1").columns(
+    beat=sqlalchemy.DateTime)
+
+
+class ReadRouter:
+    """Pick the replica or the primary engine for read-only queries."""
+
+    def __init__(self, primary: sqlalchemy.engine.base.Engine, replica: sqlalchemy.engine.base.Engine = None,
+                 max_lag: float = 5.0, interval: float = 1.0) -> None:
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.interval = interval
+        # seconds behind the primary, None until measured or while unreachable
+        self.lag = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="replica-probe", daemon=True)
+
+    def probe(self, now: datetime = None) -> float:
+        """Write a heartbeat on the primary and measure the replica's lag from it."""
+        now = now or datetime.utcnow()
+        try:
+            with self.primary.begin() as conn:
+                conn.execute(stmt_beat, beat=now)
+            with self.replica.connect() as conn:
+                beat = conn.execute(stmt_read_beat).scalar()
+            self.lag = max(0.0, (now - beat).total_seconds()) if beat is not None else None
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.warning(f"replica probe failed: {e}")
+            self.lag = None
+        return self.lag
+
+    def fresh(self) -> bool:
+        return self.replica is not None and self.lag is not None and self.lag <= self.max_lag
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Connection to the replica if it is fresh, else to the primary."""
+        if not self.fresh():
+            if self.replica is not None:
+                metrics.replica_fallbacks.inc()
+            with self.primary.connect() as conn:
+                yield conn
+            return
+        try:
+            conn = self.replica.connect()
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.warning(f"replica unavailable, reading from the primary: {e}")
+            self.lag = None
+            metrics.replica_fallbacks.inc()
+            conn = self.primary.connect()
+        with conn:
+            try:
+                yield conn
+            except sqlalchemy.exc.OperationalError:
+                # lost the replica; read from the primary until the next probe succeeds
+                self.lag = None
+                raise
+
+    def start(self) -> None:
+        if self.replica is not None:
+            self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            self.probe()
+            if self._stop.wait(self.interval):
+                break
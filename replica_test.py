@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+from replica import ReadRouter
+
+
+def engine(path):
+    db = sqlalchemy.create_engine(f"sqlite:///{path}")
+    with db.begin() as conn:
+        conn.execute("CREATE TABLE replica_heartbeat (id INTEGER PRIMARY KEY, beat DATETIME NOT NULL)")
+        conn.execute("INSERT INTO replica_heartbeat VALUES (1, '2022-07-14 00:00:00')")
+        conn.execute("CREATE TABLE users (name VARCHAR(40))")
+        conn.execute(f"INSERT INTO users VALUES ('{path.stem}')")
+    return db
+
+
+def replicate(primary, replica):
+    with primary.connect() as conn:
+        beat = conn.execute("SELECT beat FROM replica_heartbeat").scalar()
+    with replica.begin() as conn:
+        conn.execute(sqlalchemy.text("UPDATE replica_heartbeat SET beat = :beat"), beat=beat)
+
+
+def reads_from(router):
+    with router.connect() as conn:
+        return conn.execute("SELECT name FROM users").scalar()
+
+
+def test_routes_to_fresh_replica_only(tmp_path):
+    primary, replica = engine(tmp_path / "primary"), engine(tmp_path / "replica")
+    router = ReadRouter(primary, replica, max_lag=5)
+    now = datetime(2022, 7, 14, 12)
+    # not probed yet
+    assert reads_from(router) == "primary"
+
+    router.probe(now)
+    assert router.lag > 5
+    assert reads_from(router) == "primary"
+
+    replicate(primary, replica)
+    assert router.probe(now + timedelta(seconds=2)) == 2
+    assert reads_from(router) == "replica"
+
+
+def test_falls_back_when_replica_is_down(tmp_path):
+    primary = engine(tmp_path / "primary")
+    router = ReadRouter(primary, sqlalchemy.create_engine(f"sqlite:///{tmp_path}/missing/replica"))
+    assert router.probe() is None
+    assert reads_from(router) == "primary"
+
+    router.lag = 0  # stale measurement
+    assert reads_from(router) == "primary"
+    assert router.lag is None
+
+
+def test_without_replica(tmp_path):
+    router = ReadRouter(engine(tmp_path / "primary"))
+    router.start()
+    assert reads_from(router) == "primary"
+    router.close()
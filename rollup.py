@@ -0,0 +1,62 @@
+"""Hourly rollup of fatigue levels.
+
+fatigue_hourly keeps the count, sum, min and max of every user's fatigue
+levels per UTC hour. Every write to fatigue_levels recomputes the hours it
+touched from the (indexed) rows of those hours, so readers such as get_peer
+read at most one row per hour, and a retried upload that inserted nothing
+leaves the rollup unchanged.
+"""
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+import dialect
+
+stmt_refresh = dialect.upsert(
+    """INSERT INTO fatigue_hourly (user_id, hour, sample_count, level_sum, level_min, level_max)
+    SELECT user_id, :hour, COUNT(*), SUM(fatigue_level), MIN(fatigue_level), MAX(fatigue_level)
+    FROM fatigue_levels WHERE user_id=:user_id AND timestamp >= :hour AND timestamp < :next_hour
+    GROUP BY user_id""",
+    ("user_id", "hour"),
+    {"sample_count": "excluded.sample_count", "level_sum": "excluded.level_sum",
+     "level_min": "excluded.level_min", "level_max": "excluded.level_max"})
+stmt_rebuild = dialect.DialectText(
+    """INSERT INTO fatigue_hourly (user_id, hour, sample_count, level_sum, level_min, level_max)
+    SELECT user_id, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00') AS hour,
+    COUNT(*), SUM(fatigue_level), MIN(fatigue_level), MAX(fatigue_level)
+    FROM fatigue_levels GROUP BY user_id, hour""",
+    sqlite="""INSERT INTO fatigue_hourly (user_id, hour, sample_count, level_sum, level_min, level_max)
+    SELECT user_id, strftime('%Y-%m-%d %H:00:00', timestamp) AS hour,
+    COUNT(*), SUM(fatigue_level), MIN(fatigue_level), MAX(fatigue_level)
+    FROM fatigue_levels GROUP BY user_id, hour""")
+stmt_select = sqlalchemy.text(
+    """SELECT hour, sample_count, level_sum, level_min, level_max FROM fatigue_hourly
+    WHERE user_id=:user_id AND hour >= :start AND hour < :end""")
+
+
+def hour_of(timestamp: str) -> str:
+    """Truncate a 'YYYY-MM-DD HH:MM:SS' timestamp to its hour."""
+    return timestamp[:13] + ":00:00"
+
+
+def hours(rows: list) -> list:
+    """Return the stmt_refresh parameters of the user hours that fatigue_levels rows fall in."""
+    keys = {(row['user_id'], hour_of(row['timestamp'])) for row in rows}
+    return [{
+        "user_id": user_id,
+        "hour": hour,
+        "next_hour": (datetime.strptime(hour, '%Y-%m-%d %H:%M:%S')
+                      + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'),
+    } for user_id, hour in sorted(keys)]
+
+
+def backfill(conn) -> None:
+    """Build the rollup from fatigue_levels if it is still empty."""
+    if conn.execute("SELECT 1 FROM fatigue_hourly LIMIT 1").fetchone():
+        return
+    conn.execute(stmt_rebuild)
+
+
+def hourly(conn, user_id, start, end) -> list:
+    """Return (hour, count, sum, min, max) rows of a user for UTC hours in [start, end)."""
+    return conn.execute(stmt_select, user_id=user_id, start=start, end=end).fetchall()
@@ -1,37 +1,45 @@
-CREATE TABLE IF NOT EXISTS users(
-  user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-  fullname VARCHAR(40) NOT NULL,
-  group_id VARCHAR(20) NOT NULL,
-
-  age INTEGER NOT NULL,
-  max_heart_rate INTEGER NOT NULL,
-  rest_heart_rate INTEGER NOT NULL,
-  hrr_cp INTEGER NOT NULL,
-  awc_tot INTEGER NOT NULL,
-  k_value INTEGER NOT NULL,
-
-  fatigue_level INTEGER NOT NULL,
-  last_update DATETIME,
-
-  created DATETIME DEFAULT CURRENT_TIMESTAMP,
-);
-
-CREATE TABLE IF NOT EXISTS heart_rates(
-  user_id INTEGER NOT NULL,
-  heart_rate INTEGER NOT NULL,
-  timestamp DATETIME NOT NULL,
-
-  FOREIGN KEY(user_id)
-    REFERENCES users(user_id)
-    ON DELETE CASCADE,
-);
-
-CREATE TABLE IF NOT EXISTS fatigue_levels(
-  user_id INTEGER NOT NULL,
-  fatigue_level INTEGER NOT NULL,
-  timestamp DATETIME NOT NULL,
-
-  FOREIGN KEY(user_id)
-    REFERENCES users(user_id)
-    ON DELETE CASCADE,
-);
+-- SQLite schema at the latest migration, for reference: the app creates and
+-- upgrades its tables itself (see migrations.py). Regenerate with
+--   sqlite3 dpm.db .schema
+
+CREATE TABLE schema_version (version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied DATETIME DEFAULT CURRENT_TIMESTAMP);
+
+CREATE TABLE users (user_id INTEGER PRIMARY KEY AUTOINCREMENT, first_name VARCHAR(40) NOT NULL, last_name VARCHAR(40) NOT NULL, group_id VARCHAR(20) NOT NULL, age INTEGER NOT NULL, max_heart_rate INTEGER NOT NULL, rest_heart_rate INTEGER NOT NULL, hrr_cp INTEGER NOT NULL, awc_tot INTEGER NOT NULL, k_value INTEGER NOT NULL, fatigue_level INTEGER NOT NULL, last_update DATETIME, created DATETIME DEFAULT CURRENT_TIMESTAMP);
+
+CREATE TABLE heart_rates (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, heart_rate INTEGER NOT NULL, timestamp DATETIME NOT NULL, FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE TABLE fatigue_levels (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, fatigue_level INTEGER NOT NULL, timestamp DATETIME NOT NULL, FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE TABLE activities (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, peer_id INTEGER NOT NULL, timestamp DATETIME NOT NULL, if_open BOOLEAN NOT NULL, FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE TABLE fatigue_state (user_id INTEGER PRIMARY KEY, w_exp DOUBLE NOT NULL, last_minute DATETIME NOT NULL, watermark DATETIME NOT NULL, FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE TABLE fatigue_hourly (user_id INTEGER NOT NULL, hour DATETIME NOT NULL, sample_count INTEGER NOT NULL, level_sum BIGINT NOT NULL, level_min INTEGER NOT NULL, level_max INTEGER NOT NULL, PRIMARY KEY (user_id, hour), FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE INDEX ix_users_name ON users (first_name, last_name);
+
+CREATE INDEX ix_users_group ON users (group_id);
+
+CREATE INDEX ix_activities_user_time ON activities (user_id, timestamp);
+
+CREATE TABLE heart_rate_buckets (user_id INTEGER NOT NULL, resolution INTEGER NOT NULL, bucket DATETIME NOT NULL, sample_count INTEGER NOT NULL, hr_sum BIGINT NOT NULL, hr_min INTEGER NOT NULL, hr_max INTEGER NOT NULL, PRIMARY KEY (user_id, resolution, bucket));
+
+CREATE TABLE downsample_state (name VARCHAR(40) PRIMARY KEY, watermark BIGINT NOT NULL, horizon BIGINT NOT NULL);
+
+CREATE UNIQUE INDEX ux_heart_rates_user_time ON heart_rates (user_id, timestamp);
+
+CREATE UNIQUE INDEX ux_fatigue_levels_user_time ON fatigue_levels (user_id, timestamp);
+
+CREATE UNIQUE INDEX ux_activities_user_peer_time ON activities (user_id, peer_id, timestamp);
+
+CREATE TABLE replica_heartbeat (id INTEGER PRIMARY KEY, beat DATETIME(6) NOT NULL);
+
+CREATE TABLE view_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, peer_id INTEGER NOT NULL, started DATETIME NOT NULL, ended DATETIME NULL, timed_out BOOLEAN NOT NULL DEFAULT FALSE);
+
+CREATE INDEX ix_view_sessions_user_time ON view_sessions (user_id, started);
+
+CREATE INDEX ix_view_sessions_peer_time ON view_sessions (peer_id, started);
+
+CREATE INDEX ix_view_sessions_ended ON view_sessions (ended);
+
+CREATE TABLE view_session_state (id INTEGER PRIMARY KEY, watermark BIGINT NOT NULL, horizon BIGINT NOT NULL);
@@ -0,0 +1,208 @@
+"""Peer viewing sessions.
+
+activities holds raw events: a user opening (if_open) or closing the view of
+a peer. A background job pairs them into view_sessions rows, one per
+(user_id, peer_id, started, ended) interval, so "who viewed whom today" is
+a range read of an index instead of a replay of every event.
+
+Like downsample.py the job follows the activities id, and picks up late
+uploads whatever their timestamp. Each pair's events are paired in timestamp
+order. A session whose close never arrives is closed `timeout` seconds after
+it opened (VIEW_SESSION_TIMEOUT), or at the pair's next open if that is
+sooner, and flagged timed_out. A close without an open session is dropped.
+No session is longer than `timeout`, which bounds the index range read for
+the sessions overlapping a time window.
+
+    python sessions.py    # run once, e.g. from cron
+"""
+from datetime import datetime, timedelta
+
+import logging
+import os
+import threading
+
+import sqlalchemy
+
+import dialect
+
+logger = logging.getLogger()
+
+# activities rows paired per transaction
+BATCH_SIZE = 50000
+
+# seconds after which a session without a close is considered over
+DEFAULT_TIMEOUT = 1800.0
+
+stmt_state = sqlalchemy.text(
+    "SELECT watermark, horizon FROM view_session_state WHERE id = 1")
+stmt_save_state = dialect.upsert(
+    """INSERT INTO view_session_state (id, watermark, horizon)
+    VALUES (1, :watermark, :horizon)""",
+    ("id",), {"watermark": "excluded.watermark", "horizon": "excluded.horizon"})
+stmt_max_id = sqlalchemy.text("SELECT MAX(id) FROM activities")
+stmt_new_events = sqlalchemy.text(
+    """SELECT id, user_id, peer_id, timestamp, if_open FROM activities
+    WHERE id > :watermark AND id <= :horizon ORDER BY id LIMIT :limit""")
+stmt_open = sqlalchemy.text(
+    "SELECT id, user_id, peer_id, started FROM view_sessions WHERE ended IS NULL")
+stmt_insert = sqlalchemy.text(
+    """INSERT INTO view_sessions (user_id, peer_id, started, ended, timed_out)
+    VALUES (:user_id, :peer_id, :started, :ended, :timed_out)""")
+stmt_close = sqlalchemy.text(
+    "UPDATE view_sessions SET ended = :ended, timed_out = :timed_out WHERE id = :id")
+# sessions overlapping [start, end); those started by earliest (start - timeout) ended before start
+stmt_viewers = sqlalchemy.text(
+    """SELECT user_id, started, ended FROM view_sessions
+    WHERE peer_id = :user_id AND started > :earliest AND started < :end
+    AND (ended IS NULL OR ended > :start)""")
+stmt_viewed = sqlalchemy.text(
+    """SELECT peer_id, started, ended FROM view_sessions
+    WHERE user_id = :user_id AND started > :earliest AND started < :end
+    AND (ended IS NULL OR ended > :start)""")
+
+
+def session_timeout() -> float:
+    return float(os.environ.get("VIEW_SESSION_TIMEOUT", DEFAULT_TIMEOUT))
+
+
+def sessionize(events, open_sessions: dict, now: datetime, timeout: float = DEFAULT_TIMEOUT):
+    """Pair (user_id, peer_id, timestamp, if_open) events into sessions.
+
+    `open_sessions` maps (user_id, peer_id) to the (id, started) of the pair's
+    open session, id None if it is not stored yet; it is updated in place.
+    Sessions open for longer than `timeout` at `now` are closed too.
+    Return the sessions to insert and the stored sessions to close."""
+    limit = timedelta(seconds=timeout)
+    inserts = []
+    closes = []
+
+    def close(pair, session, ended, timed_out):
+        session_id, started = session
+        if session_id is None:
+            inserts.append({"user_id": pair[0], "peer_id": pair[1], "started": started,
+                            "ended": ended, "timed_out": timed_out})
+        else:
+            closes.append({"id": session_id, "ended": ended, "timed_out": timed_out})
+
+    for user_id, peer_id, timestamp, if_open in sorted(events, key=lambda e: (e[0], e[1], e[2])):
+        pair = (user_id, peer_id)
+        session = open_sessions.get(pair)
+        if session is not None and timestamp < session[1]:
+            continue  # older than the open session; its own session is gone
+        if if_open:
+            if session is not None:
+                close(pair, session, min(timestamp, session[1] + limit), True)
+            open_sessions[pair] = (None, timestamp)
+        elif session is not None:
+            if timestamp - session[1] <= limit:
+                close(pair, session, timestamp, False)
+            else:
+                close(pair, session, session[1] + limit, True)
+            del open_sessions[pair]
+
+    for pair, session in list(open_sessions.items()):
+        if now - session[1] > limit:
+            close(pair, session, session[1] + limit, True)
+            del open_sessions[pair]
+        elif session[0] is None:
+            inserts.append({"user_id": pair[0], "peer_id": pair[1], "started": session[1],
+                            "ended": None, "timed_out": False})
+    return inserts, closes
+
+
+def run(db: sqlalchemy.engine.base.Engine, now: datetime = None, timeout: float = None) -> int:
+    """Pair the activities uploaded since the last run into sessions.
+    Return the number of events processed."""
+    now = now or datetime.utcnow()
+    timeout = timeout if timeout is not None else session_timeout()
+    processed = 0
+    with db.connect() as conn:
+        # only one worker sessionizes at a time
+        with dialect.named_lock(conn, "sessions") as acquired:
+            if not acquired:
+                return 0
+            state = conn.execute(stmt_state).fetchone()
+            watermark, horizon = state if state is not None else (0, 0)
+            while True:
+                rows = conn.execute(stmt_new_events, watermark=watermark, horizon=horizon,
+                                    limit=BATCH_SIZE).fetchall()
+                with conn.begin():
+                    open_sessions = {(row[1], row[2]): (row[0], row[3])
+                                     for row in conn.execute(stmt_open).fetchall()}
+                    inserts, closes = sessionize([row[1:] for row in rows], open_sessions, now, timeout)
+                    if closes:
+                        conn.execute(stmt_close, closes)
+                    if inserts:
+                        conn.execute(stmt_insert, inserts)
+                    if rows:
+                        conn.execute(stmt_save_state, watermark=rows[-1][0], horizon=horizon)
+                if not rows:
+                    break
+                watermark = rows[-1][0]
+                processed += len(rows)
+            # ids up to the current maximum are processed by the next run
+            conn.execute(stmt_save_state, watermark=max(watermark, horizon),
+                         horizon=conn.execute(stmt_max_id).scalar() or 0)
+    return processed
+
+
+def _durations(rows, start: datetime, end: datetime, now: datetime) -> list:
+    """Sum (other user, started, ended) sessions per other user, within [start, end)
+    and open ones up to `now`."""
+    totals = {}
+    for other, started, ended in rows:
+        total = totals.setdefault(other, [0, 0.0])
+        total[0] += 1
+        total[1] += max(0.0, (min(ended or now, end) - max(started, start)).total_seconds())
+    return [{"user_id": other, "sessions": count, "seconds": round(seconds)}
+            for other, (count, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])]
+
+
+def _overlapping(conn, stmt, user_id: int, start: datetime, end: datetime, now: datetime):
+    earliest = start - timedelta(seconds=session_timeout())
+    rows = conn.execute(stmt, user_id=user_id, earliest=earliest, start=start, end=end).fetchall()
+    return _durations(rows, start, end, now or datetime.utcnow())
+
+
+def viewers(conn, user_id: int, start: datetime, end: datetime, now: datetime = None) -> list:
+    """Who viewed the user in sessions overlapping [start, end), and for how long within it."""
+    return _overlapping(conn, stmt_viewers, user_id, start, end, now)
+
+
+def viewed(conn, user_id: int, start: datetime, end: datetime, now: datetime = None) -> list:
+    """Whom the user viewed in sessions overlapping [start, end), and for how long within it."""
+    return _overlapping(conn, stmt_viewed, user_id, start, end, now)
+
+
+class Sessionizer:
+    """Background thread running the sessionizing job every `interval` seconds."""
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, interval: float) -> None:
+        self.db = db
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sessions", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                run(self.db)
+            except Exception as e:
+                logger.exception(e)
+
+
+def main():
+    from connect import init_connection_pool
+    processed = run(init_connection_pool())
+    print(f"paired {processed} activities into sessions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import sqlalchemy
+
+from connect_sqlite import connect_sqlite
+import migrations
+import sessions
+
+T0 = datetime(2022, 10, 1, 12)
+
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+
+def test_sessionize_pairs_and_times_out():
+    events = [
+        (1, 2, at(0), True), (1, 2, at(60), False),  # a closed session
+        (1, 3, at(0), True), (1, 3, at(100), True),  # reopened without a close
+        (1, 3, at(5000), True),  # never closed
+        (2, 1, at(10), False),  # close without an open
+    ]
+    open_sessions = {(4, 1): (9, at(-10))}
+    inserts, closes = sessions.sessionize(events, open_sessions, now=at(5100), timeout=1800)
+
+    assert [(s["user_id"], s["peer_id"], s["started"], s["ended"], s["timed_out"]) for s in inserts] == [
+        (1, 2, at(0), at(60), False),
+        (1, 3, at(0), at(100), True),
+        (1, 3, at(100), at(1900), True),
+        (1, 3, at(5000), None, False),
+    ]
+    # the stored session of (4, 1) timed out
+    assert closes == [{"id": 9, "ended": at(1790), "timed_out": True}]
+    assert open_sessions == {(1, 3): (None, at(5000))}
+
+
+def test_run_is_incremental(tmp_path, add_users):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    stmt_event = sqlalchemy.text(
+        "INSERT INTO activities (user_id, peer_id, timestamp, if_open) VALUES (:user_id, :peer_id, :timestamp, :if_open)")
+    with db.connect() as conn:
+        add_users(conn, ["a"] * 3)
+        conn.execute(stmt_event, [{"user_id": 1, "peer_id": 2, "timestamp": at(0), "if_open": True},
+                                  {"user_id": 3, "peer_id": 2, "timestamp": at(30), "if_open": True}])
+    # ids are picked up one run after they appear, as in downsample.py
+    assert sessions.run(db, now=at(60)) == 0
+    assert sessions.run(db, now=at(60)) == 2
+    with db.connect() as conn:
+        conn.execute(stmt_event, user_id=1, peer_id=2, timestamp=at(90), if_open=False)
+    sessions.run(db, now=at(120))
+    assert sessions.run(db, now=at(120)) == 1
+
+    with db.connect() as conn:
+        assert sessions.viewers(conn, 2, at(-60), at(3600), now=at(120)) == [
+            {"user_id": 1, "sessions": 1, "seconds": 90},
+            {"user_id": 3, "sessions": 1, "seconds": 90},
+        ]
+        assert sessions.viewed(conn, 1, at(-60), at(3600), now=at(120)) == [
+            {"user_id": 2, "sessions": 1, "seconds": 90}]
+
+
+def test_sessions_overlapping_the_window(tmp_path, monkeypatch):
+    monkeypatch.setenv("VIEW_SESSION_TIMEOUT", "600")
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    with db.connect() as conn:
+        conn.execute(sessions.stmt_insert, [
+            # crosses the start of the window
+            {"user_id": 1, "peer_id": 2, "started": at(-300), "ended": at(60), "timed_out": False},
+            # over before the window
+            {"user_id": 3, "peer_id": 2, "started": at(-900), "ended": at(-300), "timed_out": True},
+            # still open
+            {"user_id": 3, "peer_id": 2, "started": at(3500), "ended": None, "timed_out": False},
+        ])
+        assert sessions.viewers(conn, 2, at(0), at(3600), now=at(3560)) == [
+            {"user_id": 1, "sessions": 1, "seconds": 60},
+            {"user_id": 3, "sessions": 1, "seconds": 60},
+        ]
@@ -0,0 +1,106 @@
+"""Streaming upload sessions.
+
+A device opens one long-lived channel, a WebSocket on the async ingestion
+server or a chunked NDJSON POST to the Flask app, and sends JSON frames:
+
+    {"user_id": 1}                                                  # once, first
+    {"heart_rate": 80, "timestamp": 1657776614}                     # type defaults to heart_rate
+    {"type": "activity", "peer_id": 2, "if_open": true, "timestamp": 1657776614}
+
+Frames are validated with the ingest parsers and written in windows of up
+to `window` frames or `max_age` seconds. Each written window is acknowledged
+with `{"ack": n, "accepted": a, "rejected": [{"index": i, "error": ...}]}`,
+where n counts the frames received so far (the first frame excluded) and
+indexes refer to that count, so a client resends from its last ack.
+"""
+import json
+import time
+
+import sqlalchemy
+
+import ingest
+
+FRAME_KINDS = ("heart_rate", "activity")
+
+stmt_user = sqlalchemy.text("SELECT user_id FROM users WHERE user_id=:user_id")
+
+
+def hello(line) -> int:
+    """Validate the first frame of a stream. Return its user_id."""
+    try:
+        frame = json.loads(line)
+    except ValueError:
+        raise ingest.InvalidSample("first frame must be a JSON object")
+    if not isinstance(frame, dict):
+        raise ingest.InvalidSample("first frame must be a JSON object")
+    user_id = ingest._to_int(frame, 'user_id')
+    if user_id <= 0:
+        raise ingest.InvalidSample("invalid user_id")
+    return user_id
+
+
+class StreamSession:
+    """Frames of one device's stream, buffered until their window is written."""
+
+    def __init__(self, user_id: int, window: int = 100, max_age: float = 1.0) -> None:
+        self.user_id = user_id
+        self.window = window
+        self.max_age = max_age
+
+        self.received = 0
+        self._rows = {kind: [] for kind in FRAME_KINDS}
+        self._rejected = []
+        self._pending = 0
+        self._oldest = None
+
+    def feed(self, line) -> None:
+        """Validate one NDJSON line or WebSocket message and buffer it."""
+        index = self.received
+        self.received += 1
+        self._pending += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        try:
+            try:
+                frame = json.loads(line)
+            except ValueError:
+                raise ingest.InvalidSample("invalid JSON")
+            if not isinstance(frame, dict):
+                raise ingest.InvalidSample("frame must be an object")
+            kind = frame.get('type', "heart_rate")
+            if kind not in FRAME_KINDS:
+                raise ingest.InvalidSample("invalid type")
+            frame['user_id'] = self.user_id
+            parse, _ = ingest.KINDS[kind]
+            self._rows[kind].append(parse(frame))
+        except ingest.InvalidSample as e:
+            self._rejected.append({"index": index, "error": str(e)})
+
+    def timeout(self) -> float:
+        """Seconds until the buffered window is due, None while it is empty."""
+        if self._oldest is None:
+            return None
+        return max(0.0, self._oldest + self.max_age - time.monotonic())
+
+    def due(self) -> bool:
+        return self._pending >= self.window or self.timeout() == 0.0
+
+    def take(self):
+        """Hand over the buffered window. Return its rows per kind and the
+        acknowledgement to send once they are written."""
+        rows = self._rows
+        ack = {
+            "ack": self.received,
+            "accepted": self._pending - len(self._rejected),
+            "rejected": self._rejected,
+        }
+        self._rows = {kind: [] for kind in FRAME_KINDS}
+        self._rejected = []
+        self._pending = 0
+        self._oldest = None
+        return rows, ack
+
+
+def plan(rows: dict) -> list:
+    """Write plan of the rows of a window."""
+    return ingest.plan_heart_rates(rows["heart_rate"]) + ingest.plan_activities(rows["activity"])
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+import ingest
+import stream
+
+
+def test_hello():
+    assert stream.hello(b'{"user_id": 3}\n') == 3
+    for line in (b'', b'[]', b'{"user_id": 0}', b'{"heart_rate": 80}'):
+        with pytest.raises(ingest.InvalidSample):
+            stream.hello(line)
+
+
+def test_session_windows_and_acks():
+    session = stream.StreamSession(3, window=3, max_age=60)
+    assert session.timeout() is None
+    session.feed(json.dumps({"heart_rate": 80, "timestamp": 1657776614}))
+    session.feed(json.dumps({"type": "activity", "peer_id": 2, "if_open": True, "timestamp": 1657776615}))
+    assert not session.due()
+    session.feed(b'{"heart_rate": 900, "timestamp": 1657776616}')
+    assert session.due()
+
+    rows, ack = session.take()
+    assert ack == {"ack": 3, "accepted": 2,
+                   "rejected": [{"index": 2, "error": "heart_rate out of range"}]}
+    plan = dict(stream.plan(rows))
+    assert plan[ingest.stmt_heart_rate] == [
+        {"user_id": 3, "heart_rate": 80, "timestamp": "2022-07-14 05:30:14"}]
+    assert plan[ingest.stmt_activity][0]['peer_id'] == 2
+
+    session.feed(b'not json')
+    _, ack = session.take()
+    assert ack == {"ack": 4, "accepted": 0, "rejected": [{"index": 3, "error": "invalid JSON"}]}
+    assert session.timeout() is None
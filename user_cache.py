@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+import os
+import threading
+import time
+
+# columns of users cached as a profile; fatigue_level and last_update change
+# with every upload and are always read from the database
+PROFILE_COLUMNS = ("user_id", "first_name", "last_name", "group_id", "age", "max_heart_rate",
+                   "rest_heart_rate", "hrr_cp", "awc_tot", "k_value")
+
+
+class UserCache:
+    """LRU cache of user profiles with TTL, keyed by user_id and by name.
+
+    Names without a user are cached too, for `negative_ttl` seconds, so
+    repeated logins of unregistered users do not reach the database either.
+    Profiles written by this process replace the cached ones (`write`);
+    those changed by other processes are picked up when the entry expires.
+    """
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, max_entries: int = 20000) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # ("id", user_id) or ("name", first, last) -> (expires, profile or None)
+        self._generation = 0  # number of writes and invalidations
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "UserCache":
+        return cls(ttl=float(os.environ.get("USER_CACHE_TTL", 60)),
+                   negative_ttl=float(os.environ.get("USER_CACHE_NEGATIVE_TTL", 5)),
+                   max_entries=int(os.environ.get("USER_CACHE_SIZE", 20000)))
+
+    @staticmethod
+    def profile(row) -> dict:
+        """The profile of a users row."""
+        return {column: row[column] for column in PROFILE_COLUMNS}
+
+    def get(self, user_id: int):
+        """Return (hit, profile or None if there is no such user)."""
+        return self._get(("id", int(user_id)))
+
+    def get_by_name(self, first_name: str, last_name: str):
+        """Return (hit, profile or None if there is no such user)."""
+        return self._get(("name", first_name, last_name))
+
+    def token(self) -> int:
+        """Take before querying the database and hand to `put`, so a profile
+        read before a write is not cached after it."""
+        with self._lock:
+            return self._generation
+
+    def put(self, profile: dict, token: int) -> None:
+        """Cache a profile read from the database."""
+        with self._lock:
+            if self._generation == token:
+                self._store(profile)
+
+    def put_unknown(self, first_name: str, last_name: str, token: int) -> None:
+        """Cache that no user has this name."""
+        with self._lock:
+            if self._generation == token:
+                self._set(("name", first_name, last_name), None, self.negative_ttl)
+
+    def write(self, profile: dict) -> None:
+        """Replace the cached profile of a user after changing it in the database."""
+        with self._lock:
+            self._generation += 1
+            self._drop(profile["user_id"])
+            self._store(profile)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._generation += 1
+            self._drop(user_id)
+
+    def _get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def _store(self, profile: dict) -> None:
+        self._set(("id", int(profile["user_id"])), profile, self.ttl)
+        self._set(("name", profile["first_name"], profile["last_name"]), profile, self.ttl)
+
+    def _set(self, key: tuple, profile, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, profile)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _drop(self, user_id: int) -> None:
+        entry = self._entries.pop(("id", int(user_id)), None)
+        if entry is not None and entry[1] is not None:
+            self._entries.pop(("name", entry[1]["first_name"], entry[1]["last_name"]), None)
@@ -0,0 +1,46 @@
+import time
+
+from user_cache import UserCache
+
+
+def profile(user_id, first_name="Ada", group_id="a"):
+    return {"user_id": user_id, "first_name": first_name, "last_name": "Lovelace", "group_id": group_id,
+            "age": 36, "max_heart_rate": 175, "rest_heart_rate": 60, "hrr_cp": 0.4, "awc_tot": 20000,
+            "k_value": 5}
+
+
+def test_by_id_and_name():
+    cache = UserCache()
+    assert cache.get(1) == (False, None)
+    cache.put(profile(1), cache.token())
+    assert cache.get(1) == (True, profile(1))
+    assert cache.get_by_name("Ada", "Lovelace") == (True, profile(1))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_negative_entries_expire_first():
+    cache = UserCache(ttl=60, negative_ttl=0.01)
+    cache.put_unknown("Ada", "Lovelace", cache.token())
+    assert cache.get_by_name("Ada", "Lovelace") == (True, None)
+    time.sleep(0.02)
+    assert cache.get_by_name("Ada", "Lovelace") == (False, None)
+
+
+def test_write_through_replaces_the_old_name():
+    cache = UserCache()
+    cache.put(profile(1), cache.token())
+    token = cache.token()
+    cache.write(profile(1, first_name="Augusta", group_id="b"))
+    assert cache.get(1) == (True, profile(1, first_name="Augusta", group_id="b"))
+    assert cache.get_by_name("Ada", "Lovelace") == (False, None)
+    # a profile read before the write is not cached after it
+    cache.put(profile(1), token)
+    assert cache.get(1)[1]["first_name"] == "Augusta"
+
+
+def test_size_bound():
+    cache = UserCache(max_entries=4)
+    for user_id in range(1, 4):
+        cache.put(profile(user_id, first_name=str(user_id)), cache.token())
+    assert cache.get(1) == (False, None)
+    assert cache.get(3)[0]
@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+
+import sqlalchemy
+
+from idempotency import RecentKeys
+import ingest
+
+logger = logging.getLogger()
+
+
+class QueueFull(Exception):
+    """Raised when the write-behind buffer cannot accept more samples."""
+
+
+class WriteBehindBuffer:
+    """Bounded in-process buffer for uploaded samples.
+
+    Upload handlers validate samples and `put` them here instead of writing
+    them synchronously. A background flusher thread drains the buffer into
+    heart_rates, fatigue_levels and activities in bulk, whenever `batch_size`
+    samples are pending or the oldest pending sample is `max_age` seconds old.
+
+    A batch the database refuses is split in halves until the failing samples
+    are isolated, so the rest is written. A sample refused `max_attempts`
+    times on its own (e.g. for an unknown user) is logged and dropped rather
+    than retried forever. While the database is unavailable nothing is
+    dropped: failed batches are retried and the full queue pushes back.
+
+    `on_written(kind, rows, inserted)` is called from the flusher thread once
+    rows are in the database. The counters are updated and read under the
+    buffer's lock; samples that cannot be written on `close` count as dropped.
+    """
+
+    def __init__(self, db: sqlalchemy.engine.base.Engine, max_size: int = 10000,
+                 batch_size: int = 500, max_age: float = 1.0, max_attempts: int = 3,
+                 on_written=None) -> None:
+        self.db = db
+        self.on_written = on_written
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+
+        self._cond = threading.Condition()
+        self._pending = {kind: [] for kind in ingest.KINDS}
+        self._depth = 0
+        self._oldest = None
+        self._stopping = False
+        self._thread = None
+        self._attempts = {}  # key of a refused sample -> times refused
+
+        # counters
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.dropped = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, db: sqlalchemy.engine.base.Engine, on_written=None) -> "WriteBehindBuffer":
+        return cls(
+            db,
+            max_size=int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", 10000)),
+            batch_size=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500)),
+            max_age=float(os.environ.get("WRITE_BEHIND_MAX_AGE", 1.0)),
+            max_attempts=int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", 3)),
+            on_written=on_written,
+        )
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, kind: str, rows: list) -> None:
+        """Queue validated rows of the given kind, all or nothing.
+        Raise QueueFull when there is no room for every row."""
+        with self._cond:
+            if self._stopping or self._depth + len(rows) > self.max_size:
+                self.rejected += len(rows)
+                raise QueueFull()
+            self._pending[kind].extend(rows)
+            self._depth += len(rows)
+            self.enqueued += len(rows)
+            if self._oldest is None:
+                # wake the flusher so it starts the age timer
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif self._depth >= self.batch_size:
+                self._cond.notify()
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stop accepting samples, flush everything pending and stop the flusher."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # flush leftovers if the flusher never ran or gave up
+        failed = self._flush(self._take())
+        dropped = sum(len(rows) for rows in failed.values())
+        if dropped:
+            with self._cond:
+                self.dropped += dropped
+            logger.error(f"write-behind dropped {dropped} samples on shutdown")
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": self._depth,
+                "queue_capacity": self.max_size,
+                "enqueued": self.enqueued,
+                "rejected": self.rejected,
+                "flushed": self.flushed,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "dropped": self.dropped,
+                "last_flush_seconds": self.last_flush_seconds,
+                "max_flush_seconds": self.max_flush_seconds,
+                "avg_flush_seconds": self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+            }
+
+    def _take(self) -> dict:
+        with self._cond:
+            pending = self._pending
+            self._pending = {kind: [] for kind in ingest.KINDS}
+            self._depth = 0
+            self._oldest = None
+        return pending
+
+    def _requeue(self, pending: dict) -> None:
+        # put a failed batch back in front of newer samples; may exceed max_size
+        # briefly, which makes put() push back on clients until the DB recovers
+        with self._cond:
+            for kind, rows in pending.items():
+                self._pending[kind][:0] = rows
+                self._depth += len(rows)
+            if self._oldest is None and self._depth:
+                self._oldest = time.monotonic()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping and self._depth < self.batch_size:
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._oldest + self.max_age - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                stopping = self._stopping
+
+            failed = self._flush(self._take())
+            if stopping:
+                # close() retries whatever is left once more
+                self._requeue(failed)
+                return
+            if failed:
+                self._requeue(failed)
+                time.sleep(self.max_age)
+
+    def _flush(self, pending: dict) -> dict:
+        """Write pending rows, one transaction per kind.
+        Return the rows of the kinds that could not be written."""
+        failed = {}
+        if not any(pending.values()):
+            return failed
+
+        start = time.perf_counter()
+        try:
+            with self.db.connect() as conn:
+                for kind, rows in pending.items():
+                    if rows:
+                        rows = self._write(conn, kind, rows)
+                    if rows:
+                        failed[kind] = rows
+        except Exception as e:
+            # could not get a connection at all
+            with self._cond:
+                self.flush_errors += 1
+            logger.exception(e)
+            return {kind: rows for kind, rows in pending.items() if rows}
+
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.flushes += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+        return failed
+
+    def _write(self, conn, kind: str, rows: list) -> list:
+        """Write rows of one kind, bisecting a refused batch.
+        Return the rows to retry."""
+        _, write = ingest.KINDS[kind]
+        try:
+            inserted = write(conn, rows)
+        except sqlalchemy.exc.OperationalError as e:
+            # the database is unavailable or busy, not refusing these rows
+            with self._cond:
+                self.flush_errors += 1
+            logger.exception(e)
+            return rows
+        except Exception as e:
+            if len(rows) > 1:
+                middle = len(rows) // 2
+                return self._write(conn, kind, rows[:middle]) + self._write(conn, kind, rows[middle:])
+            with self._cond:
+                self.flush_errors += 1
+            key = RecentKeys.key(kind, rows[0])
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[key] = attempts
+                return rows
+            self._attempts.pop(key, None)
+            with self._cond:
+                self.dropped += 1
+            logger.error(f"write-behind dropped a {kind} sample refused {attempts} times: {e}",
+                         extra={"kind": kind, "sample": rows[0]})
+            return []
+        with self._cond:
+            self.flushed += len(rows)
+        if self.on_written is not None:
+            self.on_written(kind, rows, inserted)
+        if self._attempts:
+            for row in rows:
+                self._attempts.pop(RecentKeys.key(kind, row), None)
+        return []
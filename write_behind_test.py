@@ -0,0 +1,129 @@
+import time
+
+import pytest
+import sqlalchemy
+
+from connect_sqlite import connect_sqlite
+import ingest
+import migrations
+from write_behind import QueueFull, WriteBehindBuffer
+
+
+def row(second, heart_rate=80):
+    return {"user_id": 1, "heart_rate": heart_rate, "timestamp": f"2022-10-01 12:00:{second:02d}"}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def db(tmp_path, add_users):
+    db = connect_sqlite(str(tmp_path / "dpm.db"))
+    migrations.migrate(db)
+    add_users(db)
+    return db
+
+
+def stored(db):
+    with db.connect() as conn:
+        return [row[0] for row in conn.execute("SELECT heart_rate FROM heart_rates ORDER BY timestamp")]
+
+
+def failing_writes(monkeypatch, refuse):
+    """Make heart rate writes raise the error `refuse(rows)` returns, if any."""
+    parse, write = ingest.KINDS["heart_rate"]
+
+    def flaky_write(conn, rows):
+        error = refuse(rows)
+        if error is not None:
+            raise error
+        write(conn, rows)
+
+    monkeypatch.setitem(ingest.KINDS, "heart_rate", (parse, flaky_write))
+
+
+def test_flush_by_size_and_age(db):
+    buffer = WriteBehindBuffer(db, batch_size=3, max_age=60)
+    buffer.start()
+    buffer.put("heart_rate", [row(0), row(1)])
+    time.sleep(0.1)
+    assert buffer.stats()["flushed"] == 0
+    buffer.put("heart_rate", [row(2)])
+    wait_for(lambda: buffer.stats()["flushed"] == 3)
+    buffer.close()
+
+    buffer = WriteBehindBuffer(db, batch_size=100, max_age=0.05)
+    buffer.start()
+    buffer.put("heart_rate", [row(3)])
+    wait_for(lambda: buffer.stats()["flushed"] == 1)
+    buffer.close()
+    assert stored(db) == [80] * 4
+
+
+def test_failed_batch_is_requeued(db, monkeypatch):
+    failures = [sqlalchemy.exc.OperationalError("INSERT", {}, Exception("database is locked"))]
+    failing_writes(monkeypatch, lambda rows: failures.pop() if failures else None)
+    buffer = WriteBehindBuffer(db, batch_size=2, max_age=0.05)
+    buffer.start()
+    buffer.put("heart_rate", [row(0), row(1)])
+    wait_for(lambda: buffer.stats()["flushed"] == 2)
+    buffer.close()
+    stats = buffer.stats()
+    assert (stats["flush_errors"], stats["dropped"], stats["queue_depth"]) == (1, 0, 0)
+    assert stored(db) == [80, 80]
+
+
+def test_close_flushes_and_stops_accepting(db):
+    buffer = WriteBehindBuffer(db, batch_size=100, max_age=60)
+    buffer.put("heart_rate", [row(0), row(1)])
+    buffer.close()
+    assert stored(db) == [80, 80]
+    with pytest.raises(QueueFull):
+        buffer.put("heart_rate", [row(2)])
+
+
+def test_queue_full(db):
+    buffer = WriteBehindBuffer(db, max_size=2)
+    buffer.put("heart_rate", [row(0)])
+    with pytest.raises(QueueFull):
+        buffer.put("heart_rate", [row(1), row(2)])
+    assert buffer.stats()["rejected"] == 2
+
+
+def test_poison_sample_is_isolated_and_dropped(db):
+    buffer = WriteBehindBuffer(db, batch_size=5, max_age=0.01, max_attempts=2)
+    buffer.start()
+    # refused by the foreign key on user_id
+    unknown_user = {**row(2), "user_id": 2}
+    buffer.put("heart_rate", [row(0), row(1), unknown_user, row(3), row(4)])
+    # the other samples are written with the first flush
+    wait_for(lambda: buffer.stats()["flushed"] == 4)
+    wait_for(lambda: buffer.stats()["dropped"] == 1)
+    buffer.put("heart_rate", [row(5)])
+    wait_for(lambda: buffer.stats()["flushed"] == 5)
+    buffer.close()
+    assert buffer.stats()["queue_depth"] == 0
+    assert stored(db) == [80] * 5
+
+
+def test_rows_are_reported_once_written(db):
+    written = []
+    buffer = WriteBehindBuffer(db, batch_size=100, max_age=60,
+                               on_written=lambda kind, rows, inserted: written.append((kind, len(rows), inserted)))
+    buffer.put("heart_rate", [row(0), row(1)])
+    assert written == []
+    buffer.close()
+    assert written == [("heart_rate", 2, 2)]
+
+
+def test_samples_left_on_shutdown_count_as_dropped(db, monkeypatch):
+    failing_writes(monkeypatch, lambda rows: sqlalchemy.exc.OperationalError("INSERT", {}, Exception("gone")))
+    buffer = WriteBehindBuffer(db, batch_size=100, max_age=60)
+    buffer.put("heart_rate", [row(0), row(1)])
+    buffer.close()
+    stats = buffer.stats()
+    assert (stats["dropped"], stats["flushed"], stats["queue_depth"]) == (2, 0, 0)